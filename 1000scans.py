@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 import re
-from Hooks.scans.parser import parse
+from Hooks.scans.parser import parse, pool
 from time import sleep
 import gc
 
@@ -16,4 +16,5 @@ with open("1000scans.txt") as f:
         sleep(2)
         gc.collect()
 
+pool.join()
 print "Done."
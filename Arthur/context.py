@@ -20,9 +20,14 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
  
 from django.http import HttpResponse
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    StreamingHttpResponse = None
 
 from Core.exceptions_ import UserError
 from Core.config import Config
+from Core.db import session
 from Core.maps import Updates, Slogan
 from Arthur.jinja import jinja
 
@@ -100,3 +105,18 @@ def base_context(request):
 def render(template, request, **context):
     context = dict(base_context(request).items() + context.items())
     return HttpResponse(jinja.get_template(template).render(context))
+
+def stream(template, request, **context):
+    # Render the template as it's sent, rather than building the whole page
+    #  first. The session is kept open until the page is done, as the
+    #  template may still load attributes of the objects it's given.
+    context = dict(base_context(request).items() + context.items())
+    if StreamingHttpResponse is None:
+        return HttpResponse(jinja.get_template(template).render(context))
+    def generate():
+        try:
+            for chunk in jinja.get_template(template).generate(context):
+                yield chunk
+        finally:
+            session.remove()
+    return StreamingHttpResponse(generate())
@@ -32,7 +32,9 @@ class db(object):
         session.remove()
     
     def process_response(self, request, response):
-        session.remove()
+        # Streamed pages remove the session once they're sent
+        if not getattr(response, "streaming", False):
+            session.remove()
         return response
     
     def process_exception(self, request, exception):
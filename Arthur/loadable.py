@@ -26,8 +26,10 @@ import hashlib
 
 from Core.exceptions_ import LoadableError, UserError
 from Core.config import Config
-from Core.db import Session, session
+from Core.db import session
 from Core.maps import Planet, Alliance, User, Arthur, Intel, PageView
+from Core.audit import AuditLog
+from Core.profiler import Profiler
 from Core.loadable import _base, require_user, require_planet
 from Arthur.context import render
 
@@ -100,18 +102,18 @@ class loadable(_base):
         return user, cookie, key, planet_id
     
     def run(self, request, **kwargs):
+        call = Profiler.start()
         try:
             user, cookie, key, planet_id = self.router(request)
             response = self.execute(request, user, **kwargs)
             
-            session = Session()
-            session.add(PageView(page = self.name,
-                                 full_request = request.get_full_path(),
-                                 username = user.name,
-                                 session = key,
-                                 planet_id = user.planet.id if user.planet else None,
-                                 hostname = request.META['REMOTE_ADDR'],))
-            session.commit()
+            AuditLog.add(PageView, page = self.name,
+                                   full_request = request.get_full_path(),
+                                   username = user.name,
+                                   session = key,
+                                   planet_id = user.planet.id if user.planet else None,
+                                   hostname = request.META['REMOTE_ADDR'],
+                                   request_time = datetime.now(),)
             
             if cookie is not None:
                 response.set_cookie(SESSION_KEY, cookie, expires=request.session.expire)
@@ -125,6 +127,9 @@ class loadable(_base):
         
         except UserError, e:
             return self.login_page(request, str(e))
+        
+        finally:
+            Profiler.stop(call, self.name)
     
     def execute(self, request, user, **kwargs):
         pass
@@ -28,12 +28,12 @@
                     ("galreal_score", "[Galaxy] Real Score",),
                 )
         %}
-{% block title %}Search Results{% endblock %}
+{% block title %}Search Results{% if estimated %} (about {{count|intcomma}}){% endif %}{% endblock %}
 {% block sort_rank %}{{ order }}{% endblock %}
 {% block sort %}{{ order }}{% endblock %}
 {% block sort_growth %}{{ order }}{% endblock %}
 {% block showsort %}{%for opt, name in orders if sort==opt%}<th>{{name}}</th>{%else%}{{super()}}{%endfor%}{%endblock%}
-{% block page %}/search/{{params}}/page:{{p}}/{% endblock %}
+{% block page %}/search/{{params}}/page:{{p}}/{% if after and p == page + 1 %}after:{{after}}/{% endif %}{% endblock %}
 {% block content %}
 <form method="post" action="/search/">
 <input type="hidden" value="search" name="search">
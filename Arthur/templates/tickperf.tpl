@@ -0,0 +1,48 @@
+{% extends "base.tpl" %}
+{% block content %}
+<table cellspacing="1" cellpadding="3" class="black">
+    <tr class="datahigh">
+        <th colspan="5">
+            Tick {{ tick or "" }} stage timings against the previous {{ ticks }} ticks
+        </th>
+    </tr>
+    <tr class="header">
+        <th>Stage</th>
+        <th width="80">Seconds</th>
+        <th width="80">Average</th>
+        <th width="80">Worst</th>
+        <th width="70">Change</th>
+    </tr>
+    {% for stage, seconds, average, worst in stages %}
+    <tr class="{{ loop.cycle('odd', 'even') }}">
+        <td>{{ stage }}</td>
+        <td class="right">{{ "%.3f"|format(seconds) }}</td>
+        <td class="right">{% if average is not none %}{{ "%.3f"|format(average) }}{% endif %}</td>
+        <td class="right">{% if worst is not none %}{{ "%.3f"|format(worst) }}{% endif %}</td>
+        <td class="right">{% if average %}{% set pc = (seconds / average - 1) * 100 %}
+            <span class="{% if pc > 50 %}red{% elif pc < 0 %}green{% else %}yellow{% endif %}">{{ pc|round(1) }}%</span>
+        {% endif %}</td>
+    </tr>
+    {% else %}
+    <tr class="odd"><td colspan="5" class="center">No tick timings have been recorded yet</td></tr>
+    {% endfor %}
+</table>
+
+<p>&nbsp;</p>
+
+<table cellspacing="1" cellpadding="3" class="black">
+    <tr class="datahigh">
+        <th colspan="2">Total per tick</th>
+    </tr>
+    <tr class="header">
+        <th width="60">Tick</th>
+        <th width="80">Seconds</th>
+    </tr>
+    {% for tick, seconds in totals %}
+    <tr class="{{ loop.cycle('odd', 'even') }}">
+        <td class="right">{{ tick }}</td>
+        <td class="right">{{ "%.3f"|format(seconds) }}</td>
+    </tr>
+    {% endfor %}
+</table>
+{% endblock %}
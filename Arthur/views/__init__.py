@@ -34,6 +34,7 @@ urlpatterns = patterns('Arthur.views',
     (r'', include('Arthur.views.attack')),
     (r'', include('Arthur.views.scans')),
     (r'', include('Arthur.views.graphs')),
+    (r'', include('Arthur.views.tickperf')),
 )
 
 from Arthur.views import home
@@ -46,3 +47,4 @@ from Arthur.views import search
 from Arthur.views import exiles
 from Arthur.views import attack
 from Arthur.views import scans
+from Arthur.views import tickperf
@@ -20,8 +20,7 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
  
 from sqlalchemy.sql import asc, desc
-from Core.db import session
-from Core.maps import Alliance
+from Core.maps import Updates, Alliance, rankings_cache
 from Arthur.context import menu, render
 from Arthur.loadable import loadable, load
 
@@ -50,14 +49,19 @@ class alliances(loadable):
             sort = "score"
         order = order.get(sort)
         
-        Q = session.query(Alliance)
-        Q = Q.filter(Alliance.active == True)
+        def rankings(private):
+            Q = private.query(Alliance)
+            Q = Q.filter(Alliance.active == True)
+            
+            count = Q.count()
+            
+            for o in order:
+                Q = Q.order_by(o)
+            Q = Q.limit(50).offset(offset)
+            return count, Q.all()
         
-        count = Q.count()
+        count, alliances = rankings_cache.get(Updates.current_tick(), ("alliances", page, sort,), rankings)
         pages = count/50 + int(count%50 > 0)
         pages = range(1, 1+pages)
         
-        for o in order:
-            Q = Q.order_by(o)
-        Q = Q.limit(50).offset(offset)
-        return render("alliances.tpl", request, alliances=Q.all(), offset=offset, pages=pages, page=page, sort=sort)
+        return render("alliances.tpl", request, alliances=alliances, offset=offset, pages=pages, page=page, sort=sort)
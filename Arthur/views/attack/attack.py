@@ -23,7 +23,7 @@ from django.core.urlresolvers import reverse
 from django.http import HttpResponseRedirect
 from sqlalchemy.sql import asc
 from Core.db import session
-from Core.maps import Updates, Planet, Target, Attack
+from Core.maps import Updates, Planet, Target, Attack, LatestScan
 from Core.config import Config
 from Arthur.context import menu, render
 from Arthur.loadable import loadable, load
@@ -51,9 +51,12 @@ class attack(loadable):
         Q = Q.filter(Target.tick >= tick - 12) # We shouldn't need any bookings 12 ticks after landing
         Q = Q.order_by(asc(Target.tick), asc(Planet.x), asc(Planet.y), asc(Planet.z))
         
+        result = Q.all()
+        LatestScan.load([planet for planet, tock in result], "PDUAJ")
+        
         bookings = []
         scans = []
-        for planet, tock in Q.all():
+        for planet, tock in result:
             bookings.append((planet, tock, [],))
             if planet.scan("P"):
                 bookings[-1][2].append(planet.scan("P"))
@@ -85,6 +88,8 @@ class view(loadable):
         waves = xrange(attack.landtick, attack.landtick + attack.waves)
         show_jgps = attack.landtick <= Updates.current_tick() + Config.getint("Misc", "attjgp")
         
+        LatestScan.load(attack.planets, "PDUAJ")
+        
         group = []
         scans = []
         for planet in attack.planets:
@@ -20,8 +20,7 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
  
 from sqlalchemy.sql import asc, desc
-from Core.db import session
-from Core.maps import Galaxy
+from Core.maps import Updates, Galaxy, rankings_cache
 from Arthur.context import menu, render
 from Arthur.loadable import loadable, load
 
@@ -53,14 +52,19 @@ class galaxies(loadable):
             sort = "score"
         order = order.get(sort)
         
-        Q = session.query(Galaxy)
-        Q = Q.filter(Galaxy.active == True)
+        def rankings(private):
+            Q = private.query(Galaxy)
+            Q = Q.filter(Galaxy.active == True)
+            
+            count = Q.count()
+            
+            for o in order:
+                Q = Q.order_by(o)
+            Q = Q.limit(50).offset(offset)
+            return count, Q.all()
         
-        count = Q.count()
+        count, galaxies = rankings_cache.get(Updates.current_tick(), ("galaxies", page, sort,), rankings)
         pages = count/50 + int(count%50 > 0)
         pages = range(1, 1+pages)
         
-        for o in order:
-            Q = Q.order_by(o)
-        Q = Q.limit(50).offset(offset)
-        return render("galaxies.tpl", request, galaxies=Q.all(), offset=offset, pages=pages, page=page, sort=sort)
+        return render("galaxies.tpl", request, galaxies=galaxies, offset=offset, pages=pages, page=page, sort=sort)
@@ -28,7 +28,7 @@ from sqlalchemy.sql import asc, desc
 
 from Core.config import Config
 from Core.db import session
-from Core.maps import Updates, Galaxy, Planet, Alliance
+from Core.maps import Updates, Galaxy, Planet, Alliance, rankings_cache
 from Arthur.context import menu, render
 from Arthur.errors import page_not_found
 from Arthur.loadable import loadable, load, require_user
@@ -61,37 +61,57 @@ class home(loadable):
         
         planet, galaxy = (user.planet, user.planet.galaxy,) if user.planet else (Planet(), Galaxy(),)
         
-        planets = session.query(Planet).filter(Planet.active == True)
-        galaxies = session.query(Galaxy).filter(Galaxy.active == True)
-        alliances = session.query(Alliance).filter(Alliance.active == True)
+        ranks = rankings_cache.get(Updates.current_tick(), "home", self.rankings)
         
         dup = lambda l,o,c=True: l+[o] if o in session and c and o not in l else l
         
         return render("index.tpl", request,
-                     topplanets = dup(planets.order_by(asc(Planet.score_rank))[:20], 
+                     topplanets = dup(ranks["topplanets"], 
                                       planet),
-                 roidingplanets = dup(planets.filter(Planet.size_growth > 0).order_by(desc(Planet.size_growth))[:5],
+                 roidingplanets = dup(ranks["roidingplanets"],
                                       planet, planet.size_growth > 0),
-                  roidedplanets = dup(planets.filter(Planet.size_growth < 0).order_by(asc(Planet.size_growth))[:5],
+                  roidedplanets = dup(ranks["roidedplanets"],
                                       planet, planet.size_growth < 0),
-                      xpplanets = dup(planets.filter(Planet.xp_growth > 0).order_by(desc(Planet.xp_growth))[:5],
+                      xpplanets = dup(ranks["xpplanets"],
                                       planet, planet.xp_growth > 0),
-                  bashedplanets = dup(planets.filter(Planet.value_growth < 0).order_by(asc(Planet.value_growth))[:5],
+                  bashedplanets = dup(ranks["bashedplanets"],
                                       planet, planet.value_growth < 0),
                 
-                    topgalaxies = dup(galaxies.order_by(asc(Galaxy.score_rank))[:10],
+                    topgalaxies = dup(ranks["topgalaxies"],
                                       galaxy),
-                roidinggalaxies = dup(galaxies.filter(Galaxy.size_growth > 0).order_by(desc(Galaxy.size_growth))[:5],
+                roidinggalaxies = dup(ranks["roidinggalaxies"],
                                       galaxy, galaxy.size_growth > 0),
-                 roidedgalaxies = dup(galaxies.filter(Galaxy.size_growth < 0).order_by(asc(Galaxy.size_growth))[:5],
+                 roidedgalaxies = dup(ranks["roidedgalaxies"],
                                       galaxy, galaxy.size_growth < 0),
-                     xpgalaxies = dup(galaxies.filter(Galaxy.xp_growth > 0).order_by(desc(Galaxy.xp_growth))[:5],
+                     xpgalaxies = dup(ranks["xpgalaxies"],
                                       galaxy, galaxy.xp_growth > 0),
-                 bashedgalaxies = dup(galaxies.filter(Galaxy.value_growth < 0).order_by(asc(Galaxy.value_growth))[:5],
+                 bashedgalaxies = dup(ranks["bashedgalaxies"],
                                       galaxy, galaxy.value_growth < 0),
                 
-                   topalliances =     alliances.order_by(asc(Alliance.score_rank))[:8],
+                   topalliances =     ranks["topalliances"],
                             )
+    
+    def rankings(self, private):
+        # The same for everyone until the next tick
+        planets = private.query(Planet).filter(Planet.active == True)
+        galaxies = private.query(Galaxy).filter(Galaxy.active == True)
+        alliances = private.query(Alliance).filter(Alliance.active == True)
+        
+        return {
+                     "topplanets" : planets.order_by(asc(Planet.score_rank))[:20],
+                 "roidingplanets" : planets.filter(Planet.size_growth > 0).order_by(desc(Planet.size_growth))[:5],
+                  "roidedplanets" : planets.filter(Planet.size_growth < 0).order_by(asc(Planet.size_growth))[:5],
+                      "xpplanets" : planets.filter(Planet.xp_growth > 0).order_by(desc(Planet.xp_growth))[:5],
+                  "bashedplanets" : planets.filter(Planet.value_growth < 0).order_by(asc(Planet.value_growth))[:5],
+                
+                    "topgalaxies" : galaxies.order_by(asc(Galaxy.score_rank))[:10],
+                "roidinggalaxies" : galaxies.filter(Galaxy.size_growth > 0).order_by(desc(Galaxy.size_growth))[:5],
+                 "roidedgalaxies" : galaxies.filter(Galaxy.size_growth < 0).order_by(asc(Galaxy.size_growth))[:5],
+                     "xpgalaxies" : galaxies.filter(Galaxy.xp_growth > 0).order_by(desc(Galaxy.xp_growth))[:5],
+                 "bashedgalaxies" : galaxies.filter(Galaxy.value_growth < 0).order_by(asc(Galaxy.value_growth))[:5],
+                
+                   "topalliances" : alliances.order_by(asc(Alliance.score_rank))[:8],
+               }
 
 @menu(name,          "Intel",       suffix = name)
 @menu("Planetarion", "BCalc",       suffix = "bcalc")
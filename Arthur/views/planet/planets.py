@@ -22,7 +22,7 @@
 from sqlalchemy.sql import asc, desc
 from Core.paconf import PA
 from Core.db import session
-from Core.maps import Planet, Alliance, Intel
+from Core.maps import Updates, Planet, Alliance, Intel, rankings_cache
 from Arthur.context import menu, render
 from Arthur.loadable import loadable, load
 
@@ -51,21 +51,34 @@ class planets(loadable):
             sort = "score"
         order = order.get(sort)
         
-        Q = session.query(Planet, Intel.nick, Alliance.name)
-        Q = Q.outerjoin(Planet.intel)
-        Q = Q.outerjoin(Intel.alliance)
-        Q = Q.filter(Planet.active == True)
-        
-        if race.lower() in PA.options("races"):
-            Q = Q.filter(Planet.race.ilike(race))
-        else:
+        if race.lower() not in PA.options("races"):
             race = "all"
         
-        count = Q.count()
+        def rankings(private):
+            Q = private.query(Planet)
+            Q = Q.filter(Planet.active == True)
+            
+            if race != "all":
+                Q = Q.filter(Planet.race.ilike(race))
+            
+            count = Q.count()
+            
+            for o in order:
+                Q = Q.order_by(o)
+            Q = Q.limit(50).offset(offset)
+            return count, Q.all()
+        
+        count, planets = rankings_cache.get(Updates.current_tick(), ("planets", page, sort, race,), rankings)
         pages = count/50 + int(count%50 > 0)
         pages = range(1, 1+pages)
         
-        for o in order:
-            Q = Q.order_by(o)
-        Q = Q.limit(50).offset(offset)
-        return render("planets.tpl", request, planets=Q.all(), offset=offset, pages=pages, page=page, sort=sort, race=race)
+        # Intel can change at any time, so it isn't cached
+        intel = {}
+        if len(planets) > 0:
+            Q = session.query(Intel.planet_id, Intel.nick, Alliance.name)
+            Q = Q.outerjoin(Intel.alliance)
+            Q = Q.filter(Intel.planet_id.in_([planet.id for planet in planets]))
+            intel = dict([(id, (nick, alliance,),) for id, nick, alliance in Q.all()])
+        planets = [(planet,) + intel.get(planet.id, (None, None,)) for planet in planets]
+        
+        return render("planets.tpl", request, planets=planets, offset=offset, pages=pages, page=page, sort=sort, race=race)
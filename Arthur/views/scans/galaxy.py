@@ -23,7 +23,7 @@ from django.core.urlresolvers import reverse
 from django.http import HttpResponseRedirect
 from Core.config import Config
 from Core.paconf import PA
-from Core.maps import Galaxy, Scan
+from Core.maps import Galaxy, Scan, LatestScan
 from Arthur.context import render
 from Arthur.loadable import loadable, load
 
@@ -36,6 +36,8 @@ class galaxy(loadable):
         if galaxy is None:
             return HttpResponseRedirect(reverse("galaxy_ranks"))
         
+        LatestScan.load([planet for planet in galaxy.planets if planet.active], "PDUA")
+        
         group = []
         scans = []
         for planet in galaxy.planets:
@@ -67,6 +69,8 @@ class types(loadable):
         if galaxy is None:
             return HttpResponseRedirect(reverse("galaxy_ranks"))
         
+        LatestScan.load([planet for planet in galaxy.planets if planet.active], types)
+        
         group = []
         scans = []
         for planet in galaxy.planets:
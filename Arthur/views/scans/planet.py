@@ -25,7 +25,7 @@ from sqlalchemy.sql import asc, desc
 from Core.config import Config
 from Core.paconf import PA
 from Core.db import session
-from Core.maps import Planet, Scan
+from Core.maps import Planet, Scan, LatestScan
 from Arthur.context import render
 from Arthur.loadable import loadable, load
 
@@ -94,6 +94,8 @@ class types(loadable):
         if planet is None:
             return HttpResponseRedirect(reverse("planet_ranks"))
         
+        LatestScan.load([planet], types)
+        
         group = [(planet, [],)]
         scans = []
         for type in Scan._scan_types:
@@ -19,16 +19,17 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
  
+import re
 from django.conf.urls import include, patterns, url
 from django.http import HttpResponseRedirect
-from sqlalchemy import or_
+from sqlalchemy import and_, or_
 from sqlalchemy.sql import asc, desc
 
 from Core.config import Config
 from Core.paconf import PA
-from Core.db import session
+from Core.db import engine, session
 from Core.maps import Galaxy, Planet, Alliance, Intel
-from Arthur.context import menu, render
+from Arthur.context import menu, stream
 from Arthur.loadable import loadable, load
 
 urlpatterns = patterns('Arthur.views.search',
@@ -39,6 +40,10 @@ urlpatterns = patterns('Arthur.views.search',
 @menu("Search")
 @load
 class search(loadable):
+    # Searches the planner expects to match fewer rows than this are counted
+    #  exactly, broader ones use its estimate
+    exact = 1000
+    
     def execute(self, request, user, params=""):
         
         Q = session.query(Planet, Intel.nick, Alliance.name)
@@ -50,6 +55,7 @@ class search(loadable):
         query = False
         
         page = 1
+        after = None
         
         search = {
                     "ruler" : "", "planet" : "", "galaxy" : "", "nick" : "", "alliance" : "",
@@ -286,6 +292,9 @@ class search(loadable):
             
             elif arg == "page" and val.isdigit():
                 page = int(val)
+            
+            elif arg == "after":
+                after = val
         
         if len(orders) < 1:
             orders.append((desc, "score",))
@@ -295,26 +304,89 @@ class search(loadable):
         search["order1o"] = orders[0][0].__name__
         search["order2"] = orders[1][1]
         search["order2o"] = orders[1][0].__name__
+        
+        # The columns to order by, then coords to keep the order stable
+        keys = []
         for d, os in orders:
             if type(order[os]) is tuple:
-                for o in order[os]:
-                    Q = Q.order_by(d(o))
+                keys += [(d, o,) for o in order[os]]
             else:
-                Q = Q.order_by(d(order[os]))
+                keys.append((d, order[os],))
+        keys += [(asc, Planet.x,), (asc, Planet.y,), (asc, Planet.z,)]
         
         showsort = True if search["order1"] not in ("xyz","size","value","score","ratio","xp",
                                                     "size_growth","value_growth","score_growth",
                                                     "size_growth_pc","value_growth_pc","score_growth_pc",) else False
         
-        count = Q.count()
+        count, estimated = self.count(Q) if query else (0, False,)
         pages = count/50 + int(count%50 > 0)
         pages = range(1, 1+pages)
         
+        for d, o in keys:
+            Q = Q.order_by(d(o))
+        Q = Q.add_columns(*[o for d, o in keys])
+        
+        # Continue from the last row of the previous page where we can,
+        #  rather than skipping over every row before it
         offset = (page - 1)*50
-        Q = Q.limit(50).offset(offset)
+        key = self.decode(after, len(keys)) if after else None
+        if key is not None:
+            Q = Q.filter(self.seek(keys, key))
+        else:
+            Q = Q.offset(offset)
+        Q = Q.limit(50)
         
-        results = Q.all() if query else None
+        rows = Q.all() if query else []
+        results = [row[:3] for row in rows] if query else None
+        after = self.encode(rows[-1][3:]) if len(rows) == 50 else ""
         
-        return render("search.tpl", request, planets=results, sort=search["order1"],
+        params = "/".join([param for param in params.split("/") if param.partition(":")[0].lower() not in ("page", "after",)])
+        
+        return stream("search.tpl", request, planets=results, sort=search["order1"],
                                 showsort=showsort, s=search, params=params,
-                                offset=offset, pages=pages, page=page)
+                                offset=offset, pages=pages, page=page,
+                                count=count, estimated=estimated, after=after)
+    
+    def count(self, Q):
+        # Use the planner's estimate of the rows matched, from the table
+        #  statistics and indexes, and only count small results exactly
+        statement = Q.statement.compile(dialect=engine.dialect)
+        plan = session.connection().execute("EXPLAIN " + unicode(statement), statement.params).fetchone()[0]
+        m = re.search(r"rows=(\d+)", plan)
+        if m and int(m.group(1)) >= self.exact:
+            return int(m.group(1)), True
+        return Q.count(), False
+    
+    def seek(self, keys, key):
+        # Rows after key in the order of keys, with NULLs sorting as
+        #  PostgreSQL sorts them: last when ascending, first when descending
+        clauses = []
+        for i, ((d, o), value) in enumerate(zip(keys, key)):
+            if d is asc and value is None:
+                continue
+            elif d is asc:
+                after = or_(o > value, o == None)
+            elif value is None:
+                after = o != None
+            else:
+                after = o < value
+            clauses.append(and_(*[c == v for (x, c), v in zip(keys[:i], key[:i])] + [after]))
+        return or_(*clauses)
+    
+    def encode(self, key):
+        return ",".join(["~" if v is None else repr(v) if type(v) is float else str(v) for v in key])
+    
+    def decode(self, after, length):
+        key = []
+        for v in after.split(","):
+            if v == "~":
+                key.append(None)
+                continue
+            try:
+                key.append(int(v))
+            except ValueError:
+                try:
+                    key.append(float(v))
+                except ValueError:
+                    return None
+        return key if len(key) == length else None
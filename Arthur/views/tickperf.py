@@ -0,0 +1,49 @@
+# This file is part of Merlin/Arthur.
+# Merlin/Arthur is the Copyright (C)2009,2010 of Elliot Rosemarine.
+
+# Individual portions may be copyright by individual contributors, and
+# are included in this collective work with permission of the copyright
+# owners.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+ 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+ 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+from django.conf.urls import patterns, url
+from sqlalchemy.sql import desc, func
+
+from Core.config import Config
+from Core.db import session
+from Core.maps import TickTiming
+from Arthur.context import menu, render
+from Arthur.loadable import loadable, load
+bot = Config.get("Connection","nick")
+
+urlpatterns = patterns('Arthur.views.tickperf',
+    url(r'^tickperf/$', 'tickperf', name="tickperf"),
+    url(r'^tickperf/(?P<ticks>\d+)/$', 'tickperf', name="tickperfn"),
+)
+
+@menu(bot, "Tick Timings")
+@load
+class tickperf(loadable):
+    access = "admin"
+    def execute(self, request, user, ticks="24"):
+        ticks = int(ticks)
+        
+        tick, stages = TickTiming.stages(ticks)
+        
+        Q = session.query(TickTiming.tick, func.sum(TickTiming.seconds))
+        Q = Q.group_by(TickTiming.tick)
+        Q = Q.order_by(desc(TickTiming.tick))
+        
+        return render("tickperf.tpl", request, tick=tick, ticks=ticks, stages=stages, totals=Q[:ticks])
@@ -0,0 +1,112 @@
+# This file is part of Merlin.
+# Merlin is the Copyright (C)2008,2009,2010 of Robin K. Hansen, Elliot Rosemarine, Andreas Jacobsen.
+
+# Individual portions may be copyright by individual contributors, and
+# are included in this collective work with permission of the copyright
+# owners.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+# Audit log writer
+#   Command and PageView rows are buffered in memory and written in bulk
+#   by a background thread, so logging a command or a page view doesn't
+#   put a database round trip on the reply path.
+
+import atexit
+import threading
+import time
+
+from Core.config import Config
+from Core.string import errorlog
+from Core.db import engine
+
+class auditlog(object):
+    # Flush every this many rows, or this many seconds
+    rows = Config.getint("Misc", "auditrows") if Config.has_option("Misc", "auditrows") else 50
+    delay = Config.getint("Misc", "auditdelay") if Config.has_option("Misc", "auditdelay") else 10
+    # Rows beyond this are dropped rather than held in memory
+    maxsize = Config.getint("Misc", "auditbuffer") if Config.has_option("Misc", "auditbuffer") else 5000
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.writing = threading.Lock()
+        self.buffer = []
+        self.thread = None
+        self.stopping = False
+        self.written = 0
+        self.flushes = 0
+        self.dropped = 0
+        atexit.register(self.shutdown)
+
+    def add(self, table, **row):
+        # Queue a row for the table of a mapped class
+        #  Callers set the time column themselves, as the row
+        #  may not be written until some seconds later
+        with self.lock:
+            if len(self.buffer) >= self.maxsize:
+                self.dropped += 1
+                return
+            self.buffer.append((table.__table__, row,))
+            if self.thread is None or not self.thread.is_alive():
+                self.stopping = False
+                self.thread = threading.Thread(target=self.run, name="auditlog")
+                self.thread.daemon = True
+                self.thread.start()
+            if len(self.buffer) >= self.rows:
+                self.lock.notify()
+
+    def run(self):
+        # Writer loop
+        while True:
+            with self.lock:
+                if len(self.buffer) < self.rows and not self.stopping:
+                    self.lock.wait(self.delay)
+                stopping = self.stopping
+            self.flush()
+            if stopping:
+                break
+
+    def flush(self):
+        # Write everything buffered so far, one insert per table
+        with self.writing:
+            with self.lock:
+                buffer, self.buffer = self.buffer, []
+            tables = {}
+            for table, row in buffer:
+                tables.setdefault(table, []).append(row)
+            for table, rows in tables.items():
+                try:
+                    engine.execute(table.insert(), rows)
+                except Exception, e:
+                    self.dropped += len(rows)
+                    errorlog("%s - Audit log error, dropped %s %s rows: %s\n" % (time.asctime(),len(rows),table.name,str(e),))
+                else:
+                    self.written += len(rows)
+                    self.flushes += 1
+
+    def shutdown(self):
+        # Stop the writer and flush anything left, before a reload or exit
+        with self.lock:
+            self.stopping = True
+            self.lock.notify()
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            thread.join(30)
+        self.flush()
+
+    def stats(self):
+        return "Audit log: %s rows waiting, %s written in %s inserts, %s dropped" % (len(self.buffer), self.written, self.flushes, self.dropped,)
+
+AuditLog = auditlog()
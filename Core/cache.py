@@ -0,0 +1,176 @@
+# This file is part of Merlin.
+# Merlin is the Copyright (C)2008,2009,2010 of Robin K. Hansen, Elliot Rosemarine, Andreas Jacobsen.
+
+# Individual portions may be copyright by individual contributors, and
+# are included in this collective work with permission of the copyright
+# owners.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+# Object cache
+#   Keeps detached copies of rows that rarely change, like users and
+#   channels, and merges them into the current session without a query.
+#   Entries expire after a while, and the whole cache is cleared when any
+#   row of its class is inserted, updated or deleted through the ORM, such
+#   as by !adduser, !edituser, !pref or !remchan.
+# Tick cache
+#   Keeps query results that only change when a tick is processed, such as
+#   the rankings, keyed on the tick they were loaded at. Everything from
+#   older ticks is dropped as soon as excalibur commits the next one.
+
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import event
+from sqlalchemy.orm.attributes import instance_state
+
+from Core.config import Config
+from Core.db import Session, session
+
+def attach(obj):
+    # Attach a cached copy of an object to the current session
+    #  If the session already has the object, that's used as it is, as
+    #  merging into it would overwrite any changes not yet committed
+    key = instance_state(obj).key
+    if key is not None:
+        current = session.identity_map.get(key)
+        if current is not None:
+            return current
+    return session.merge(obj, load=False)
+
+class cache(object):
+    ttl = Config.getint("Misc", "cachettl") if Config.has_option("Misc", "cachettl") else 300
+    size = Config.getint("Misc", "cachesize") if Config.has_option("Misc", "cachesize") else 500
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.pending = False
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        # Return the object for key, attached to the current session
+        #  On a miss, load(session) is called with a private session
+        key = key.lower()
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] > now:
+                # Move it to the end, the least recently used go first
+                self.entries[key] = entry
+                self.hits += 1
+                return self.attach(entry[1])
+            self.misses += 1
+            generation = self.generation
+
+        private = Session()
+        try:
+            obj = load(private)
+        finally:
+            # Closing detaches the object with everything it loaded
+            private.close()
+
+        with self.lock:
+            # Don't keep it if the cache was cleared while it was loading
+            if generation == self.generation:
+                self.entries[key] = (now + self.ttl, obj,)
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return self.attach(obj)
+
+    def attach(self, obj):
+        if obj is None:
+            return None
+        return attach(obj)
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def listen(self, cls):
+        # Clear the cache when any row of the class is changed, and again
+        #  once the change is committed in case it was loaded in between
+        for name in ("after_insert", "after_update", "after_delete",):
+            event.listen(cls, name, self.changed)
+        event.listen(Session, "after_commit", self.committed)
+
+    def changed(self, mapper, connection, target):
+        self.pending = True
+        self.invalidate()
+
+    def committed(self, session):
+        if self.pending:
+            self.pending = False
+            self.invalidate()
+
+    def stats(self):
+        return "%s cache: %s entries, %s hits, %s misses" % (self.name, len(self.entries), self.hits, self.misses,)
+
+class tickcache(object):
+    size = Config.getint("Misc", "tickcachesize") if Config.has_option("Misc", "tickcachesize") else 200
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.tick = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tick, key, load):
+        # Return load(session)'s result for key at tick, with any mapped
+        #  objects in it attached to the current session
+        with self.lock:
+            if tick != self.tick:
+                # A new tick, nothing we have is current
+                self.entries.clear()
+                self.tick = tick
+            result = self.entries.pop(key, None)
+            if result is not None:
+                self.entries[key] = result
+                self.hits += 1
+                return self.attach(result)
+            self.misses += 1
+
+        private = Session()
+        try:
+            result = load(private)
+        finally:
+            private.close()
+
+        with self.lock:
+            if tick == self.tick:
+                self.entries[key] = result
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return self.attach(result)
+
+    def attach(self, result):
+        # Merge the objects in a result into the current session, keeping
+        #  lists, tuples and dicts as they are
+        if isinstance(result, (list, tuple,)):
+            return type(result)([self.attach(item) for item in result])
+        if isinstance(result, dict):
+            return dict([(key, self.attach(value),) for key, value in result.items()])
+        if hasattr(result, "_sa_instance_state"):
+            return attach(result)
+        return result
+
+    def stats(self):
+        return "%s cache: %s entries for tick %s, %s hits, %s misses" % (self.name, len(self.entries), self.tick, self.hits, self.misses,)
@@ -21,11 +21,15 @@
  
 # This module handles callbacks
 
+import ast
 import os
+import re
 import socket
 import sys
 import time
-from Core.exceptions_ import MerlinSystemCall
+from threading import RLock
+from Core.exceptions_ import MerlinSystemCall, ParseError
+from Core.config import Config
 from Core.loader import Loader
 from Core.string import errorlog
 from Core.db import session
@@ -33,14 +37,29 @@ from Core.loadable import loadable
 
 class callbacks(object):
     use_init_all = True
+    # Only import modules of plain commands when they're first used
+    use_lazy = Config.getboolean("Misc", "lazyhooks") if Config.has_option("Misc", "lazyhooks") else True
     # Modules/Callbacks/Hooks controller
     modules = []
     callbacks = {}
+    commands = {}
+    catchalls = {}
     robocops = {}
+    wordre = re.compile(r"^\w+$")
+    # Manifest of the hooks not imported yet
+    # {event: {name: module}}, {name: module} for RoboCop
+    #  and {module: modification time}
+    lazy = {}
+    lazycops = {}
+    manifests = {}
+    # Time taken to import and hook in each module
+    timings = {}
+    lock = RLock()
     
     def init(self):
         # Load in everything in /Hooks/
         self.load_package("Hooks")
+        print "%s %s" % (time.asctime(), self.report(),)
         # Tell the Loader to back up the modules we've used
         # The backup call is currently done in Loader._reload() for
         #  better transactional safety, despite this being more elegant.
@@ -49,6 +68,9 @@ class callbacks(object):
     def load_package(self, path):
         if self.use_init_all:
         # Using __init__'s __all__ to detect module list
+            # Modules of plain commands are indexed now and imported later
+            if self.use_lazy and self.manifest(path):
+                return
             # Load the current module/package
             package = self.load_module(path)
             if "__all__" in dir(package):
@@ -76,16 +98,126 @@ class callbacks(object):
     def load_module(self, mod):
         # Keep a list of all modules imported so Loader can back them up
         self.modules.append(mod)
+        start = time.time()
         Loader.load_module(mod)
+        self.timings[mod] = time.time() - start
         return sys.modules[mod]
     
     def hook_module(self, mod):
+        start = time.time()
         for object in dir(mod):
             # Iterate over objects in the module
             callback = getattr(mod, object)
             if isinstance(callback, type) and issubclass(callback, loadable) and (callback is not loadable):
                 # loadable.loadable
                 self.add_callback(callback.trigger, callback(),)
+        self.timings[mod.__name__] = self.timings.get(mod.__name__, 0) + time.time() - start
+    
+    def manifest(self, mod):
+        # Index the commands of a hook module from its source without
+        #  importing it. Only modules made of plain loadable classes can
+        #  wait, anything else (system hooks, other triggers, aliases that
+        #  aren't words) returns False to be imported now.
+        path = mod.replace(".", os.sep) + ".py"
+        if mod in sys.modules or not os.path.isfile(path):
+            # Already in use, keep it loaded through reloads
+            return False
+        try:
+            with open(path) as source:
+                tree = ast.parse(source.read(), path)
+        except SyntaxError:
+            # Let the import report it
+            return False
+        
+        hooks, classes, loadables = [], ["object", "loadable"], ["loadable"]
+        for node in tree.body:
+            if isinstance(node, ast.If):
+                # Optional imports
+                if not all([isinstance(item, (ast.Import, ast.ImportFrom,)) for item in node.body + node.orelse]):
+                    return False
+                continue
+            if isinstance(node, ast.FunctionDef) and node.decorator_list:
+                # system hooks
+                return False
+            if not isinstance(node, (ast.Import, ast.ImportFrom, ast.Assign, ast.Expr, ast.FunctionDef, ast.ClassDef,)):
+                # Anything else may be setting something up
+                return False
+            if not isinstance(node, ast.ClassDef):
+                continue
+            bases = [base.id for base in node.bases if isinstance(base, ast.Name)]
+            if len(bases) < len(node.bases) or not set(bases) <= set(classes):
+                # Might be a hook inheriting from another module
+                return False
+            classes.append(node.name)
+            if not set(bases) & set(loadables):
+                continue
+            loadables.append(node.name)
+            names, robocop = [node.name], False
+            for item in node.body:
+                if isinstance(item, ast.FunctionDef) and item.name == "robocop":
+                    robocop = True
+                if not isinstance(item, ast.Assign):
+                    continue
+                targets = [target.id for target in item.targets if isinstance(target, ast.Name)]
+                if "trigger" in targets or "catchall" in targets:
+                    return False
+                if "alias" in targets:
+                    if isinstance(item.value, ast.Str):
+                        names += item.value.s.split("|")
+                    elif not (isinstance(item.value, ast.Name) and item.value.id == "None"):
+                        return False
+            if not all(map(self.wordre.match, names)):
+                return False
+            hooks.append((names, robocop,))
+        if len(hooks) == 0:
+            return False
+        
+        for names, robocop in hooks:
+            for name in names:
+                self.lazy.setdefault(loadable.trigger, {})[name.lower()] = mod
+            if robocop:
+                self.lazycops[names[0]] = mod
+        self.manifests[mod] = os.path.getmtime(path)
+        return True
+    
+    def wake(self, mod):
+        # Import a module from the manifest and hook it in
+        with self.lock:
+            if mod not in self.manifests:
+                # Another thread got here first
+                return
+            module = self.load_module(mod)
+            self.hook_module(module)
+            del self.manifests[mod]
+            for names in self.lazy.values():
+                for name in [name for name, module in names.items() if module == mod]:
+                    del names[name]
+            for name in [name for name, module in self.lazycops.items() if module == mod]:
+                del self.lazycops[name]
+            # Back it up so it can be restored and reloaded like the others
+            Loader.backup(mod)
+            print "%s Loaded %s on first use in %.3f seconds" % (time.asctime(), mod, self.timings[mod],)
+    
+    def wake_all(self):
+        # Import everything left in the manifest
+        for mod in self.manifests.keys():
+            self.wake(mod)
+    
+    def stale(self):
+        # Whether any module still waiting in the manifest has been changed
+        for mod, mtime in self.manifests.items():
+            path = mod.replace(".", os.sep) + ".py"
+            if not os.path.isfile(path) or os.path.getmtime(path) != mtime:
+                return True
+        return False
+    
+    def report(self):
+        # Startup time of each module, slowest first
+        slowest = sorted(self.timings.items(), key=lambda t: t[1], reverse=True)
+        reply = "Loaded %s hook modules in %.2f seconds, %s more on first use." % (len(self.timings), sum(self.timings.values()), len(self.manifests),)
+        if len(slowest) > 0:
+            reply += " Slowest: " + ", ".join(["%s %.3fs" % timing for timing in slowest[:10]])
+        return reply
     
     def add_callback(self, event, callback):
         # Add the callback to the dictionary of callbacks
@@ -95,34 +227,73 @@ class callbacks(object):
         else:
             self.callbacks[event] = [callback,]
         
+        # Index the callback by its command name and aliases
+        # {event: {name: [(position, callback),..]}}
+        # Anything that isn't triggered by a plain command word
+        #  has to see every line for the event instead
+        # {event: [(position, callback),..]}
+        entry = (len(self.callbacks[event]), callback,)
+        names = [callback.name] + (callback.alias.split("|") if callback.alias else [])
+        if callback.catchall or not all(map(self.wordre.match, names)):
+            self.catchalls.setdefault(event, []).append(entry)
+        else:
+            for name in names:
+                self.commands.setdefault(event, {}).setdefault(name.lower(), []).append(entry)
+        
         # Store the callback again for RoboCop if
         #  it has an executable robocop method
         if callable(callback.robocop):
             self.robocops[callback.name] = callback
     
+    def lookup(self, message):
+        # Find the callbacks that could want this message, in the order
+        #  they were hooked in: the catch-alls, the command named by the
+        #  first word and, for help, the command named by the second
+        event = message.get_command()
+        callbacks = self.catchalls.get(event, [])
+        try:
+            words = message.get_msg()[1:].split(None, 2) if (self.commands.get(event) or self.lazy.get(event)) and message.get_prefix() else []
+        except ParseError:
+            words = []
+        # The command, and the command asked about for help
+        words = [word.lower() for word in words[:2]]
+        if len(words) > 1 and (words[0] != "help" or words[1] == "help"):
+            # Only once for !help help
+            del words[1]
+        if len(words) > 0:
+            for word in words:
+                # Import the command from the manifest if it's waiting there
+                if self.lazy.get(event, {}).has_key(word):
+                    self.wake(self.lazy[event][word])
+            commands = self.commands.get(event, {})
+            for word in words:
+                callbacks = callbacks + commands.get(word, [])
+            callbacks.sort()
+        return [callback for position, callback in callbacks]
+    
     def callback(self, message):
         # Call back a hooked module
-        event = message.get_command()
-        # Check we have some callbacks stored for this event,
-        if self.callbacks.has_key(event):
-            # cycle through them
-            for callback in self.callbacks[event]:
-                # and call each one, passing in the message
-                try:
-                    callback(message)
-                except (MerlinSystemCall, socket.error):
-                    raise
-                except Exception, e:
-                    # Error while executing a callback/mod/hook
-                    message.alert("Error in module '%s'. Please report the command you used to the bot owner as soon as possible." % (callback.name,))
-                    errorlog("%s - IRC Callback Error: %s\n%s\n" % (time.asctime(),str(e),message,))
-                finally:
-                    # Remove any uncommitted or unrolled-back state
-                    session.remove()
+        # Cycle through the callbacks that could want this line
+        for callback in self.lookup(message):
+            # and call each one, passing in the message
+            try:
+                callback(message)
+            except (MerlinSystemCall, socket.error):
+                raise
+            except Exception, e:
+                # Error while executing a callback/mod/hook
+                message.alert("Error in module '%s'. Please report the command you used to the bot owner as soon as possible." % (callback.name,))
+                errorlog("%s - IRC Callback Error: %s\n%s\n" % (time.asctime(),str(e),message,))
+            finally:
+                # Remove any uncommitted or unrolled-back state
+                session.remove()
     
     def robocop(self, message):
         # Call back a hooked robocop module
         command = message.get_command()
+        # Import the command from the manifest if it's waiting there
+        if self.lazycops.has_key(command):
+            self.wake(self.lazycops[command])
         # Check we have a callback stored for this command,
         if self.robocops.has_key(command):
             callback = self.robocops[command]
@@ -24,8 +24,9 @@
 import re
 import socket
 import time
-from Queue import PriorityQueue, Empty
-from threading import Thread
+from collections import deque
+from heapq import heappush, heappop
+from threading import Thread, Condition
 
 from Core.exceptions_ import Reboot
 from Core.config import Config
@@ -34,16 +35,31 @@ from Core.admintools import admin_msg
 
 class connection(object):
     # Socket/Connection handler
-    output = PriorityQueue()
     queue_warned = 0
     wait_warned = 0
     quitting = False
+    # Lines to the same target are joined up to this length when backed up
+    coalesce = 450
     
     def __init__(self):
         # Socket to handle is provided
         self.ping = re.compile(r"PING\s*:\s*(\S+)", re.I)
         self.pong = re.compile(r"PONG\s*:", re.I)
+        self.targetre = re.compile(r"(C?(?:PRIVMSG|NOTICE)\s+(\S+)\s+(?:[^:\s]\S*\s+)?:)", re.I)
         self.last = time.time()
+        # Output queue
+        # {target: [(priority, queued, line),..]} as heaps, and when
+        #  each target was last sent to, for round-robin between them
+        self.lock = Condition()
+        self.targets = {}
+        self.served = {}
+        self.queued = 0
+        self.waits = deque(maxlen=1000)
+        # Token bucket, a line costs one token and a token is earned every
+        #  antiflood seconds, up to the burst the server will accept
+        self.burst = Config.getfloat("Connection", "antiburst") if Config.has_option("Connection", "antiburst") else 5.0
+        self.tokens = self.burst
+        self.stamp = time.time()
         self.thread = Thread(target=self.writeout)
         self.thread.start()
     
@@ -66,6 +82,11 @@ class connection(object):
         return self.sock
     
     def attach(self, sock=None, nick=None):
+        # Restart the output thread if we disconnected without being reloaded
+        if not self.thread.is_alive():
+            self.quitting = False
+            self.thread = Thread(target=self.writeout)
+            self.thread.start()
         # Attach the socket
         nick = nick or Config.get("Connection", "nick")
         try:
@@ -93,41 +114,113 @@ class connection(object):
         return ()
     
     def write(self, line, priority=10):
-        # Write to output queue
-        self.output.put((priority, time.time(), line))
+        # Write to the output queue of the line's target
+        match = self.targetre.match(line)
+        target = match.group(2).lower() if match else ""
+        with self.lock:
+            heappush(self.targets.setdefault(target, []), (priority, time.time(), line,))
+            self.queued += 1
+            queued = self.queued
+            self.lock.notify()
         # Warn admins if the queue is too long
-        if self.output.qsize() > Config.getint("Connection", "maxqueue"):
+        if queued > Config.getint("Connection", "maxqueue"):
             if time.time() > self.queue_warned + 300:
                 self.queue_warned = time.time()
-                admin_msg("Message output queue length is too long: %s messages" % self.output.qsize())
-
+                admin_msg("Message output queue length is too long: %s messages" % (queued,))
+    
+    def cost(self, line, priority):
+        # Long lines and low priority lines are spaced out further
+        return 1 + (len(line) > 300) + (priority > 10)
+    
+    def refill(self):
+        # Earn the tokens for the time since the last refill
+        antiflood = Config.getfloat("Connection", "antiflood")
+        now = time.time()
+        if antiflood > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) / antiflood)
+        else:
+            self.tokens = self.burst
+        self.stamp = now
+        return antiflood
+    
+    def head(self):
+        # The target with the most urgent line, going round the targets
+        #  in turn when several are waiting at the same priority
+        return min(self.targets, key=lambda target: (self.targets[target][0][0], self.served.get(target, 0),))
+    
+    def take(self, target):
+        # Take the next line for the target, joining on any more lines
+        #  for it that are waiting at the same priority
+        queue = self.targets[target]
+        priority, queued, line = heappop(queue)
+        waits = [time.time() - queued]
+        match = self.targetre.match(line)
+        # Services (the NoColor nicks) need their commands one per line
+        if match and not Config.has_option("NoColor", match.group(2)):
+            header = match.group(1)
+            while len(queue) > 0 and queue[0][0] == priority and queue[0][2].startswith(header):
+                text = queue[0][2][len(header):]
+                if len(line) + len(text) + 3 > self.coalesce:
+                    break
+                line += " | " + text
+                waits.append(time.time() - heappop(queue)[1])
+        if len(queue) == 0:
+            del self.targets[target]
+        self.served[target] = time.time()
+        if len(self.served) > 1000:
+            for old in sorted(self.served, key=self.served.get)[:500]:
+                if old not in self.targets:
+                    del self.served[old]
+        self.queued -= len(waits)
+        self.waits.extend(waits)
+        return priority, queued, line
+    
     def writeout(self):
         # Write to socket/server
         while True:
-            try:
-                (priority, sent, line) = self.output.get(True, 1)
-            except Empty:
-                if self.quitting:
-                    break
-                else:
+            with self.lock:
+                if len(self.targets) == 0:
+                    if self.quitting:
+                        break
+                    self.lock.wait(1)
+                    continue
+                # Wait for enough tokens to send the next line, new
+                #  lines will wake us to be considered or joined on
+                antiflood = self.refill()
+                target = self.head()
+                priority, queued, line = self.targets[target][0]
+                short = min(self.cost(line, priority), self.burst) - self.tokens
+                if short > 0:
+                    self.lock.wait(short * antiflood)
                     continue
+                priority, queued, line = self.take(target)
+                self.tokens -= self.cost(line, priority)
             try:
-                while self.last + Config.getfloat("Connection", "antiflood") * (1 + (len(line) > 300) + (priority > 10)) >= time.time():
-                    time.sleep(0.5)
                 # Warn admins if the wait is too long
-                if priority < 10 and time.time() > sent + Config.getint("Connection", "maxdelay"):
+                if priority < 10 and time.time() > queued + Config.getint("Connection", "maxdelay"):
                     if time.time() > self.wait_warned + 300:
                         self.wait_warned = time.time()
-                        admin_msg("Message output message delay is too long: %.1f seconds" % (time.time() - sent))
+                        admin_msg("Message output message delay is too long: %.1f seconds. %s" % (time.time() - queued, self.stats(),))
                 self.sock.send(encode(line) + CRLF)
                 self.last = time.time()
                 print "%s >>> %s" % (time.asctime(),encode(line),)
-                self.output.task_done()
                 if line[:4].upper() == "QUIT":
                     break
             except socket.error as exc:
                 raise Reboot(exc)
     
+    def stats(self):
+        # Report the output queue and the time recent lines spent in it
+        with self.lock:
+            queued = self.queued
+            targets = len(self.targets)
+            waits = sorted(self.waits)
+        reply = "Output queue: %s lines for %s targets." % (queued, targets,)
+        if len(waits) > 0:
+            percentile = lambda p: waits[min(int(len(waits) * p), len(waits) - 1)]
+            reply += " Wait over the last %s lines: 50%% %.1fs, 90%% %.1fs, 99%% %.1fs, max %.1fs" % (len(waits), percentile(0.5), percentile(0.9), percentile(0.99), waits[-1],)
+        return reply
+    
     def read(self):
         # Read from socket
         try:
@@ -0,0 +1,214 @@
+# This file is part of Merlin.
+# Merlin is the Copyright (C)2008,2009,2010 of Robin K. Hansen, Elliot Rosemarine, Andreas Jacobsen.
+
+# Individual portions may be copyright by individual contributors, and
+# are included in this collective work with permission of the copyright
+# owners.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+# Command executor
+#   Callbacks are run on a pool of worker threads so the Router can keep
+#   reading the sockets (and answering PINGs) while a hook is busy.
+#   Lines sharing a lane (the same user in the same channel, or the same
+#   RoboCop client) are run one at a time in the order they arrived.
+
+import os
+import threading
+import time
+from collections import deque
+
+from Core.exceptions_ import MerlinSystemCall
+from Core.config import Config
+from Core.string import errorlog
+from Core.db import session
+
+class job(object):
+    # A line waiting to be called back
+    overdue = False
+    started = None
+
+    def __init__(self, message, call, lane, done=None):
+        self.message = message
+        self.call = call
+        self.lane = lane
+        self.done = done
+        self.queued = time.time()
+
+class executor(object):
+    # Worker pool controller
+    workers = Config.getint("Misc", "cmdworkers") if Config.has_option("Misc", "cmdworkers") else 8
+    maxqueue = Config.getint("Misc", "cmdqueue") if Config.has_option("Misc", "cmdqueue") else 100
+    timeout = Config.getint("Misc", "cmdtimeout") if Config.has_option("Misc", "cmdtimeout") else 60
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.pipe = None
+        self.threads = []
+        self.running = {}
+        self.ready = deque()
+        self.lanes = {}
+        self.waiting = 0
+        self.calls = []
+        self.stopping = False
+
+    def start(self):
+        # Open the wake-up pipe and start the workers
+        with self.lock:
+            self.stopping = False
+            if self.pipe is None:
+                self.pipe = os.pipe()
+            while len(self.threads) < self.workers:
+                self.spawn()
+
+    def spawn(self):
+        # Add a worker to the pool, the lock must be held
+        thread = threading.Thread(target=self.work, name="executor-%s" % (len(self.threads),))
+        thread.daemon = True
+        self.threads.append(thread)
+        thread.start()
+
+    def submit(self, message, call, lane, done=None):
+        # Queue a line to be called back, behind anything else in its lane
+        #  Returns False if the queue is full and the line was not accepted
+        #  done is called once the line has been dealt with, even if dropped
+        with self.lock:
+            self.watch()
+            if self.waiting >= self.maxqueue:
+                errorlog("%s - Executor queue full (%s waiting), dropped: %s\n" % (time.asctime(),self.waiting,message,), traceback=False)
+                return False
+            task = job(message, call, lane, done)
+            self.waiting += 1
+            if self.lanes.has_key(lane):
+                self.lanes[lane].append(task)
+            else:
+                self.lanes[lane] = deque()
+                self.ready.append(task)
+                self.lock.notify()
+            return True
+
+    def advance(self, lane):
+        # Release the next line in a lane, the lock must be held
+        if len(self.lanes[lane]) > 0:
+            self.ready.append(self.lanes[lane].popleft())
+            self.lock.notify()
+        else:
+            del self.lanes[lane]
+
+    def watch(self):
+        # Release the lanes of any callbacks that have overrun the timeout
+        #  and replace their workers, the lock must be held
+        now = time.time()
+        for thread, task in self.running.items():
+            if task.overdue or task.started + self.timeout > now:
+                continue
+            task.overdue = True
+            errorlog("%s - Executor timeout after %ss: %s\n" % (time.asctime(),self.timeout,task.message,), traceback=False)
+            self.advance(task.lane)
+            if len(self.threads) < self.workers * 2:
+                self.spawn()
+
+    def work(self):
+        # Worker loop
+        thread = threading.current_thread()
+        while True:
+            with self.lock:
+                while len(self.ready) == 0 and not self.stopping:
+                    self.lock.wait(1)
+                    self.watch()
+                if self.stopping:
+                    break
+                task = self.ready.popleft()
+                self.waiting -= 1
+                task.started = time.time()
+                self.running[thread] = task
+
+            if task.started > task.queued + self.timeout:
+                # Waited too long behind other lines to still be wanted
+                errorlog("%s - Executor dropped line after %.1fs in queue: %s\n" % (time.asctime(),task.started - task.queued,task.message,), traceback=False)
+            else:
+                self.execute(task)
+
+            if task.done is not None:
+                task.done()
+
+            with self.lock:
+                del self.running[thread]
+                if not task.overdue:
+                    self.advance(task.lane)
+                # A replacement was started if this worker overran
+                if len(self.threads) > self.workers:
+                    break
+
+        with self.lock:
+            if thread in self.threads:
+                self.threads.remove(thread)
+
+    def execute(self, task):
+        try:
+            task.call(task.message)
+        except MerlinSystemCall, e:
+            # Hand system calls back to the Router's thread
+            with self.lock:
+                self.calls.append((task.message, e,))
+                if self.pipe is not None:
+                    os.write(self.pipe[1], "!")
+        except Exception, e:
+            print "%s Routing error logged." % (time.asctime(),)
+            errorlog("%s - Routing Error: %s\n%s\n" % (time.asctime(),str(e),task.message,))
+        finally:
+            # Remove any uncommitted or unrolled-back state
+            session.remove()
+
+    def wake(self):
+        # Wake the Router, so it can pass on lines that were held back
+        with self.lock:
+            if self.pipe is not None:
+                os.write(self.pipe[1], "!")
+
+    def read(self):
+        # Return the first system call made by a hook, if any
+        os.read(self.pipe[0], 512)
+        with self.lock:
+            if len(self.calls) > 0:
+                return self.calls.pop(0)
+        return None, None
+
+    def shutdown(self):
+        # Stop the workers, giving running callbacks a chance to finish
+        with self.lock:
+            self.stopping = True
+            self.lock.notify_all()
+            threads = self.threads[:]
+            dropped = self.waiting
+        deadline = time.time() + self.timeout
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+        with self.lock:
+            if dropped:
+                errorlog("%s - Executor shutdown, dropped %s queued lines\n" % (time.asctime(),dropped,), traceback=False)
+            self.ready.clear()
+            self.lanes.clear()
+            self.waiting = 0
+            self.calls = []
+            if self.pipe is not None:
+                map(os.close, self.pipe)
+                self.pipe = None
+
+    def fileno(self):
+        # Return act like a file
+        return self.pipe[0]
+
+Executor = executor()
@@ -0,0 +1,425 @@
+# This file is part of Merlin/Arthur.
+# Merlin/Arthur is the Copyright (C)2011 of Elliot Rosemarine.
+
+# Individual portions may be copyright by individual contributors, and
+# are included in this collective work with permission of the copyright
+# owners.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+# Graph data and drawing
+#   The history plotted by Arthur's graphs is kept as a file of 64 bit
+#   integers for each planet, galaxy and alliance, one row per tick, and
+#   excalibur appends the new tick's row to each of them. Arthur reads the
+#   file instead of querying the whole history, and falls back to the
+#   database when a file is missing or behind.
+#   Cached graphs are removed for each entity that changed, rather than
+#   clearing the whole cache, and the graphs of our members and targets
+#   are drawn again straight after the tick.
+
+import os
+from itertools import groupby
+from sqlalchemy.sql import asc, func
+from Core.config import Config
+from Core.db import session
+from Core.maps import Galaxy, GalaxyHistory, Planet, PlanetHistory, Alliance, AllianceHistory, Intel, Target
+
+graphing = Config.get("Misc", "graphing") != "disabled"
+caching  = Config.get("Misc", "graphing") == "cached"
+if graphing:
+    import numpy
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+    from matplotlib.ticker import FuncFormatter
+
+# Directory the graph data is kept in, outside of the cache Arthur serves
+datadir = Config.get("Misc", "graphdata") if Config.has_option("Misc", "graphdata") else "graphdata"
+cachedir = "Arthur/graphs"
+# Kept in place of a missing rank or value, which isn't drawn
+missing = -2**63
+
+white   = '#ffffff'
+black   = '#000000'
+red     = '#ff0000'
+green   = '#00ff00'
+blue    = '#0000ff'
+yellow  = '#ffff00'
+magenta = '#ff00ff'
+cyan    = '#00ffff'
+pink    = '#ff6666'
+bgcolor = '#292D3A'
+axcolor = '#373B48'
+
+def num2short(num):
+    prefix = ("","-",)[num<0]
+    num = abs(num)
+    flt2int = lambda x: int(x) if float(x).is_integer() else x
+    if num >= 1000000:
+        return prefix+ str(flt2int(round(num/1000000.0,1)))+"m"
+    elif num >= 1000:
+        return prefix+ str(flt2int(round(num/1000.0,1)))+"k"
+    else:
+        return prefix+ str(flt2int(round(num)))
+
+def rank_axis_format(x, pos):
+    if x == 0:
+        return ""
+    if int(x) < x:
+        return ""
+    return int(x)
+
+class graph(object):
+    # Data and drawing for the graphs of one kind of entity
+    kind = None
+    history = None
+    # The path Arthur links to, and caches the graph at, and the name in its title
+    url = None
+    title = None
+    width = 500
+    left, right = {'values': yellow, 'ranks': yellow}, {'values': green, 'ranks': green}
+
+    # Columns of each row, the tick then three for each type of graph
+    types = {'values' : (0, 1, 2, 3,),
+             'ranks'  : (0, 4, 5, 6,),
+             }
+
+    plot = {'values' : lambda ax, Q: ((ax[1].plot(Q[0],Q[1],yellow)[0],  "Size",),
+                                      (ax[2].plot(Q[0],Q[2],green)[0],   "Score",),
+                                      (ax[2].plot(Q[0],Q[3],magenta)[0], "Value",),
+                                      ),
+            'ranks' :  lambda ax, Q: ((ax[1].plot(Q[0],Q[1],yellow)[0],  "Size",),
+                                      (ax[2].plot(Q[0],Q[2],green)[0],   "Score",),
+                                      (ax[2].plot(Q[0],Q[3],magenta)[0], "Value",),
+                                      ),
+            }
+
+    ax = {'values' : lambda i, Q: [(0,), Q[1], Q[2]][i],
+          'ranks' :  lambda i, Q: [(0,), Q[1], Q[2]][i],
+          }
+
+    def columns(self):
+        h = self.history
+        return (h.tick, h.size, h.score, h.value, h.size_rank, h.score_rank, h.value_rank,)
+
+    def filename(self, id):
+        return os.path.join(datadir, self.kind, str(id))
+
+    ## Data
+
+    def read(self, id):
+        # The rows kept for an entity, or None if there are none
+        try:
+            data = numpy.fromfile(self.filename(id), dtype=numpy.int64)
+        except (IOError, OSError):
+            return None
+        if len(data) == 0 or len(data) % 7:
+            # Empty, or a row was only partly written
+            return None
+        return data.reshape(-1, 7)
+
+    def last(self, id):
+        # The tick of the last row kept for an entity
+        try:
+            with open(self.filename(id), "rb") as file:
+                file.seek(0, os.SEEK_END)
+                size = file.tell()
+                if size == 0 or size % 56:
+                    return None
+                file.seek(-56, os.SEEK_END)
+                return int(numpy.fromfile(file, dtype=numpy.int64, count=1)[0])
+        except (IOError, OSError):
+            return None
+
+    def query(self, ids, tick=None):
+        # History rows for the entities, in order of id and tick
+        Q = session.query(self.history.id, *[func.coalesce(c, missing) for c in self.columns()])
+        Q = Q.filter(self.history.id.in_(ids))
+        if tick is not None:
+            Q = Q.filter(self.history.tick <= tick)
+        Q = Q.order_by(asc(self.history.id), asc(self.history.tick))
+        return Q
+
+    def load(self, o, tick):
+        # The rows for an entity up to tick, from its file if that's
+        #  up to date, otherwise from the database
+        data = self.read(o.id)
+        if data is not None and data[-1,0] == tick:
+            return data
+        data = [row[1:] for row in self.query([o.id], tick)]
+        if len(data) == 0:
+            return None
+        return numpy.array(data, dtype=numpy.int64)
+
+    def write(self, id, data):
+        # Replace the file for an entity
+        path = self.filename(id)
+        with open(path + ".tmp", "wb") as file:
+            numpy.asarray(data, dtype=numpy.int64).tofile(file)
+        os.rename(path + ".tmp", path)
+
+    def append(self, tick):
+        # Add the tick's rows to the files, and rebuild the files that are
+        #  missing or behind, returning the ids that were updated
+        dir = os.path.join(datadir, self.kind)
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+
+        Q = session.query(self.history.id, *[func.coalesce(c, missing) for c in self.columns()])
+        Q = Q.filter(self.history.tick == tick)
+
+        updated, rebuild = [], []
+        for row in Q:
+            id = row[0]
+            last = self.last(id)
+            if last == tick:
+                continue
+            if last != tick - 1:
+                rebuild.append(id)
+                continue
+            with open(self.filename(id), "ab") as file:
+                numpy.array(row[1:], dtype=numpy.int64).tofile(file)
+            updated.append(id)
+
+        # One query for everything that has to be rebuilt
+        for i in range(0, len(rebuild), 1000):
+            for id, rows in groupby(self.query(rebuild[i:i+1000], tick), lambda row: row[0]):
+                self.write(id, [row[1:] for row in rows])
+                updated.append(id)
+
+        return updated
+
+    ## Drawing
+
+    def draw(self, type, o, data):
+        # Draw the graph of an entity's rows, returns the Figure
+        width = self.width *(8.0/640)
+        height = width *(6.0/8.0)
+        fig = Figure(figsize=(width,height,), facecolor=bgcolor, edgecolor=bgcolor)
+
+        ## Set up the axes
+        fig.subplots_adjust(left=0.08,right=1-0.08,bottom=0.05,top=1-0.075)
+        ax = {}
+
+        ax[0] = fig.add_subplot(111)
+        ax[0].yaxis.set_visible(False)
+        ax[0].set_axis_bgcolor(axcolor)
+
+        ax[1] = fig.add_axes(ax[0].get_position(True), sharex=ax[0], frameon=False)
+        ax[1].yaxis.tick_left()
+        ax[1].yaxis.set_label_position('left')
+        ax[1].xaxis.set_visible(False)
+
+        ax[2] = fig.add_axes(ax[0].get_position(True), sharex=ax[1], frameon=False)
+        ax[2].yaxis.tick_right()
+        ax[2].yaxis.set_label_position('right')
+        ax[2].xaxis.set_visible(False)
+
+        ## Each column of the type, as a whole array, leaving gaps where
+        ## there's no value
+        d = data[:, list(self.types[type])].T
+        d = numpy.where(d == missing, numpy.nan, d)
+
+        ## Plot the data and draw a legend
+        leg = ax[0].legend(*zip(*self.plot[type](ax,d)), loc='upper left',
+                            ncol=len(d)-1, columnspacing=1,
+                            handlelength=0.1, handletextpad=0.5)
+        leg.get_frame().set_facecolor(black)
+        leg.get_frame().set_alpha(0.5)
+        for t in leg.get_texts():
+            t.set_color(white)
+            t.set_fontsize(10)
+
+        ## Sort out the axes
+        ax[0].tick_params(labelcolor=white)
+        ax[1].tick_params(labelcolor=self.left[type])
+        ax[2].tick_params(labelcolor=self.right[type])
+
+        if type == "values":
+            # pretty axis labels
+            ax[1].yaxis.set_major_formatter(FuncFormatter(lambda x,pos:num2short(x)))
+            ax[2].yaxis.set_major_formatter(FuncFormatter(lambda x,pos:num2short(x)))
+        else:
+            ax[1].yaxis.set_major_formatter(FuncFormatter(rank_axis_format))
+            ax[2].yaxis.set_major_formatter(FuncFormatter(rank_axis_format))
+
+        for i in (0,1,2,):
+            # axis scales
+            bottom, top = ax[i].get_ylim()
+            bottom = 0
+            peak = numpy.nanmax(self.ax[type](i,d))
+            if peak >= top:
+                top = peak + 1
+
+            if type == "values":
+                # for values, scale all the way down to 0
+                ax[i].set_ylim(bottom, top)
+            else:
+                # for ranks, invert axes, 0 at the top
+                ax[i].set_ylim(top, bottom)
+
+        ## Fix some odd behaviour
+        ax[0].set_xlim(d[0][0], d[0][-1]) #align first tick to left
+        ax[2].axvline(x=d[0][0], color=black) #fix gfx glitch on left yaxis
+
+        ## Title
+        title = self.title(o) + (" Rank" if type == "ranks" else "") + " History"
+        fig.suptitle(title, color=white, fontsize=18)
+
+        return fig
+
+    def error(self, msg):
+        width = self.width *(8.0/640)
+        fig = Figure(figsize=(width,width *(6.0/8.0),), facecolor=bgcolor, edgecolor=bgcolor)
+        fig.suptitle(msg, color=white)
+        return fig
+
+    def save(self, fig, path):
+        # Write a graph to the cache, replacing any graph already there
+        #  without leaving a partial file for the web server to send
+        dir = os.path.dirname(path)
+        try:
+            if not os.path.exists(dir):
+                os.makedirs(dir)
+            with open(path + ".tmp", "wb") as file:
+                FigureCanvas(fig).print_png(file)
+            os.rename(path + ".tmp", path)
+        except (IOError, OSError):
+            pass
+
+    def cached(self, type, o):
+        # Where the graph is cached, or None for names that would point
+        #  outside the cache, such as alliance names with a / or ..
+        url = self.url(type, o)
+        if not url or url.startswith(".") or "/" in url or os.sep in url:
+            return None
+        return os.path.join(cachedir, type, url)
+
+    def invalidate(self, tick, ids):
+        # Remove the cached graphs of the entities updated at tick
+        paths = []
+        for i in range(0, len(ids), 1000):
+            for o in session.query(self.model).filter(self.model.id.in_(ids[i:i+1000])):
+                paths += [self.cached(type, o) for type in self.types.keys()]
+            paths += self.moved(tick, ids[i:i+1000])
+        paths = [path for path in paths if path is not None]
+        removed = 0
+        for path in paths:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def moved(self, tick, ids):
+        # Cached graphs left at an old location of the entities
+        return []
+
+class planetgraph(graph):
+    kind = "planet"
+    model = Planet
+    history = PlanetHistory
+
+    url = staticmethod(lambda type, o: "%s.%s.%s" %(o.x,o.y,o.z,))
+    title = staticmethod(lambda o: "%s:%s:%s" %(o.x,o.y,o.z,))
+
+    def moved(self, tick, ids):
+        # Planets that moved this tick leave graphs at their old coords
+        Q = session.query(PlanetHistory.x, PlanetHistory.y, PlanetHistory.z)
+        Q = Q.join((Planet, Planet.id == PlanetHistory.id))
+        Q = Q.filter(PlanetHistory.tick == tick - 1)
+        Q = Q.filter(PlanetHistory.id.in_(ids))
+        Q = Q.filter((PlanetHistory.x != Planet.x) | (PlanetHistory.y != Planet.y) | (PlanetHistory.z != Planet.z))
+        return [os.path.join(cachedir, type, "%s.%s.%s" %(x,y,z,)) for x,y,z in Q for type in self.types.keys()]
+
+class galaxygraph(graph):
+    kind = "galaxy"
+    model = Galaxy
+    history = GalaxyHistory
+
+    url = staticmethod(lambda type, o: "%s.%s" %(o.x,o.y,))
+    title = staticmethod(lambda o: "%s:%s" %(o.x,o.y,))
+
+class alliancegraph(graph):
+    kind = "alliance"
+    model = Alliance
+    history = AllianceHistory
+
+    url = staticmethod(lambda type, o: o.name)
+    title = staticmethod(lambda o: "%s" %(o.name,))
+    left, right = {'values': yellow, 'ranks': cyan}, {'values': green, 'ranks': green}
+
+    def columns(self):
+        h = self.history
+        return (h.tick, h.size, h.score, h.members, h.size_rank, h.score_rank, h.points_rank,)
+
+    plot = {'values' : lambda ax, Q: ((ax[1].plot(Q[0],Q[1],yellow)[0],  "Size",),
+                                      (ax[2].plot(Q[0],Q[2],green)[0],   "Score",),
+                                      (ax[0].plot(Q[0],Q[3],pink)[0],    "Members",),
+                                      ),
+            'ranks' :  lambda ax, Q: ((ax[2].plot(Q[0],Q[1],yellow)[0],  "Size",),
+                                      (ax[2].plot(Q[0],Q[2],green)[0],   "Score",),
+                                      (ax[1].plot(Q[0],Q[3],cyan)[0],    "Points",),
+                                      ),
+            }
+
+    ax = {'values' : lambda i, Q: [Q[3], Q[1], Q[2]][i],
+          'ranks' :  lambda i, Q: [(0,), Q[3], Q[2]][i],
+          }
+
+PlanetGraph = planetgraph()
+GalaxyGraph = galaxygraph()
+AllianceGraph = alliancegraph()
+
+def append(tick):
+    # Add the tick to the graph data, returning the ids updated for each graph
+    return [(graph, graph.append(tick),) for graph in (PlanetGraph, GalaxyGraph, AllianceGraph,)]
+
+def invalidate(tick, updated):
+    # Remove the cached graphs of everything that was updated
+    return sum([graph.invalidate(tick, ids) for graph, ids in updated])
+
+def prerender(tick):
+    # Draw the graphs of our members, our targets, their galaxies and our
+    #  alliance, so they're cached before anyone asks for them
+    name = Config.get("Alliance", "name")
+
+    Q = session.query(Planet).join(Planet.intel).join(Intel.alliance)
+    Q = Q.filter(Planet.active == True).filter(Alliance.name.ilike(name))
+    planets = Q.all()
+
+    Q = session.query(Planet).join(Planet.bookings)
+    Q = Q.filter(Planet.active == True).filter(Target.tick >= tick)
+    planets += Q.all()
+
+    planets = dict([(planet.id, planet,) for planet in planets]).values()
+    galaxies = dict([(planet.galaxy.id, planet.galaxy,) for planet in planets]).values()
+    alliance = Alliance.load(name, exact=True)
+
+    drawn = 0
+    for graph, entities in ((PlanetGraph, planets,), (GalaxyGraph, galaxies,), (AllianceGraph, [alliance] if alliance else [],),):
+        for o in entities:
+            data = graph.load(o, tick)
+            if data is None:
+                continue
+            for type in graph.types.keys():
+                path = graph.cached(type, o)
+                if path is None:
+                    continue
+                graph.save(graph.draw(type, o, data), path)
+                drawn += 1
+    return drawn
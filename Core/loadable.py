@@ -22,11 +22,14 @@
 # Basic loadable class, the baseclass for most plugins
 
 import re
+from datetime import datetime
 from Core.exceptions_ import MerlinSystemCall, LoadableError, PrefError, ParseError, ChanParseError, PNickParseError, UserError
 from Core.config import Config
 from Core.paconf import PA
-from Core.db import Session, session
+from Core.db import session
 from Core.maps import User, Channel, Command
+from Core.audit import AuditLog
+from Core.profiler import Profiler
 from Core.chanusertracker import CUT
 from Core.messages import PUBLIC_REPLY
 
@@ -89,6 +92,7 @@ class loadable(_base):
     alias = None
     param = ""
     trigger = "PRIVMSG"
+    catchall = False # Called for every line, not only when the command is used
     routes = None # List of (name, regex, access,)
     robocop = None
     PParseError = "You need to login and set mode +x to use this command"
@@ -177,22 +181,21 @@ class loadable(_base):
             return
         command = m.group(2)
         
+        call, subcommand = Profiler.start(), None
         try:
             route, subcommand, user, params = self.router(message, command)
             
             route(message, user, params)
             
-            session = Session()
-            session.add(Command(command_prefix = message.get_prefix(),
-                                command = self.name,
-                                subcommand = subcommand,
-                                command_parameters = self.hide_passwords(self.name, message.get_msg()[len(m.group(1))+1:].strip()),
-                                nick = message.get_nick(),
-                                username = "" if user is True else user.name,
-                                hostname = message.get_hostmask(),
-                                target = message.get_chan() if message.in_chan() else message.get_nick(),))
-            session.commit()
-            session.close()
+            AuditLog.add(Command, command_prefix = message.get_prefix(),
+                                  command = self.name,
+                                  subcommand = subcommand,
+                                  command_parameters = self.hide_passwords(self.name, message.get_msg()[len(m.group(1))+1:].strip()),
+                                  nick = message.get_nick(),
+                                  username = "" if user is True else user.name,
+                                  hostname = message.get_hostmask(),
+                                  target = message.get_chan() if message.in_chan() else message.get_nick(),
+                                  command_time = datetime.now(),)
             
         except PNickParseError:
             message.alert(self.PParseError)
@@ -204,6 +207,8 @@ class loadable(_base):
             message.alert(self.ChanError%e)
         except ParseError:
             message.alert(self.usage)
+        finally:
+            Profiler.stop(call, self.name if subcommand is None else "%s %s" % (self.name, subcommand,))
     
     def check_access(self, message, access=None, user=None, channel=None):
         access = access or self.access
@@ -280,6 +285,7 @@ def system(trigger, command=False, admin=False, robocop=False):
         class callback(loadable):
             __doc__ = hook.__doc__
             trigger = trigg
+            catchall = not command
             def __call__(loadable, message):
                 if command is True:
                     loadable.run(message)
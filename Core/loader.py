@@ -19,8 +19,11 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
  
+import hashlib
+import os
 import sys
 import time
+from types import ModuleType, ClassType, FunctionType, BuiltinFunctionType
 
 mods = ["Core",
         "Core.exceptions_",
@@ -28,18 +31,26 @@ mods = ["Core",
         "Core.paconf",
         "Core.string",
         "Core.connection",
-        "Core.db", "Core.maps",
+        "Core.db", "Core.cache", "Core.maps", "Core.audit", "Core.profiler",
         "Core.chanusertracker",
         "Core.messages", "Core.actions",
-        "Core.loadable", "Core.robocop",
-        "Core.callbacks", "Core.router",
+        "Core.loadable", "Core.pusher", "Core.robocop",
+        "Core.callbacks", "Core.executor", "Core.router",
         "Core.logger", "Core.admintools",
         ]
 
 class loader(object):
     # Module controller
     success = False
+    report = None
     modules = {}
+    stamps = {}
+    only = None
+    # Files besides its source that a module is loaded from
+    files = {"Core.config": ["merlin.cfg"], "Core.paconf": ["pa.cfg"]}
+    # Modules that can only be reloaded together. The models are declared
+    #  on Core.db's metadata, which can't hold the same tables twice.
+    units = [("Core.db", "Core.maps",)]
     
     def init(self):
         # First things first: backup ourselves
@@ -60,21 +71,37 @@ class loader(object):
         # If the reload succeeds, this Loader instance will be
         #  replaced, so this .success is only tested if it fails.
         self.success = False
+        start = time.time()
+        changed = self.changed()
         try:
-            # Reload this module, which will instantiate a new
-            #  Loader, which in turn will do all the main loading.
-            self.load_module("Core.loader")
-            # Check the new loader has a successful status
-            if sys.modules["Core.loader"].Loader.success is not True: raise ImportError
+            if "Core.loader" in changed:
+                # Reload this module, which will instantiate a new
+                #  Loader, which in turn will do all the main loading.
+                self.load_module("Core.loader")
+                # Check the new loader has a successful status
+                loader = sys.modules["Core.loader"].Loader
+                if loader.success is not True: raise ImportError
+                count = len(loader.modules)
+            else:
+                # Only reload the modules that have changed, and the modules
+                #  holding references into them, keeping this Loader
+                loader = self
+                reloading = self.dependents(changed)
+                self._reload(reloading)
+                count = len(reloading)
         except Exception, e:
             # If the new Loader fails, catch the error and restore everything
             print "%s Reload failed, reverting to previous." % (time.asctime(),)
             errorlog("%s - Loader Reload Error: %s\n" % (time.asctime(),str(e),))
             self.restore(sys)
+        else:
+            loader.report = "Reloaded %s modules (%s changed) in %.2f seconds." % (count, len(changed), time.time() - start,)
+            print "%s %s" % (time.asctime(), loader.report,)
     
-    def _reload(self):
+    def _reload(self, only=None):
         try:
-            # Reload everything
+            # Reload everything, or only the modules given
+            self.only = only
             self.load_module(*mods)
         except Exception:
             # Exceptions will be dealt with in init or reload
@@ -83,20 +110,27 @@ class loader(object):
             # Now everything has been (re)loaded, back them up
             # Note that nothing is backed up until after everything has
             #  been successfully reloaded - key transactional functionality.
-            self.backup(*mods)
+            self.backup(*self.reloaded(mods))
             # We also need to backup the modules used by Callbacks
             # The call to backup could be done in Callbacks, this
             #  is only transaction safe if Callbacks is the last module
             #  loaded though. Doing it here is ugly and hackish but safe.
-            self.backup(*sys.modules["Core.callbacks"].Callbacks.modules)
+            self.backup(*self.reloaded(sys.modules["Core.callbacks"].Callbacks.modules))
             # Success is tested by the calling Loader or reported to the user
             self.success = True
+        finally:
+            self.only = None
+    
+    def reloaded(self, mods):
+        # The modules that were just (re)loaded
+        return [mod for mod in mods if self.only is None or mod in self.only or mod not in self.modules]
     
     def load_module(self, *mods):
         # Reload (or import for the first time) the module
         for mod in mods:
             if mod in sys.modules:
-                reload(sys.modules[mod])
+                if self.only is None or mod in self.only:
+                    reload(sys.modules[mod])
             else:
                 __import__(mod, globals(), locals(), [''], 0)
     
@@ -104,6 +138,8 @@ class loader(object):
         for mod in mods:
             # Shallow copy of the module's __dict__
             self.modules[mod] = sys.modules[mod].__dict__.copy()
+            # and a note of the files it was loaded from
+            self.stamps[mod] = self.stamp(mod)
     
     def restore(self, sys):
         # We have to pass sys in, or we'd lose it when we .clear() this module
@@ -113,6 +149,95 @@ class loader(object):
             sys.modules[mod].__dict__.clear()
             # Copy the old objects from the backup back
             sys.modules[mod].__dict__.update(self.modules[mod])
+    
+    def sources(self, mod):
+        # The files a module is loaded from
+        path = getattr(sys.modules[mod], "__file__", None)
+        if path is None:
+            return []
+        return [os.path.splitext(path)[0] + ".py"] + self.files.get(mod, [])
+    
+    def stamp(self, mod, mtimes=None):
+        # Modification times and a hash of the module's files
+        files = self.sources(mod)
+        if mtimes is None:
+            mtimes = tuple([os.path.getmtime(file) if os.path.exists(file) else None for file in files])
+        digest = hashlib.md5()
+        for file in files:
+            if os.path.exists(file):
+                with open(file, "rb") as source:
+                    digest.update(source.read())
+        return mtimes, digest.hexdigest()
+    
+    def changed(self):
+        # Find the modules whose files have changed since they were loaded,
+        #  only hashing the files of modules with a new modification time
+        changed = set()
+        for mod, (mtimes, digest) in self.stamps.items():
+            if mod not in sys.modules:
+                continue
+            now = tuple([os.path.getmtime(file) if os.path.exists(file) else None for file in self.sources(mod)])
+            if now == mtimes:
+                continue
+            stamp = self.stamp(mod, now)
+            if stamp[1] != digest:
+                changed.add(mod)
+            else:
+                # Touched but not changed
+                self.stamps[mod] = stamp
+        # Hooks that haven't been imported yet are indexed by Callbacks
+        if "Core.callbacks" in sys.modules and sys.modules["Core.callbacks"].Callbacks.stale():
+            changed.add("Core.callbacks")
+        return changed
+    
+    def dependents(self, changed):
+        # Add every module that holds a reference to an object from a module
+        #  being reloaded, so it doesn't keep using the old objects
+        hooks = sys.modules["Core.callbacks"].Callbacks.modules
+        names = [mod for mod in mods + hooks if mod in sys.modules]
+        
+        # Work out which module each object belongs to, classes and functions
+        #  say where they're from, anything else belongs to the first module
+        #  holding it, as that's the one that made it
+        owners = {}
+        for name in names:
+            for key, value in sys.modules[name].__dict__.items():
+                if key.startswith("__"):
+                    continue
+                if isinstance(value, (type(None), bool, int, long, float, basestring,)):
+                    continue
+                if isinstance(value, ModuleType):
+                    owner = value.__name__
+                elif isinstance(value, (type, ClassType, FunctionType, BuiltinFunctionType,)):
+                    owner = getattr(value, "__module__", None)
+                else:
+                    try:
+                        owner = value.__module__
+                    except Exception:
+                        owner = None
+                    if owner not in names:
+                        owner = name
+                owners.setdefault(id(value), owner)
+        
+        depends = dict([(name, set(),) for name in names])
+        for name in names:
+            for key, value in sys.modules[name].__dict__.items():
+                owner = owners.get(id(value)) if not key.startswith("__") else None
+                # A package holds its submodules, but doesn't depend on them
+                if owner in depends and owner != name and not owner.startswith(name + "."):
+                    depends[name].add(owner)
+        # Callbacks holds an instance of every hook
+        depends["Core.callbacks"].update(hooks)
+        
+        reloading = set(changed)
+        while True:
+            more = set([name for name in names if depends[name] & reloading]) - reloading
+            for unit in self.units:
+                if reloading & set(unit):
+                    more |= set([name for name in unit if name in depends]) - reloading
+            if len(more) == 0:
+                return reloading
+            reloading |= more
 
 Loader = loader()
 Loader.init()
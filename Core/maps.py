@@ -25,7 +25,10 @@ import re
 import sys
 from sqlalchemy import *
 from sqlalchemy.ext.associationproxy import association_proxy
-from sqlalchemy.orm import validates, relation, backref, dynamic_loader, aliased
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import validates, relation, backref, dynamic_loader, aliased, joinedload, subqueryload_all
+from sqlalchemy.schema import CreateTable
 from sqlalchemy.sql.functions import coalesce, count, current_timestamp, random
 from sqlalchemy.types import BIGINT
 
@@ -34,6 +37,7 @@ from Core.config import Config
 from Core.paconf import PA
 from Core.string import encode
 from Core.db import Base, session
+from Core.cache import cache, tickcache
 
 if Config.getboolean("Misc", "bcrypt"):
     import bcrypt
@@ -44,11 +48,30 @@ else:
 # #############################    DUMP TABLES    ########################### #
 # ########################################################################### #
 
+# The history tables are range partitioned by tick, with a partition for every
+#  history_partition ticks. Excalibur creates the partitions as ticks arrive.
+history_partition = 168
+
+@compiles(CreateTable, "postgresql")
+def create_table(create, compiler, **kw):
+    ddl = compiler.visit_create_table(create)
+    partition_by = create.element.info.get("partition_by")
+    # Foreign keys referencing partitioned tables need PostgreSQL 12
+    if partition_by and compiler.dialect.server_version_info >= (12,):
+        ddl = "%s PARTITION BY RANGE (%s)\n\n" % (ddl.rstrip(), partition_by,)
+    return ddl
+
 class Updates(Base):
     __tablename__ = 'updates'
     id = Column(Integer, primary_key=True, autoincrement=False)
     etag = Column(String(255))
     modified = Column(String(255))
+    galaxy_etag = Column(String(255))
+    galaxy_modified = Column(String(255))
+    alliance_etag = Column(String(255))
+    alliance_modified = Column(String(255))
+    feed_etag = Column(String(255))
+    feed_modified = Column(String(255))
     galaxies = Column(Integer)
     planets = Column(Integer)
     alliances = Column(Integer)
@@ -112,6 +135,9 @@ class Updates(Base):
         retstr += " %s)" % (self.timestamp.strftime("%a %d/%m %H:%M"),)
         return retstr
 
+# Rankings and other results that only change once a tick
+rankings_cache = tickcache("Rankings")
+
 class Cluster(Base):
     __tablename__ = 'cluster'
     x = Column(Integer, primary_key=True)
@@ -201,7 +227,7 @@ class Cluster(Base):
         return cluster
 class ClusterHistory(Base):
     __tablename__ = 'cluster_history'
-    __table_args__ = (UniqueConstraint('x', 'tick'), {})
+    __table_args__ = (UniqueConstraint('x', 'tick'), {'info':{'partition_by':'tick'}})
     tick = Column(Integer, ForeignKey(Updates.id, ondelete='cascade'), primary_key=True, autoincrement=False)
     hour = Column(Integer, index=True)
     timestamp = Column(DateTime)
@@ -403,7 +429,7 @@ Cluster.galaxies = relation(Galaxy, order_by=asc(Galaxy.y), backref="cluster")
 Cluster.galaxy_loader = dynamic_loader(Galaxy)
 class GalaxyHistory(Base):
     __tablename__ = 'galaxy_history'
-    __table_args__ = (UniqueConstraint('x', 'y', 'tick'), ForeignKeyConstraint(('x', 'tick',), (ClusterHistory.x, ClusterHistory.tick,)), {})
+    __table_args__ = (UniqueConstraint('x', 'y', 'tick'), ForeignKeyConstraint(('x', 'tick',), (ClusterHistory.x, ClusterHistory.tick,)), {'info':{'partition_by':'tick'}})
     tick = Column(Integer, ForeignKey(Updates.id, ondelete='cascade'), primary_key=True, autoincrement=False)
     hour = Column(Integer, index=True)
     timestamp = Column(DateTime)
@@ -499,22 +525,25 @@ class GalaxyHistory(Base):
         Q = session.query(GalaxyHistory)
         Q = Q.filter_by(x=x, y=y)
         if closest:
-            Q = Q.order_by(asc(func.abs(tick-GalaxyHistory.tick)))
-        else:
-            Q = Q.filter_by(tick=tick)
-        galaxy = Q.filter_by(active=True).first()
-        if galaxy is not None:
-            if galaxy.tick == tick:
-                return galaxy
+            # Search the partitions either side of the tick before the whole round.
+            #  Unless it has to be active, an active row at the tick comes
+            #  first, then the closest row of either state.
+            near = Q.filter(GalaxyHistory.tick.between(tick-history_partition, tick+history_partition))
             if active:
-                return galaxy if closest else None
-        if active:
+                searches = [near.filter_by(active=True), Q.filter_by(active=True)]
+            else:
+                searches = [Q.filter_by(tick=tick, active=True), near, Q]
+            searches = [S.order_by(asc(func.abs(tick-GalaxyHistory.tick))) for S in searches]
+            for Q in searches:
+                galaxy = Q.first()
+                if galaxy is not None:
+                    return galaxy
             return None
-        galaxy = Q.first()
-        if closest or galaxy.tick == tick:
+        Q = Q.filter_by(tick=tick)
+        galaxy = Q.filter_by(active=True).first()
+        if galaxy is not None or active:
             return galaxy
-        else:
-            return None
+        return Q.first()
 
 Galaxy.history_loader = relation(GalaxyHistory, backref=backref('current', lazy='select'), lazy='dynamic')
 ClusterHistory.galaxies = relation(GalaxyHistory, order_by=asc(GalaxyHistory.y), backref="cluster")
@@ -635,7 +664,16 @@ class Planet(Base):
         return self.history_loader.filter_by(tick=tick).first()
     
     def scan(self, type):
-        return self.scans.filter_by(scantype=type[0].upper()).order_by(desc(Scan.id)).first()
+        type = type[0].upper()
+        # Use the scans loaded by LatestScan.load() if there are any
+        latest = getattr(self, "_latest", None)
+        if latest is not None and latest.has_key(type):
+            return latest[type]
+        Q = session.query(Scan)
+        Q = Q.join((LatestScan, LatestScan.scan_id == Scan.id,))
+        Q = Q.filter(LatestScan.planet_id == self.id)
+        Q = Q.filter(LatestScan.scantype == type)
+        return Q.first()
     
     @staticmethod
     def load(x,y,z, active=True):
@@ -715,7 +753,7 @@ Galaxy.planets = relation(Planet, order_by=asc(Planet.z), backref=backref('galax
 Galaxy.planet_loader = dynamic_loader(Planet)
 class PlanetHistory(Base):
     __tablename__ = 'planet_history'
-    __table_args__ = (ForeignKeyConstraint(('x', 'y', 'tick',), (GalaxyHistory.x, GalaxyHistory.y, GalaxyHistory.tick,)), {})
+    __table_args__ = (ForeignKeyConstraint(('x', 'y', 'tick',), (GalaxyHistory.x, GalaxyHistory.y, GalaxyHistory.tick,)), {'info':{'partition_by':'tick'}})
     tick = Column(Integer, ForeignKey(Updates.id, ondelete='cascade'), primary_key=True, autoincrement=False)
     hour = Column(Integer, index=True)
     timestamp = Column(DateTime)
@@ -834,22 +872,25 @@ class PlanetHistory(Base):
         Q = session.query(PlanetHistory)
         Q = Q.filter_by(x=x, y=y, z=z)
         if closest:
-            Q = Q.order_by(asc(func.abs(tick-PlanetHistory.tick)))
-        else:
-            Q = Q.filter_by(tick=tick)
-        planet = Q.filter_by(active=True).first()
-        if planet is not None:
-            if planet.tick == tick:
-                return planet
+            # Search the partitions either side of the tick before the whole round.
+            #  Unless it has to be active, an active row at the tick comes
+            #  first, then the closest row of either state.
+            near = Q.filter(PlanetHistory.tick.between(tick-history_partition, tick+history_partition))
             if active:
-                return planet if closest else None
-        if active:
+                searches = [near.filter_by(active=True), Q.filter_by(active=True)]
+            else:
+                searches = [Q.filter_by(tick=tick, active=True), near, Q]
+            searches = [S.order_by(asc(func.abs(tick-PlanetHistory.tick))) for S in searches]
+            for Q in searches:
+                planet = Q.first()
+                if planet is not None:
+                    return planet
             return None
-        planet = Q.first()
-        if closest or planet.tick == tick:
+        Q = Q.filter_by(tick=tick)
+        planet = Q.filter_by(active=True).first()
+        if planet is not None or active:
             return planet
-        else:
-            return None
+        return Q.first()
 
     @staticmethod
     def load_planet(x,y,z,tick,active=True, closest=False):
@@ -860,6 +901,7 @@ class PlanetHistory(Base):
             return ph
     
 Planet.history_loader = relation(PlanetHistory, backref=backref('current', lazy='select'), lazy='dynamic')
+PlanetHistory._idx_x_y_z_tick = Index('planet_history_x_y_z_tick', PlanetHistory.x, PlanetHistory.y, PlanetHistory.z, PlanetHistory.tick)
 GalaxyHistory.planets = relation(PlanetHistory, order_by=asc(PlanetHistory.z), backref="galaxy")
 GalaxyHistory.planet_loader = dynamic_loader(PlanetHistory)
 class PlanetExiles(Base):
@@ -1065,6 +1107,7 @@ class Alliance(Base):
         return retstr
 class AllianceHistory(Base):
     __tablename__ = 'alliance_history'
+    __table_args__ = {'info':{'partition_by':'tick'}}
     tick = Column(Integer, ForeignKey(Updates.id, ondelete='cascade'), primary_key=True, autoincrement=False)
     hour = Column(Integer, index=True)
     timestamp = Column(DateTime)
@@ -1168,6 +1211,8 @@ class AllianceHistory(Base):
     points_avg_highest_rank_tick = Column(Integer)
     points_avg_lowest_rank = Column(Integer)
     points_avg_lowest_rank_tick = Column(Integer)
+Alliance._idx_name_trgm = Index('alliance_name_trgm', Alliance.name, postgresql_using='gin', postgresql_ops={'name':'gin_trgm_ops'})
+Alliance._idx_alias_trgm = Index('alliance_alias_trgm', Alliance.alias, postgresql_using='gin', postgresql_ops={'alias':'gin_trgm_ops'})
 Alliance.history_loader = relation(AllianceHistory, backref=backref('current', lazy='select'), lazy='dynamic')
 
 class Feed(Base):
@@ -1267,6 +1312,37 @@ alliance_temp = Table('alliance_temp', Base.metadata,
     Column('score_avg', Integer),
     Column('points_avg', Integer))
 
+class TickTiming(Base):
+    __tablename__ = 'tick_timing'
+    id = Column(Integer, primary_key=True)
+    tick = Column(Integer, ForeignKey(Updates.id, ondelete='cascade'), index=True)
+    stage = Column(String(255), index=True)
+    seconds = Column(Float)
+
+    @staticmethod
+    def stages(ticks=24):
+        # Timings for the latest tick against the average and worst of the
+        #  previous ticks, as [(stage, latest, average, worst),], slowest first
+        tick = session.query(func.max(TickTiming.tick)).scalar()
+        if tick is None:
+            return None, []
+        latest = dict(session.query(TickTiming.stage, TickTiming.seconds).filter(TickTiming.tick == tick).all())
+        Q = session.query(TickTiming.stage, func.avg(TickTiming.seconds), func.max(TickTiming.seconds))
+        Q = Q.filter(TickTiming.tick < tick)
+        Q = Q.filter(TickTiming.tick >= tick - ticks)
+        Q = Q.group_by(TickTiming.stage)
+        previous = dict((stage, (average, worst,)) for stage, average, worst in Q.all())
+        stages = [(stage, seconds,) + previous.get(stage, (None, None,)) for stage, seconds in latest.items()]
+        stages.sort(key=lambda s: s[1], reverse=True)
+        return tick, stages
+
+    @staticmethod
+    def history(stage, ticks=24):
+        Q = session.query(TickTiming.tick, TickTiming.stage, TickTiming.seconds)
+        Q = Q.filter(TickTiming.stage.ilike(stage))
+        Q = Q.order_by(desc(TickTiming.tick), asc(TickTiming.stage))
+        return Q[:ticks]
+
 # ########################################################################### #
 # #############################    USER TABLES    ########################### #
 # ########################################################################### #
@@ -1362,6 +1438,9 @@ class User(Base):
     @staticmethod
     def load(name=None, id=None, passwd=None, exact=True, active=True, access=0):
         assert id or name
+        if id is None and passwd is None and exact is True and active is True and access == 0:
+            # The plain pnick lookup done for every command and reply
+            return user_cache.get(name, lambda session: session.query(User).filter(User.active == True).filter(User.access >= 0).filter(User.name.ilike(name)).first())
         Q = session.query(User)
         if active is True:
             if access in Config.options("Access"):
@@ -1401,6 +1480,8 @@ class User(Base):
         else:
             return None
 Planet.user = relation(User, uselist=False, backref="planet")
+user_cache = cache("User")
+user_cache.listen(User)
 def user_access_function(num):
     # Function generator for access check
     def func(self):
@@ -1459,9 +1540,9 @@ class Channel(Base):
     
     @staticmethod
     def load(name):
-        Q = session.query(Channel)
-        channel = Q.filter(Channel.name.ilike(name)).first()
-        return channel
+        return channel_cache.get(name, lambda session: session.query(Channel).filter(Channel.name.ilike(name)).first())
+channel_cache = cache("Channel")
+channel_cache.listen(Channel)
 
 # ########################################################################### #
 # ############################    INTEL TABLE    ############################ #
@@ -2047,6 +2128,7 @@ class FleetScan(Base):
 Scan.fleets = relation(FleetScan, backref="scan", order_by=asc(FleetScan.landing_tick))
 FleetScan.owner = relation(Planet, primaryjoin=FleetScan.owner_id==Planet.id)
 FleetScan.target = relation(Planet, primaryjoin=FleetScan.target_id==Planet.id)
+FleetScan._idx_target_mission = Index('%sfleetscan_target_mission' % (Config.get('DB', 'prefix'),), FleetScan.target_id, FleetScan.mission)
 
 class CovOp(Base):
     __tablename__ = Config.get('DB', 'prefix') + 'covop'
@@ -2058,6 +2140,84 @@ Scan.covops = relation(CovOp, backref="scan")
 CovOp.covopper = relation(Planet, primaryjoin=CovOp.covopper_id==Planet.id)
 CovOp.target = relation(Planet, primaryjoin=CovOp.target_id==Planet.id)
 
+class LatestScan(Base):
+    # The newest scan of each type on each planet, kept by the scan parser
+    __tablename__ = Config.get('DB', 'prefix') + 'latest_scan'
+    planet_id = Column(String(8), ForeignKey(Planet.id, ondelete='cascade'), primary_key=True)
+    scantype = Column(Enum(*Scan._scan_types, name="scantype"), primary_key=True)
+    scan_id = Column(Integer, ForeignKey(Scan.id, ondelete='cascade'), index=True)
+    tick = Column(Integer)
+    
+    @staticmethod
+    def refresh(scans):
+        # Point the planets at any of these scans that are newer than
+        #  what they have, inserting rows for their first scans of a type
+        newest = {}
+        for scan in scans:
+            if scan.planet_id is None:
+                continue
+            key = (scan.planet_id, scan.scantype,)
+            if not newest.has_key(key) or scan.id > newest[key].id:
+                newest[key] = scan
+        if len(newest) < 1:
+            return
+        
+        # The database decides whether a scan is newer, so two parsers storing
+        #  scans of the same planet at once can't leave the older one behind.
+        #  Rows are updated in order so they lock in the same order.
+        table = LatestScan.__table__
+        for (planet_id, scantype,), scan in sorted(newest.items()):
+            where = and_(table.c.planet_id == planet_id, table.c.scantype == scantype)
+            update = table.update().where(and_(where, or_(table.c.scan_id == None, table.c.scan_id < scan.id)))
+            update = update.values(scan_id=scan.id, tick=scan.tick)
+            if session.execute(update).rowcount > 0:
+                continue
+            if session.execute(select([table.c.scan_id]).where(where)).first() is not None:
+                # It already has a newer scan
+                continue
+            session.begin_nested()
+            try:
+                session.execute(table.insert().values(planet_id=planet_id, scantype=scantype, scan_id=scan.id, tick=scan.tick))
+                session.commit()
+            except IntegrityError:
+                # Another scan of the same planet was stored at the same time
+                session.rollback()
+                session.execute(update)
+    
+    @staticmethod
+    def rebuild():
+        # Fill the table from the scans already stored
+        session.execute(LatestScan.__table__.delete())
+        session.execute(text("INSERT INTO %s (planet_id, scantype, scan_id, tick) SELECT DISTINCT ON (planet_id, scantype) planet_id, scantype, id, tick FROM %s WHERE planet_id IS NOT NULL ORDER BY planet_id, scantype, id DESC;" % (LatestScan.__tablename__, Scan.__tablename__,)))
+        session.commit()
+    
+    @staticmethod
+    def load(planets, types=None):
+        # Load the newest scans of the given types (all by default) for a
+        #  list of planets in one go, with what they found, and keep them on
+        #  the planets for Planet.scan(). Returns {planet_id: {type: scan}}.
+        planets = dict([(planet.id, planet,) for planet in planets if planet is not None])
+        types = [type for type in Scan._scan_types if types is None or type in types.upper()]
+        result = dict([(id, dict.fromkeys(types),) for id in planets.keys()])
+        if len(planets) < 1 or len(types) < 1:
+            return result
+        
+        Q = session.query(Scan)
+        Q = Q.join((LatestScan, LatestScan.scan_id == Scan.id,))
+        Q = Q.filter(LatestScan.planet_id.in_(planets.keys()))
+        Q = Q.filter(LatestScan.scantype.in_(types))
+        Q = Q.options(joinedload(Scan.planetscan), joinedload(Scan.devscan),
+                      subqueryload_all(Scan.units, UnitScan.ship), subqueryload_all(Scan.fleets, FleetScan.owner),
+                      subqueryload_all(Scan.fleets, FleetScan.target))
+        for scan in Q.all():
+            result[scan.planet_id][scan.scantype] = scan
+        
+        for id, planet in planets.items():
+            if getattr(planet, "_latest", None) is None:
+                planet._latest = {}
+            planet._latest.update(result[id])
+        return result
+
 # ########################################################################### #
 # ############################    PENIS CACHE    ############################ #
 # ########################################################################### #
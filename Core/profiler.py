@@ -0,0 +1,184 @@
+# This file is part of Merlin.
+# Merlin is the Copyright (C)2008,2009,2010 of Robin K. Hansen, Elliot Rosemarine, Andreas Jacobsen.
+
+# Individual portions may be copyright by individual contributors, and
+# are included in this collective work with permission of the copyright
+# owners.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+# Command profiler
+#   When enabled, each command (with its subcommand) and each Arthur view
+#   has its wall time, database queries, query time and rows recorded.
+#   The last samples of each are kept to give a rolling histogram, and
+#   the slowest calls can be dumped as cProfile stats.
+
+import cProfile
+import heapq
+import os
+import re
+import threading
+import time
+from collections import deque
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from Core.config import Config
+
+class sample(object):
+    # One profiled call
+    profile = None
+
+    def __init__(self):
+        self.start = time.time()
+        self.queries = 0
+        self.dbtime = 0.0
+        self.rows = 0
+
+class profiler(object):
+    enabled = Config.getboolean("Misc", "profile") if Config.has_option("Misc", "profile") else False
+    # Samples kept for each command or view
+    window = Config.getint("Misc", "profilewindow") if Config.has_option("Misc", "profilewindow") else 500
+    # Directory to keep cProfile stats of the slowest calls in, if any
+    dumpdir = Config.get("Misc", "profiledump") if Config.has_option("Misc", "profiledump") else ""
+    slowest = Config.getint("Misc", "profileslowest") if Config.has_option("Misc", "profileslowest") else 10
+    # Histogram bucket limits, in seconds
+    buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.samples = {}
+        self.dumps = []
+        # Listen on every engine, as reloading Core.db replaces its engine
+        event.listen(Engine, "before_cursor_execute", self.before_execute)
+        event.listen(Engine, "after_cursor_execute", self.after_execute)
+
+    def start(self):
+        # Start profiling a call in this thread, returns None if disabled
+        if not self.enabled or getattr(self.local, "call", None) is not None:
+            return None
+        call = self.local.call = sample()
+        if self.dumpdir:
+            call.profile = cProfile.Profile()
+            call.profile.enable()
+        return call
+
+    def stop(self, call, name):
+        # Finish profiling a call, recording it under name
+        if call is None:
+            return
+        wall = time.time() - call.start
+        if call.profile is not None:
+            call.profile.disable()
+        self.local.call = None
+        with self.lock:
+            if not self.samples.has_key(name):
+                self.samples[name] = deque(maxlen=self.window)
+            self.samples[name].append((wall, call.queries, call.dbtime, call.rows,))
+        if call.profile is not None:
+            self.dump(name, wall, call.profile)
+
+    def before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        call = getattr(self.local, "call", None)
+        if call is not None:
+            self.local.query = time.time()
+
+    def after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        call = getattr(self.local, "call", None)
+        if call is not None:
+            call.queries += 1
+            call.dbtime += time.time() - getattr(self.local, "query", call.start)
+            if cursor.rowcount > 0 and cursor.description is not None:
+                call.rows += cursor.rowcount
+
+    def dump(self, name, wall, profile):
+        # Keep the stats of the slowest calls, removing the ones they replace
+        with self.lock:
+            if len(self.dumps) >= self.slowest and wall <= self.dumps[0][0]:
+                return
+            path = os.path.join(self.dumpdir, "%s-%s.prof" % (re.sub(r"\W+", "_", name), int(time.time() * 1000),))
+            heapq.heappush(self.dumps, (wall, path,))
+            removed = heapq.heappop(self.dumps)[1] if len(self.dumps) > self.slowest else None
+        try:
+            profile.dump_stats(path)
+            if removed is not None and os.path.exists(removed):
+                os.remove(removed)
+        except (IOError, OSError), e:
+            print "%s Profile dump error: %s" % (time.asctime(), str(e),)
+
+    def reset(self):
+        with self.lock:
+            self.samples = {}
+
+    def percentile(self, values, pc):
+        return values[min(int(len(values) * pc), len(values) - 1)]
+
+    def summary(self, count=10):
+        # The commands or views taking the most time in total
+        with self.lock:
+            samples = [(name, list(calls),) for name, calls in self.samples.items()]
+        if len(samples) == 0:
+            return ["No calls have been profiled%s" % ("" if self.enabled else ", profiling is off",)]
+        samples.sort(key=lambda s: sum([call[0] for call in s[1]]), reverse=True)
+        lines = []
+        for name, calls in samples[:count]:
+            times = sorted([call[0] for call in calls])
+            lines.append("%s: %s calls, avg %.3fs, p95 %.3fs, max %.3fs, %.1f queries (%.3fs), %.1f rows" % (name, len(calls),
+                            sum(times) / len(times), self.percentile(times, 0.95), times[-1],
+                            float(sum([call[1] for call in calls])) / len(calls),
+                            sum([call[2] for call in calls]) / len(calls),
+                            float(sum([call[3] for call in calls])) / len(calls),))
+        return lines
+
+    def histogram(self, name):
+        # Wall times of the recent calls of a command or view, with the
+        #  calls in each bucket
+        with self.lock:
+            calls = list(self.samples.get(name, []))
+            if len(calls) == 0:
+                # Match commands without their subcommand
+                for key in self.samples.keys():
+                    if key.split()[0] == name:
+                        calls += list(self.samples[key])
+        if len(calls) == 0:
+            return None
+        times = sorted([call[0] for call in calls])
+        counts = []
+        lower = 0
+        for limit in self.buckets + (None,):
+            n = len([t for t in times if t >= lower and (limit is None or t < limit)])
+            if n:
+                counts.append(("<%ss" % (limit,) if limit is not None else ">%ss" % (lower,), n,))
+            lower = limit
+        return len(times), self.percentile(times, 0.5), self.percentile(times, 0.95), times[-1], counts
+
+    def stats(self, name=None):
+        # Lines to reply with, for IRC or RoboCop
+        if name is None:
+            return self.summary()
+        histogram = self.histogram(name)
+        if histogram is None:
+            return ["No calls of %s have been profiled" % (name,)]
+        calls, median, p95, worst, counts = histogram
+        return ["%s: %s calls, median %.3fs, p95 %.3fs, max %.3fs. %s" % (name, calls, median, p95, worst,
+                    ", ".join(["%s: %s" % count for count in counts]),)]
+
+# Keep the running profiler when this module is reloaded, so its engine
+#  listeners aren't registered twice
+try:
+    Profiler
+except NameError:
+    Profiler = profiler()
@@ -0,0 +1,163 @@
+# This file is part of Merlin.
+# Merlin is the Copyright (C)2008,2009,2010 of Robin K. Hansen, Elliot Rosemarine, Andreas Jacobsen.
+
+# Individual portions may be copyright by individual contributors, and
+# are included in this collective work with permission of the copyright
+# owners.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+# RoboCop message pusher
+#   Kept apart from Core.robocop so the scan parser and excalibur can push
+#   without importing the IRC side of the bot.
+
+import atexit
+import select
+import socket
+import threading
+import time
+from collections import deque
+
+from Core.config import Config
+from Core.string import CRLF, errorlog
+
+class pusher(object):
+    # Keeps one connection to a RoboCop server open, and sends the lines
+    #  queued by push() from a background thread in batches. When the
+    #  queue is full push() waits for room, up to a limit. If a batch is
+    #  only partly written, the lines written in full aren't sent again.
+    maxqueue = Config.getint("Misc", "robocopqueue") if Config.has_option("Misc", "robocopqueue") else 1000
+    batch = 100
+    
+    def __init__(self, port):
+        self.port = port
+        self.lock = threading.Condition()
+        self.queue = deque()
+        self.sock = None
+        self.thread = None
+        self.stopping = False
+        self.sent = 0
+        self.dropped = 0
+        atexit.register(self.shutdown)
+    
+    def add(self, line):
+        with self.lock:
+            deadline = time.time() + 30
+            while len(self.queue) >= self.maxqueue and time.time() < deadline:
+                self.lock.wait(deadline - time.time())
+            if len(self.queue) >= self.maxqueue:
+                self.dropped += 1
+                errorlog("%s - RoboCop push queue full, dropped: %s\n" % (time.asctime(),line,), traceback=False)
+                return
+            self.queue.append(line)
+            if self.thread is None or not self.thread.is_alive():
+                self.stopping = False
+                self.thread = threading.Thread(target=self.run, name="robocop-%s" % (self.port,))
+                self.thread.daemon = True
+                self.thread.start()
+            self.lock.notify_all()
+    
+    def run(self):
+        # Sender loop
+        delay = 1
+        while True:
+            with self.lock:
+                while len(self.queue) == 0 and not self.stopping:
+                    self.lock.wait()
+                if len(self.queue) == 0:
+                    break
+                lines = [self.queue[i] for i in range(min(len(self.queue), self.batch))]
+            done, e = self.send(lines)
+            with self.lock:
+                for i in range(done):
+                    self.queue.popleft()
+                self.sent += done
+                self.lock.notify_all()
+            if e is None:
+                delay = 1
+                continue
+            self.close()
+            if self.stopping:
+                with self.lock:
+                    self.dropped += len(self.queue)
+                    errorlog("%s - RoboCop push error, dropped %s lines: %s\n" % (time.asctime(),len(self.queue),str(e),), traceback=False)
+                    self.queue.clear()
+                break
+            # Try again, backing off while the server is away
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+        self.close()
+    
+    def send(self, lines):
+        # Write the lines, returning how many were written in full and the
+        #  error that stopped the rest, if any
+        data = CRLF.join(lines) + CRLF
+        written = 0
+        try:
+            if self.sock is None:
+                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.sock.settimeout(30)
+                self.sock.connect(("127.0.0.1", self.port,))
+            self.drain()
+            while written < len(data):
+                written += self.sock.send(data[written:])
+        except socket.error, e:
+            return data.count(CRLF, 0, written), e
+        return len(lines), None
+    
+    def drain(self):
+        # Discard the server's OK/ERROR replies so they don't back up,
+        #  and notice if it has closed the connection
+        while select.select([self.sock], [], [], 0)[0]:
+            if not self.sock.recv(4096):
+                raise socket.error("Connection closed by RoboCop")
+    
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+    
+    def shutdown(self):
+        # Send anything left before exit
+        with self.lock:
+            self.stopping = True
+            self.lock.notify_all()
+            thread = self.thread
+        if thread is not None:
+            thread.join(30)
+
+# Keep the pushers when this module is reloaded, so their connections are reused
+try:
+    pushers
+except NameError:
+    pushers = {}
+    pushlock = threading.Lock()
+
+def deliver(line, port=None):
+    # Queue a line for the RoboCop server on port, this bot's by default
+    port = port or Config.getint("Misc", "robocop")
+    with pushlock:
+        if not pushers.has_key(port):
+            pushers[port] = pusher(port)
+    pushers[port].add(line)
+
+class push(object):
+    # Robocop message pusher
+    def __init__(self, line, **kwargs):
+        line = " ".join([line] + map(lambda i: "%s=%s"%i, kwargs.items()))
+        deliver(line)
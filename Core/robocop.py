@@ -20,12 +20,16 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
  
 import socket
+import threading
 import time
+from collections import deque
 
 from Core.exceptions_ import Call999, UnderArrest
 from Core.config import Config
 from Core.string import CRLF
 from Core.actions import Action
+# Hooks push through here
+from Core.pusher import push
 
 class server(object):
     # Robocop server
@@ -94,10 +98,19 @@ RoboCop = server()
 
 class client(object):
     # Robocop client
+    # Clients may keep their connection open and send many lines at once,
+    #  lines are held back while too many of theirs are still being run,
+    #  so a busy client is slowed down rather than filling the Executor
+    maxpending = Config.getint("Misc", "robocoppending") if Config.has_option("Misc", "robocoppending") else 20
+    
     def __init__(self, sock):
         # Basic attach
         self.sock = sock
-        self.file = self.sock.makefile('rb', 0)
+        self.sock.settimeout(30)
+        self.lock = threading.Lock()
+        self.buffer = ""
+        self.lines = deque()
+        self.pending = 0
         try:
             self._host = (self.sock.getpeername()[1],self.fileno(),)
         except socket.error:
@@ -117,31 +130,54 @@ class client(object):
     
     def write(self, line):
         # Write to socket/server
+        #  Replies come from the Executor's threads, so one at a time
         try:
-            self.sock.send(line + CRLF)
+            with self.lock:
+                self.sock.sendall(line + CRLF)
             print "%s >>> %s :%s" % (time.asctime(),self.host(),line,)
         except socket.error as exc:
             self.disconnect()
     
     def read(self):
-        # Read from socket
+        # Read from socket, keeping any complete lines
         try:
-            line = self.file.readline()
+            data = self.sock.recv(4096)
         except socket.error:
             self.disconnect()
             raise UnderArrest
-        if line:
-            if line[-2:] == CRLF:
-                line = line[:-2]
-            if line[-1] in CRLF:
+        if not data:
+            self.disconnect()
+            raise UnderArrest
+        lines = (self.buffer + data).split("\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            if line[-1:] == "\r":
                 line = line[:-1]
+            if not line.strip():
+                continue
             # All this just to print a pretty log message...
             print "%s <<< :%s %s%s" % (time.asctime(), self.host(), line.split(None,1)[0].upper(),
                                        " :"+" ".join(line.split(None,1)[1:]) if len(line.split())-1 else "",)
-            return line
-        else:
-            self.disconnect()
-            raise UnderArrest
+            self.lines.append(line)
+    
+    def next(self):
+        # Return the next line to run, if there's room for it
+        with self.lock:
+            if len(self.lines) == 0 or self.pending >= self.maxpending:
+                return None
+            self.pending += 1
+            return self.lines.popleft()
+    
+    def ready(self):
+        # Whether more lines should be read from this client
+        return self.pending < self.maxpending and len(self.lines) == 0
+    
+    def done(self):
+        # A line has been run, or dropped
+        with self.lock:
+            self.pending -= 1
+            held = self.pending == self.maxpending - 1 and len(self.lines) > 0
+        return held
     
     def fileno(self):
         # Return act like a file
@@ -176,14 +212,3 @@ class EmergencyCall(Action):
         # This should be called if an error occurs while
         #  executing a callback or if it completes successfully
         self.reply(("OK %s" if success else "ERROR %s") % (self.line,))
-
-class push(object):
-    # Robocop message pusher
-    def __init__(self, line, **kwargs):
-        line = " ".join([line] + map(lambda i: "%s=%s"%i, kwargs.items()))
-        port = Config.getint("Misc", "robocop")
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(30)
-        sock.connect(("127.0.0.1", port,))
-        sock.send(line + CRLF)
-    
@@ -26,9 +26,12 @@ from Core.exceptions_ import MerlinSystemCall, Reboot, Call999, UnderArrest
 from Core.loader import Loader
 from Core.string import errorlog
 from Core.connection import Connection
+from Core.admintools import admin_msg
 from Core.actions import Action
 from Core.robocop import RoboCop, EmergencyCall
 from Core.callbacks import Callbacks
+from Core.executor import Executor
+from Core.audit import AuditLog
 
 class router(object):
     message = None
@@ -38,13 +41,40 @@ class router(object):
         # If we've been asked to reload, report if it didn't work
         if Loader.success is False and self.message is not None:
             self.message.alert("I detect a sudden weakness in the Morphing Grid.")
+        # Otherwise let the admins know how long it took
+        if Loader.success is True and Loader.report is not None:
+            admin_msg(Loader.report)
+            Loader.report = None
         
+        # Start the workers that will run the callbacks
+        Executor.start()
+        
+        try:
+            self.loop()
+        finally:
+            # Let running callbacks finish before anything is reloaded
+            Executor.shutdown()
+            # and write out their command log rows
+            AuditLog.shutdown()
+    
+    def loop(self):
         # Operation loop
         #   Loop to parse every line received over the connections
         while True:
             
-            # Generate a list of connections ready to read
-            inputs = select.select([Connection, RoboCop]+RoboCop.clients, [], [], 330)[0]
+            # Pass on lines from RoboCop clients that were held back
+            #  while too many of their lines were running
+            for connection in RoboCop.clients[:]:
+                try:
+                    self.client(connection)
+                except Exception, e:
+                    print "%s Routing error logged." % (time.asctime(),)
+                    errorlog("%s - Routing Error: %s\n%s\n" % (time.asctime(),str(e),connection,))
+            
+            # Generate a list of connections ready to read, RoboCop
+            #  clients aren't read from while their lines are held back
+            clients = [connection for connection in RoboCop.clients if connection.ready()]
+            inputs = select.select([Connection, RoboCop, Executor]+clients, [], [], 330)[0]
             
             # None of the inputs are ready to read, the IRC
             #  socket has timed out, so reboot and reconnect
@@ -60,7 +90,10 @@ class router(object):
                     if connection == RoboCop:
                         self.robocop()
                     if connection in RoboCop.clients:
+                        connection.read()
                         self.client(connection)
+                    if connection == Executor:
+                        self.executor()
                 except UnderArrest:
                     pass
                 except MerlinSystemCall:
@@ -73,18 +106,32 @@ class router(object):
         # A line from IRC
         # Create a new message object
         self.message = Action()
-        # Read the line
+        # Read the line, any PING has already been answered
         line = Connection.read()
         try:
             # Parse the line
             self.message.parse(line)
+        except Exception:
+            self.message.alert("An exception occured whilst processing your request. Please report the command you used to the bot owner as soon as possible.")
+            raise
+        # Commands are run by the Executor, everything else is cheap
+        #  channel/user tracking that has to stay in order, so do it now
+        if self.message.get_command() == "PRIVMSG":
+            lane = ("%s %s" % (self.message.get_chan(), self.message.get_nick(),)).lower()
+            if not Executor.submit(self.message, self.callback, lane):
+                self.message.alert("I'm too busy to deal with that right now, please try again in a moment.")
+        else:
+            self.callback(self.message)
+    
+    def callback(self, message):
+        try:
             # Callbacks process the line
-            Callbacks.callback(self.message)
+            Callbacks.callback(message)
         except MerlinSystemCall:
             raise
         except Exception:
             # Error while executing a callback/mod/hook
-            self.message.alert("An exception occured whilst processing your request. Please report the command you used to the bot owner as soon as possible.")
+            message.alert("An exception occured whilst processing your request. Please report the command you used to the bot owner as soon as possible.")
             raise
     
     def robocop(self):
@@ -94,21 +141,47 @@ class router(object):
         RoboCop.read()
     
     def client(self, connection):
-        # A line from a RoboCop client
-        # Create a new message object
-        self.message = EmergencyCall(connection)
-        # Read the line
-        line = connection.read()
+        # Lines from a RoboCop client
+        while True:
+            # Take the next line, if there's room for it
+            line = connection.next()
+            if line is None:
+                break
+            # Create a new message object
+            self.message = EmergencyCall(connection)
+            try:
+                # Parse the line
+                self.message.parse(line)
+            except Exception:
+                self.clientdone(connection)
+                self.message.alert(False)
+                raise
+            if not Executor.submit(self.message, self.clientcall, connection.host(), lambda connection=connection: self.clientdone(connection)):
+                self.clientdone(connection)
+                self.message.alert(False)
+    
+    def clientdone(self, connection):
+        # Wake the loop if the client's lines were being held back
+        if connection.done():
+            Executor.wake()
+    
+    def clientcall(self, message):
         try:
-            # Parse the line
-            self.message.parse(line)
             # Callbacks process the line
-            Callbacks.robocop(self.message)
+            Callbacks.robocop(message)
         except MerlinSystemCall:
             raise
         except Exception:
             # Error while executing a callback/mod/hook
-            self.message.alert(False)
+            message.alert(False)
             raise
+    
+    def executor(self):
+        # A hook running on the Executor made a system call,
+        #  keep the message so a failed reload can be reported
+        message, call = Executor.read()
+        if call is not None:
+            self.message = message
+            raise call
 
 Router = router()
\ No newline at end of file
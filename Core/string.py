@@ -19,8 +19,15 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
  
+import atexit
+import os
+import re
+import threading
+import time
+from collections import deque
 from sys import stdout
 from traceback import format_exc
+from Core.exceptions_ import SMSError
 from Core.config import Config
 # For email
 import socket
@@ -54,43 +61,172 @@ def encode(text):
     else:
         raise UnicodeError
 
-def log(filename, log, traceback=True, spacing=True):
-    def _log(file):
-        file.write(encode(log) + "\n")
-        if traceback is True:
-            file.write(format_exc() + "\n")
-        if spacing is True:
-            file.write("\n\n")
-    try:
-        file = Config.get("Misc", filename)
-        if file == "stdout":
-            _log(stdout)
-        else:
-            with open(file, "a") as file:
-                _log(file)
-    finally:
-        if filename == "excalibur":
-            if "d" not in Config.get("Misc", "maillogs"):
-                return
-        elif filename[0] not in Config.get("Misc", "maillogs"):
-            return
-        if traceback:
-            sep = "\n\n" if spacing else "\n"
-            log = sep.join([log, format_exc()])
-        for addr in Config.get("Misc", "logmail").split():
-            send_email("%s: %s" % (Config.get("Connection", "nick"), filename), log, addr)
-
-errorlog = lambda text, traceback=True: log("errorlog", text, traceback=traceback)
-scanlog = lambda text, traceback=False, spacing=False: log("scanlog", text, traceback=traceback, spacing=spacing or traceback)
-arthurlog = lambda text, traceback=True: log("arthurlog", text, traceback=traceback)
-excaliburlog = lambda text, traceback=False, spacing=False: log("excalibur", text, traceback=traceback, spacing=spacing or traceback)
+class logwriter(object):
+    # Log lines are written by a background thread, which keeps each log file
+    #  open, so logging never waits on the disk or a mail server.
+    # Emailed lines are sent as one digest per log, at most every maildelay
+    #  seconds, with up to maillines lines in each.
+    maildelay = Config.getint("Misc", "maildelay") if Config.has_option("Misc", "maildelay") else 300
+    maillines = Config.getint("Misc", "maillines") if Config.has_option("Misc", "maillines") else 100
+    
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.queue = deque()
+        self.files = {}
+        self.mail = {}
+        self.skipped = {}
+        self.mailed = 0
+        self.thread = None
+        self.stopping = False
+        atexit.register(self.shutdown)
+    
+    def add(self, path, text, mail=None):
+        # Queue text for the file at path, and for the digest of log mail
+        with self.lock:
+            self.queue.append((path, text, mail,))
+            if self.thread is None or not self.thread.is_alive():
+                self.stopping = False
+                self.thread = threading.Thread(target=self.run, name="logwriter")
+                self.thread.daemon = True
+                self.thread.start()
+            self.lock.notify()
+    
+    def run(self):
+        # Writer loop
+        while True:
+            with self.lock:
+                if len(self.queue) == 0 and not self.stopping:
+                    if len(self.mail) > 0:
+                        self.lock.wait(max(self.mailed + self.maildelay - time.time(), 0.1))
+                    else:
+                        self.lock.wait()
+                lines, self.queue = self.queue, deque()
+                stopping = self.stopping
+            self.write(lines)
+            if len(self.mail) > 0 and (stopping or time.time() >= self.mailed + self.maildelay):
+                self.send()
+            if stopping:
+                break
+    
+    def write(self, lines):
+        # Write a batch of lines, flushing each file once at the end
+        written = set()
+        for path, text, mail in lines:
+            if path is not None:
+                try:
+                    self.open(path).write(text)
+                    written.add(path)
+                except (IOError, OSError), e:
+                    print "%s Log error writing to %s: %s" % (time.asctime(), path, str(e),)
+            if mail is not None:
+                if len(self.mail.get(mail, [])) < self.maillines:
+                    self.mail.setdefault(mail, []).append(text)
+                else:
+                    self.skipped[mail] = self.skipped.get(mail, 0) + 1
+        for path in written:
+            try:
+                self.files[path].flush()
+            except (IOError, OSError):
+                pass
+    
+    def open(self, path):
+        # Return the open file for path, reopening it if it has been moved
+        #  or deleted since, such as by logrotate
+        file = self.files.get(path)
+        if file is not None:
+            try:
+                if os.stat(path).st_ino == os.fstat(file.fileno()).st_ino:
+                    return file
+            except OSError:
+                pass
+            file.close()
+        file = self.files[path] = open(path, "a")
+        return file
+    
+    def send(self):
+        # Send a digest of each emailed log to each address
+        self.mailed = time.time()
+        mail, self.mail = self.mail, {}
+        skipped, self.skipped = self.skipped, {}
+        for filename, lines in mail.items():
+            subject = "%s: %s" % (Config.get("Connection", "nick"), filename,)
+            if len(lines) + skipped.get(filename, 0) > 1:
+                subject += " (%s entries)" % (len(lines) + skipped.get(filename, 0),)
+            message = "".join(lines)
+            if skipped.get(filename):
+                message += "\n%s more entries were not included." % (skipped[filename],)
+            for addr in Config.get("Misc", "logmail").split():
+                error = send_email(subject, message, addr)
+                if error:
+                    print "%s Log mail to %s failed. %s" % (time.asctime(), addr, error,)
+    
+    def shutdown(self):
+        # Write everything queued and send any mail left, before exit
+        with self.lock:
+            self.stopping = True
+            self.lock.notify()
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            thread.join(60)
+        for file in self.files.values():
+            file.close()
+        self.files = {}
+
+# Keep the running writer when this module is reloaded, so no lines are lost
+try:
+    LogWriter
+except NameError:
+    LogWriter = logwriter()
+
+fieldre = re.compile(r"[\s=\"]")
+
+def fields(**kwargs):
+    # Format timings and other values as key=value pairs
+    pairs = []
+    for key, value in sorted(kwargs.items()):
+        value = value if isinstance(value, basestring) else "%.3f" % (value,) if isinstance(value, float) else str(value)
+        if fieldre.search(value) or value == "":
+            value = '"%s"' % (value.replace('"', '\\"'),)
+        pairs.append("%s=%s" % (key, value,))
+    return " ".join(pairs)
+
+def log(filename, log, traceback=True, spacing=True, **kwargs):
+    # Extra keyword arguments are added to the line as key=value pairs
+    text = encode(log)
+    if kwargs:
+        text += " " + encode(fields(**kwargs))
+    text += "\n"
+    if traceback is True:
+        # Format the traceback now, while we're still handling it
+        text += format_exc() + "\n"
+    if spacing is True:
+        text += "\n\n"
+    
+    if filename == "excalibur":
+        mail = "d" in Config.get("Misc", "maillogs")
+    else:
+        mail = filename[0] in Config.get("Misc", "maillogs")
+    
+    file = Config.get("Misc", filename)
+    if file == "stdout":
+        # Keep the order of anything else being printed
+        stdout.write(text)
+        if mail:
+            LogWriter.add(None, text, filename)
+    elif file or mail:
+        LogWriter.add(file or None, text, filename if mail else None)
+
+errorlog = lambda text, traceback=True, **kwargs: log("errorlog", text, traceback=traceback, **kwargs)
+scanlog = lambda text, traceback=False, spacing=False, **kwargs: log("scanlog", text, traceback=traceback, spacing=spacing or traceback, **kwargs)
+arthurlog = lambda text, traceback=True, **kwargs: log("arthurlog", text, traceback=traceback, **kwargs)
+excaliburlog = lambda text, traceback=False, spacing=False, **kwargs: log("excalibur", text, traceback=traceback, spacing=spacing or traceback, **kwargs)
 
 def send_email(subject, message, addr):
     try:
         if (Config.get("smtp", "port") == "0"):
-            smtp = SMTP("localhost")
+            smtp = SMTP("localhost", timeout=30)
         else:
-            smtp = SMTP(Config.get("smtp", "host"), Config.get("smtp", "port"))
+            smtp = SMTP(Config.get("smtp", "host"), Config.get("smtp", "port"), timeout=30)
 
         if not ((Config.get("smtp", "host") == "localhost") or (Config.get("smtp", "host") == "127.0.0.1")):
             try:
@@ -24,6 +24,7 @@ __all__ = ["system",
            "chanusertracker",
            "auth",
            "commandlog",
+           "auditlog",
            "help",
            "user",
            "propsandcookies",
@@ -48,4 +49,7 @@ __all__ = ["system",
            "rollback",
            "updatenotifier",
            "adminmsg",
+           "tickperf",
+           "sendqueue",
+           "profile",
            ]
@@ -42,6 +42,8 @@ class help(loadable):
             if not user.id:
                 return
         message.reply(self.doc+". For more information use: "+self.usage)
+        # Import any commands that haven't been used yet
+        Callbacks.wake_all()
         for callback in Callbacks.callbacks["PRIVMSG"]:
             try:
                 if callback.check_access(message, None, user, channel) is not None:
@@ -0,0 +1,50 @@
+# This file is part of Merlin.
+# Merlin is the Copyright (C)2008,2009,2010 of Robin K. Hansen, Elliot Rosemarine, Andreas Jacobsen.
+ 
+# Individual portions may be copyright by individual contributors, and
+# are included in this collective work with permission of the copyright
+# owners.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+ 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+from Core.profiler import Profiler
+from Core.loadable import loadable, robohci, route
+
+class profile(loadable):
+    """Show the commands taking the most time while profiling is on, with their database queries and rows. Give a command to see a histogram of its recent calls. Turn profiling on or off, or reset the samples."""
+    usage = " [on|off|reset] | [command]"
+    access = "admin"
+    
+    @robohci
+    def robocop(self, message, name=None):
+        for line in Profiler.stats(name):
+            message.reply(line)
+    
+    @route(r"(on|off|reset)")
+    def control(self, message, user, params):
+        if params.group(1).lower() == "reset":
+            Profiler.reset()
+            message.reply("Profiling samples cleared")
+        else:
+            Profiler.enabled = params.group(1).lower() == "on"
+            message.reply("Profiling is %s" % ("on" if Profiler.enabled else "off",))
+    
+    @route(r"(\S+)")
+    def detail(self, message, user, params):
+        message.reply(" | ".join(Profiler.stats(params.group(1).lower())))
+    
+    @route(r"")
+    def summary(self, message, user, params):
+        message.reply(" | ".join(Profiler.stats()))
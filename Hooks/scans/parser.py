@@ -19,33 +19,113 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
  
+import httplib
 import re
 import socket
-from threading import Thread
+from Queue import Queue
+from threading import Lock, Thread, local
 from time import asctime, time
 import urllib2
+import urlparse
+from sqlalchemy import tuple_
 from sqlalchemy.exc import IntegrityError
 from Core.config import Config
 from Core.paconf import PA
-from Core.string import decode, scanlog, CRLF
+from Core.string import decode, scanlog
 from Core.db import session
 from Core.maps import Updates, Planet, PlanetHistory, Intel, Ship, Scan, Request
-from Core.maps import PlanetScan, DevScan, UnitScan, FleetScan, CovOp
+from Core.maps import PlanetScan, DevScan, UnitScan, FleetScan, CovOp, LatestScan
+from Core.pusher import push
 
 scanre=re.compile("https?://[^/]+/(?:showscan|waves).pl\?scan_id=([0-9a-zA-Z]+)")
 scangrpre=re.compile("https?://[^/]+/(?:showscan|waves).pl\?scan_grp=([0-9a-zA-Z]+)")
 
-class push(object):
-    # Robocop message pusher
-    def __init__(self, line, **kwargs):
-        line = " ".join([line] + map(lambda i: "%s=%s"%i, kwargs.items()))
-        port = Config.getint("Misc", "robocop")
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(30)
-        sock.connect(("127.0.0.1", port,))
-        sock.send(line + CRLF)
-
-class parse(Thread):
+class scanpool(object):
+    # Scans are queued for a fixed number of worker threads instead of each
+    #  getting a thread of its own. Each worker keeps its connections to the
+    #  game server open between scans.
+    def __init__(self, workers):
+        self.workers = workers
+        self.threads = []
+        self.queue = Queue()
+        self.queued = set()
+        self.lock = Lock()
+        self.connections = local()
+        self.parsed = 0
+        self.waited = 0.0
+        self.taken = 0.0
+        self.slowest = 0.0
+    
+    def put(self, job):
+        # Returns False if the scan or group is already waiting or being parsed
+        with self.lock:
+            if (job.type, job.id,) in self.queued:
+                return False
+            self.queued.add((job.type, job.id,))
+            while len(self.threads) < self.workers:
+                thread = Thread(target=self.work, name="scanpool-%s" % (len(self.threads)+1,))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        job.queued = time()
+        self.queue.put(job)
+        return True
+    
+    def work(self):
+        while True:
+            job = self.queue.get()
+            t_start = time()
+            try:
+                job.run()
+            finally:
+                with self.lock:
+                    self.queued.discard((job.type, job.id,))
+                    self.parsed += 1
+                    self.waited += t_start - job.queued
+                    self.taken += time() - t_start
+                    self.slowest = max(self.slowest, time() - job.queued)
+                self.queue.task_done()
+    
+    def join(self):
+        # Wait for everything queued so far to be parsed
+        self.queue.join()
+    
+    def fetch(self, url, redirects=5):
+        scheme, host, path, query, fragment = urlparse.urlsplit(url)
+        if query:
+            path += "?" + query
+        if not hasattr(self.connections, "hosts"):
+            self.connections.hosts = {}
+        for retry in (False, True,):
+            conn = self.connections.hosts.get((scheme, host,))
+            if conn is None:
+                conn = (httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection)(host, timeout=30)
+                self.connections.hosts[(scheme, host,)] = conn
+            try:
+                conn.request("GET", path, headers={"User-Agent": parse.useragent})
+                response = conn.getresponse()
+                page = response.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                # The server may have dropped the idle connection, so try again on a new one
+                conn.close()
+                del self.connections.hosts[(scheme, host,)]
+                if retry:
+                    raise
+        if response.status in (301, 302, 303, 307,) and response.getheader("Location") and redirects:
+            return self.fetch(urlparse.urljoin(url, response.getheader("Location")), redirects-1)
+        if response.status != 200:
+            raise IOError("HTTP %s %s for %s" % (response.status, response.reason, url,))
+        return page
+    
+    def stats(self):
+        with self.lock:
+            average = (self.waited + self.taken) / self.parsed if self.parsed else 0
+            return "%s queued, %s being parsed by %s workers. %s parsed, averaging %.1fs queued and %.1fs parsing (%.1fs total), slowest %.1fs" % (
+                        self.queue.qsize(), len(self.queued) - self.queue.qsize(), self.workers, self.parsed,
+                        self.waited / self.parsed if self.parsed else 0, self.taken / self.parsed if self.parsed else 0, average, self.slowest,)
+
+class parse(object):
     useragent = "Merlin (Python-urllib/%s); Alliance/%s; BotNick/%s; Admin/%s" % (urllib2.__version__, Config.get("Alliance", "name"),
                                                                               Config.get("Connection", "nick"), Config.items("Admins")[0][0])
     def __init__(self, uid, type, id, share=True):
@@ -53,11 +133,15 @@ class parse(Thread):
         self.type = type
         self.id = id
         self.share = share
-        Thread.__init__(self)
+    
+    def start(self):
+        if not pool.put(self):
+            scanlog("%s %s is already queued" % (self.type.capitalize(), self.id,))
     
     def run(self):
         scanlog(asctime())
         t_start=time()
+        scanlog("Waited %.3f seconds in the scan queue" % (t_start - self.queued,))
         
         uid = self.uid
         type = self.type
@@ -71,7 +155,7 @@ class parse(Thread):
             scanlog("Exception in scan: %s"%(str(e),), traceback=True)
         
         t1=time()-t_start
-        scanlog("Total time taken: %.3f seconds" % (t1,), spacing=True)
+        scanlog("Total time taken: %.3f seconds" % (t1,), spacing=True, type=type, id=id, seconds=t1, queued=t_start - self.queued)
         session.remove()
     
     def group(self, uid, gid):
@@ -79,16 +163,13 @@ class parse(Thread):
         if not self.share and session.query(Scan).filter(Scan.group_id == gid).count() > 0:
             return
         scanlog("Group scan: %s" %(gid,))
-        req = urllib2.Request(Config.get("URL","viewgroup")%(gid,)+"&inc=1")
-        req.add_header("User-Agent", self.useragent)
-        page = urllib2.urlopen(req).read()
+        page = pool.fetch(Config.get("URL","viewgroup")%(gid,)+"&inc=1")
+        pages = []
         for scan in page.split("<hr>"):
             m = re.search('scan_id=([0-9a-zA-Z]+)',scan)
             if m:
-                try:
-                    self.execute(scan, uid, m.group(1), gid)
-                except Exception, e:
-                    scanlog("Exception in scan: %s"%(str(e),), traceback=True)
+                pages.append((m.group(1), scan,))
+        self.execute(pages, uid, gid)
         if self.share:
             push("sharescan", pa_id=gid, group=True)
     
@@ -96,21 +177,16 @@ class parse(Thread):
         # Skip duplicate scans (unless something went wrong last time)
         if session.query(Scan).filter(Scan.pa_id == pa_id).filter(Scan.planet_id != None).count() > 0:
             return
-        req = urllib2.Request(Config.get("URL","viewscan")%(pa_id,)+"&inc=1")
-        req.add_header("User-Agent", self.useragent)
-        page = urllib2.urlopen(req).read()
-        self.execute(page, uid, pa_id, gid)
+        page = pool.fetch(Config.get("URL","viewscan")%(pa_id,)+"&inc=1")
+        self.execute([(pa_id, page,)], uid, gid)
         if self.share:
             push("sharescan", pa_id=pa_id)
     
-    def execute(self, page, uid, pa_id, gid=None):
-        scanlog("Scan: %s (group: %s)" %(pa_id,gid,))
-        page = decode(page)
-        
+    def header(self, page, pa_id):
         m = re.search('>([^>]+) on (\d+)\:(\d+)\:(\d+) in tick (\d+)', page)
         if not m:
             scanlog("Expired/non-matchinng scan (id: %s)" %(pa_id,))
-            return
+            return None
         
         scantype = m.group(1)[0].upper()
         x = int(m.group(2))
@@ -121,66 +197,119 @@ class parse(Thread):
         m = re.search("<p class=\"right scan_time\">Scan time: ([^<]*)</p>", page)
         scantime = m.group(1)
         
-        planet = Planet.load(x,y,z,)
-
-        try:
-            Q = session.query(Scan).filter(Scan.pa_id == pa_id).filter(Scan.planet_id == None)
-            if Q.count() > 0:
-                scan = Q.first()
-            else:
-                scan = Scan(pa_id=pa_id, scantype=scantype, tick=tick, time=scantime, group_id=gid, scanner_id=uid)
+        return scantype, x, y, z, tick, scantime
+    
+    def execute(self, pages, uid, gid=None):
+        # Every scan is read before anything is stored, so the planets, earlier
+        #  attempts and open requests for a whole group are one query each.
+        #  Each scan is stored under a savepoint, so one bad scan doesn't
+        #  lose the rest of the group, and it's all committed together.
+        scans = []
+        for pa_id, page in pages:
+            scanlog("Scan: %s (group: %s)" %(pa_id,gid,))
+            try:
+                page = decode(page)
+                header = self.header(page, pa_id)
+            except Exception, e:
+                scanlog("Exception in scan: %s"%(str(e),), traceback=True)
+                continue
+            if header is not None:
+                scans.append((pa_id, page,) + header)
+        if len(scans) < 1:
+            return
+        
+        Q = session.query(Planet)
+        Q = Q.filter(Planet.active == True)
+        Q = Q.filter(tuple_(Planet.x, Planet.y, Planet.z).in_(list(set([s[3:6] for s in scans]))))
+        planets = dict((((p.x, p.y, p.z,), p) for p in Q.all()))
+        
+        Q = session.query(Scan)
+        Q = Q.filter(Scan.pa_id.in_([s[0] for s in scans]))
+        Q = Q.filter(Scan.planet_id == None)
+        unparsed = dict(((s.pa_id, s) for s in Q.all()))
+        
+        stored = []
+        for pa_id, page, scantype, x, y, z, tick, scantime in scans:
+            planet = planets.get((x,y,z,))
+            
+            session.begin_nested()
+            try:
+                scan = unparsed.get(pa_id) or Scan(pa_id=pa_id, scantype=scantype, tick=tick, time=scantime, group_id=gid, scanner_id=uid)
                 session.add(scan)
-            if planet:
-                planet.scans.append(scan)
+                if planet:
+                    planet.scans.append(scan)
+                session.flush()
+            except IntegrityError, e:
+                session.rollback()
+                scanlog("Scan %s may already exist: %s" %(pa_id,str(e),))
+                continue
+            
+            if planet is None:
+                session.commit()
+                scanlog("No planet found. Check the bot is ticking. Scan will be tried again at next tick.")
+                continue
+            
+            scanlog("%s %s:%s:%s" %(PA.get(scantype,"name"), x,y,z,))
+            
+            parser = {
+                      "P": self.parse_P,
+                      "D": self.parse_D,
+                      "U": self.parse_U,
+                      "A": self.parse_U,
+                      "J": self.parse_J,
+                      "N": self.parse_N,
+                     }.get(scantype)
+            try:
+                if parser is not None:
+                    parser(scan.id, scan, page)
+                session.commit()
+            except Exception, e:
+                session.rollback()
+                scanlog("Exception in scan: %s"%(str(e),), traceback=True)
+                continue
+            stored.append((scan, planet,))
+        
+        if len(stored) < 1:
             session.commit()
-            scan_id = scan.id
-        except IntegrityError, e:
-            session.rollback()
-            scanlog("Scan %s may already exist: %s" %(pa_id,str(e),))
             return
-
-        if planet is None:
-            scanlog("No planet found. Check the bot is ticking. Scan will be tried again at next tick.")
-            return
-        
-        scanlog("%s %s:%s:%s" %(PA.get(scantype,"name"), x,y,z,))
         
-        parser = {
-                  "P": self.parse_P,
-                  "D": self.parse_D,
-                  "U": self.parse_U,
-                  "A": self.parse_U,
-                  "J": self.parse_J,
-                  "N": self.parse_N,
-                 }.get(scantype)
-        if parser is not None:
-            parser(scan_id, scan, page)
+        LatestScan.refresh([scan for scan, planet in stored])
         
         Q = session.query(Request)
-        Q = Q.filter(Request.scantype==scantype)
-        Q = Q.filter(Request.target==planet)
+        Q = Q.filter(Request.planet_id.in_(list(set([planet.id for scan, planet in stored]))))
         Q = Q.filter(Request.scan==None)
         Q = Q.filter(Request.active==True)
-        Q = Q.filter(Request.tick<=tick + PA.getint(scan.scantype,"expire"))
         result = Q.all()
         
-        users = []
         req_ids = []
+        old_ids = []
         for request in result:
-            if tick >= request.tick:
-                scanlog("Scan %s matches request %s for %s" %(pa_id, request.id, request.user.name,))
-                request.scan_id = scan_id
-                request.active = False
-                users.append(request.user.name)
-                req_ids.append(str(request.id))
+            matches = [scan for scan, planet in stored if scan.scantype == request.scantype and planet.id == request.planet_id
+                                                           and request.tick <= scan.tick + PA.getint(scan.scantype,"expire")]
+            for scan in matches:
+                if scan.tick >= request.tick:
+                    scanlog("Scan %s matches request %s for %s" %(scan.pa_id, request.id, request.user.name,))
+                    request.scan_id = scan.id
+                    request.active = False
+                    req_ids.append(str(request.id))
+                    break
             else:
-                scanlog("Scan %s matches request %s for %s but is old." %(pa_id, request.id, request.user.name,))
-                push("scans", scantype=scantype, pa_id=pa_id, x=planet.x, y=planet.y, z=planet.z, names=request.user.name, scanner=uid, reqs=request.id, old=True)
-                
+                if matches:
+                    scanlog("Scan %s matches request %s for %s but is old." %(matches[0].pa_id, request.id, request.user.name,))
+                    old_ids.append("%s:%s" % (request.id, matches[0].pa_id,))
+        
         session.commit()
         
-        if len(users) > 0:
-            push("scans", scantype=scantype, pa_id=pa_id, x=planet.x, y=planet.y, z=planet.z, names=",".join(users), scanner=uid, reqs=",".join(req_ids))
+        if len(req_ids) > 0 or len(old_ids) > 0:
+            push("scans", scanner=uid, reqs=",".join(req_ids), old=",".join(old_ids))
+
+    def fleet(self, fleetscan):
+        # Fleets are unique, so check for the same fleet from an earlier scan
+        #  here rather than waiting for an IntegrityError on commit
+        Q = session.query(FleetScan)
+        Q = Q.filter_by(owner_id=fleetscan.owner.id, target_id=fleetscan.target.id, fleet_size=fleetscan.fleet_size,
+                        fleet_name=fleetscan.fleet_name, landing_tick=fleetscan.landing_tick, mission=fleetscan.mission)
+        return Q.first()
 
     def parse_P(self, scan_id, scan, page):
         planetscan = scan.planetscan = PlanetScan()
@@ -233,8 +362,6 @@ class parse(Thread):
         planetscan.prod_res=m[0]
         planetscan.sold_res=m[1]
 
-        session.commit()
-
     def parse_D(self, scan_id, scan, page):
         devscan = scan.devscan = DevScan()
 
@@ -286,17 +413,13 @@ class parse(Thread):
         devscan.covert_op = m.group(6)
         devscan.mining = m.group(7)
 
-        session.commit()
-
         if scan.planet.intel is None:
             scan.planet.intel = Intel()
         if (scan.planet.intel.dists < devscan.wave_distorter) or (scan.tick == Updates.current_tick()):
             scan.planet.intel.dists = devscan.wave_distorter
-            session.commit()
             scanlog("Updating planet-intel-dists")
         if (scan.planet.intel.amps < devscan.wave_amplifier) or (scan.tick == Updates.current_tick()):
             scan.planet.intel.amps = devscan.wave_amplifier
-            session.commit()
             scanlog("Updating planet-intel-amps")
 
     def parse_U(self, scan_id, scan, page):
@@ -309,8 +432,6 @@ class parse(Thread):
                 continue
             scan.units.append(UnitScan(ship=ship, amount=m.group(2).replace(',', '')))
 
-        session.commit()
-
     def parse_J(self, scan_id, scan, page):
         # <td class=left>Origin</td><td class=left>Mission</td><td>Fleet</td><td>ETA</td><td>Fleetsize</td>
         # <td class=left>13:10:5</td><td class=left>Attack</td><td>Gamma</td><td>5</td><td>265</td>
@@ -348,25 +469,12 @@ class parse(Thread):
             fleetscan.in_cluster = fleetscan.owner.x == fleetscan.target.x
             fleetscan.in_galaxy = fleetscan.in_cluster and fleetscan.owner.y == fleetscan.target.y
 
-            try:
-                scan.fleets.append(fleetscan)
-                session.commit()
-            except IntegrityError, e:
-                session.rollback()
-                scanlog("Caught integrity exception in jgp: %s"%(str(e),))
-                scanlog("Trying to update instead")
-                query = session.query(FleetScan).filter_by(owner=attacker, target=scan.planet, fleet_size=fleetsize, fleet_name=fleet, landing_tick=eta+scan.tick, mission=mission)
-                try:
-                    query.update({"scan_id": scan_id})
-                    session.commit()
-                except Exception, e:
-                    session.rollback()
-                    scanlog("Exception trying to update jgp: %s"%(str(e),), traceback=True)
-                    continue
-            except Exception, e:
-                session.rollback()
-                scanlog("Exception in jgp: %s"%(str(e),), traceback=True)
+            existing = self.fleet(fleetscan)
+            if existing is not None:
+                scanlog("Fleet already seen in jgp, updating instead")
+                existing.scan_id = scan_id
                 continue
+            scan.fleets.append(fleetscan)
 
     def parse_N(self, scan_id, scan, page):
         #incoming fleets
@@ -396,13 +504,9 @@ class parse(Thread):
             fleetscan.in_cluster = fleetscan.owner.x == fleetscan.target.x
             fleetscan.in_galaxy = fleetscan.in_cluster and fleetscan.owner.y == fleetscan.target.y
 
-            try:
-                scan.fleets.append(fleetscan)
-                session.commit()
-            except Exception, e:
-                session.rollback()
-                scanlog("Exception in news: %s"%(str(e),), traceback=True)
+            if self.fleet(fleetscan) is not None:
                 continue
+            scan.fleets.append(fleetscan)
 
             scanlog('Incoming: ' + newstick + ':' + fleetname + '-' + originx + ':' + originy + ':' + originz + '-' + arrivaltick + '|' + numships)
 
@@ -431,13 +535,9 @@ class parse(Thread):
             fleetscan.in_cluster = fleetscan.owner.x == fleetscan.target.x
             fleetscan.in_galaxy = fleetscan.in_cluster and fleetscan.owner.y == fleetscan.target.y
 
-            try:
-                scan.fleets.append(fleetscan)
-                session.commit()
-            except Exception, e:
-                session.rollback()
-                scanlog("Exception in news: %s"%(str(e),), traceback=True)
+            if self.fleet(fleetscan) is not None:
                 continue
+            scan.fleets.append(fleetscan)
 
             scanlog('Attack:' + newstick + ':' + fleetname + ':' + originx + ':' + originy + ':' + originz + ':' + arrivaltick)
 
@@ -466,13 +566,9 @@ class parse(Thread):
             fleetscan.in_cluster = fleetscan.owner.x == fleetscan.target.x
             fleetscan.in_galaxy = fleetscan.in_cluster and fleetscan.owner.y == fleetscan.target.y
 
-            try:
-                scan.fleets.append(fleetscan)
-                session.commit()
-            except Exception, e:
-                session.rollback()
-                scanlog("Exception in news: %s"%(str(e),), traceback=True)
+            if self.fleet(fleetscan) is not None:
                 continue
+            scan.fleets.append(fleetscan)
 
             scanlog('Defend:' + newstick + ':' + fleetname + ':' + originx + ':' + originy + ':' + originz + ':' + arrivaltick)
 
@@ -501,13 +597,7 @@ class parse(Thread):
             covop.covopper = covopper
             covop.target = scan.planet
 
-            try:
-                scan.covops.append(covop)
-                session.commit()
-            except Exception, e:
-                session.rollback()
-                scanlog("Exception in unit: %s"%(str(e),), traceback=True)
-                continue
+            scan.covops.append(covop)
 
             scanlog('Security:' + newstick + ':' + ruler + ':' + originx + ':' + originy + ':' + originz)
 
@@ -536,3 +626,9 @@ class parse(Thread):
         #<table width=500><tr><th class=left>Asteroids Captured</th><th class=left>Metal : 37</th><th class=left>Crystal : 36</th><th class=left>Eonium : 34</th></tr></table>
         #
         #</td></tr>
+
+# Keep the running pool when this module is reloaded, so its workers aren't left behind
+try:
+    pool
+except NameError:
+    pool = scanpool(Config.getint("Misc", "scanworkers") if Config.has_option("Misc", "scanworkers") else 8)
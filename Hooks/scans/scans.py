@@ -19,11 +19,11 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
  
+from sqlalchemy.sql import asc
 from sqlalchemy.sql.functions import count, max
 from Core.config import Config
-from Core.paconf import PA
 from Core.db import session
-from Core.maps import Planet, User, Scan
+from Core.maps import Planet, User, Scan, Request
 from Core.chanusertracker import CUT
 from Core.loadable import loadable, route, robohci
 
@@ -55,27 +55,52 @@ class scans(loadable):
         message.reply(reply)
     
     @robohci
-    def robocop(self, message, scantype, pa_id, x, y, z, names, scanner, reqs, old=False):
-        nicks = []
-        reply = "Old " if old else ""
-        reply += "%s on %s:%s:%s " % (PA.get(scantype,"name"),x,y,z,)
-        if ("showscanner" in Config.options("Misc") and Config.getboolean("Misc", "showscanner") and scanner != 'None'):
-            reply+= "from %s " % (User.load(id=scanner).name) if User.load(id=scanner) not in (None, 'None') else ""
-        reply += Config.get("URL","viewscan") % (pa_id,)
-        if old:
-            reply += " !request cancel %s if this is suitable." % (reqs)
+    def robocop(self, message, scanner, reqs="", old=""):
+        # All of the requests matched by a scan or a whole scan group arrive
+        #  together, so each user gets one message for all of their scans
+        scanner = User.load(id=scanner) if scanner != 'None' and ("showscanner" in Config.options("Misc") and Config.getboolean("Misc", "showscanner")) else None
+        old = dict([o.split(":") for o in old.split(",") if o])
+        ids = [int(id) for id in reqs.split(",") + old.keys() if id]
+        if len(ids) < 1:
+            return
+        
+        Q = session.query(Request)
+        Q = Q.filter(Request.id.in_(ids))
+        Q = Q.order_by(asc(Request.id))
+        
+        replies = {}
+        delivered = []
+        for req in Q.all():
+            pa_id = old.get(str(req.id))
+            reply = "Old " if pa_id else ""
+            reply += "%s on %s:%s:%s " % (req.type, req.target.x, req.target.y, req.target.z,)
+            reply += "from %s " % (scanner.name,) if scanner else ""
+            reply += Config.get("URL","viewscan") % (pa_id or req.scan.pa_id,)
+            if pa_id:
+                reply += " !request cancel %s if this is suitable." % (req.id,)
+            else:
+                for scan, matched in delivered:
+                    if scan == req.scan:
+                        matched.append(req)
+                        break
+                else:
+                    delivered.append((req.scan, [req],))
+            replies.setdefault(req.user, []).append(reply)
         
-        for name in names.split(","):
-            user = User.load(name)
-            for nick in CUT.get_user_nicks(name):
-                nicks.append(nick)
-                message.privmsg(self.url(reply, user), nick)
+        nicks = {}
+        for user, reply in replies.items():
+            nicks[user] = sorted(CUT.get_user_nicks(user.name))
+            for nick in nicks[user]:
+                message.privmsg(self.url(" | ".join(reply), user), nick)
         
-        if not old:
-            reply = "[-%s] %s on %s:%s:%s " % (reqs,PA.get(scantype,"name"),x,y,z,)
-            reply+= "delivered to: "
-            reply+= ", ".join(nicks) if not Config.getboolean("Misc", "anonscans") else "Anon"
+        reply = []
+        for scan, matched in delivered:
+            line = "[-%s] %s on %s:%s:%s " % (",".join([str(r.id) for r in matched]), scan.type, scan.planet.x, scan.planet.y, scan.planet.z,)
+            line += "delivered to: "
+            line += ", ".join(sorted(set(sum([nicks[r.user] for r in matched], [])))) if not Config.getboolean("Misc", "anonscans") else "Anon"
             if Config.getboolean("Misc", "showurls"):
-                reply += " (%s)" % (Config.get("URL","viewscan") % (pa_id,))
+                line += " (%s)" % (scan.link,)
+            reply.append(line)
+        if len(reply) > 0:
             from Hooks.scans.request import request
-            message.privmsg(reply, request().scanchan())
+            message.privmsg(" | ".join(reply), request().scanchan())
@@ -0,0 +1,62 @@
+# This file is part of Merlin.
+# Merlin is the Copyright (C)2008,2009,2010 of Robin K. Hansen, Elliot Rosemarine, Andreas Jacobsen.
+
+# Individual portions may be copyright by individual contributors, and
+# are included in this collective work with permission of the copyright
+# owners.
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+from Core.maps import TickTiming
+from Core.loadable import loadable, route
+
+class tickperf(loadable):
+    """Show how long each stage of the last tick took compared to the previous ticks (24 by default). Stages that took more than 50% longer than average are flagged. Give a stage name to see its recent timings."""
+    usage = " [ticks] | <stage> [ticks]"
+    access = "admin"
+    slower = 1.5
+
+    @route(r"(\d+)?")
+    def latest(self, message, user, params):
+        ticks = int(params.group(1) or 24)
+        tick, stages = TickTiming.stages(ticks)
+        if tick is None:
+            message.reply("No tick timings have been recorded yet")
+            return
+
+        total = sum([s[1] for s in stages])
+        slow = [s for s in stages if s[2] and s[1] > s[2] * self.slower]
+
+        reply = "Tick %s took %.1fs over %s stages." % (tick, total, len(stages),)
+        if slow:
+            reply += " Slower than the last %s ticks: " % (ticks,)
+            reply += ", ".join(["%s %.2fs (avg %.2fs, +%d%%)" % (s[0], s[1], s[2], (s[1] / s[2] - 1) * 100,) for s in slow])
+        else:
+            reply += " No stages slower than the last %s ticks. Slowest: " % (ticks,)
+            reply += ", ".join(["%s %.2fs" % (s[0], s[1],) for s in stages[:5]])
+        message.reply(reply)
+
+    @route(r"(.*?\D.*?)(?:\s+(\d+))?")
+    def stage(self, message, user, params):
+        stage = params.group(1)
+        ticks = int(params.group(2) or 24)
+        history = TickTiming.history("%"+stage+"%", ticks)
+        if len(history) < 1:
+            message.reply("No timings recorded for stages matching '%s'" % (stage,))
+            return
+
+        reply = "Timings matching '%s' (newest first): " % (stage,)
+        reply += ", ".join(["pt%s %s %.2fs" % (tick, name, seconds,) for tick, name, seconds in history])
+        message.reply(reply)
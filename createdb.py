@@ -24,7 +24,7 @@ import sqlalchemy
 from sqlalchemy.exc import DBAPIError, IntegrityError, ProgrammingError
 from sqlalchemy.sql import text, bindparam
 from Core.config import Config
-from Core.db import Base, session
+from Core.db import Base, engine, session
 import shipstats
 
 mysql = Config.get("DB", "dbms") == "mysql"
@@ -33,6 +33,29 @@ mysql = Config.get("DB", "dbms") == "mysql"
 old_prefix = Config.get('DB', 'prefix')
 prefix = Config.get('DB', 'prefix')
 
+def trigrams():
+    # The trigram indexes need the pg_trgm extension, from postgresql-contrib.
+    #  If it can't be created they're left out, and the lookups using them
+    #  scan the table instead.
+    try:
+        schema = session.execute(text("SELECT nspname FROM pg_extension JOIN pg_namespace ON pg_namespace.oid = extnamespace WHERE extname = 'pg_trgm';")).scalar()
+        if schema is None:
+            session.execute(text("CREATE EXTENSION pg_trgm;"))
+        elif schema != "public":
+            # It went with an old round's schema
+            session.execute(text("ALTER EXTENSION pg_trgm SET SCHEMA public;"))
+    except DBAPIError, e:
+        session.rollback()
+        print "Unable to create the pg_trgm extension, skipping the trigram indexes: %s" % (str(e).strip(),)
+        for table in Base.metadata.sorted_tables:
+            for index in list(table.indexes):
+                if "gin_trgm_ops" in index.kwargs.get("postgresql_ops", {}).values():
+                    table.indexes.discard(index)
+    else:
+        session.commit()
+    finally:
+        session.close()
+
 if len(sys.argv) > 2 and sys.argv[1] == "--migrate":
     round = sys.argv[2]
     if round.isdigit():
@@ -40,11 +63,44 @@ if len(sys.argv) > 2 and sys.argv[1] == "--migrate":
     noschema= (len(sys.argv) > 3 and sys.argv[3] == "--noschema")
 elif len(sys.argv) > 1 and sys.argv[1] == "--new":
     round = None
+elif len(sys.argv) > 1 and sys.argv[1] in ("--upgrade", "--indexes",) and not mysql:
+    # Bring the current round's tables up to date with the models, without
+    #  touching the data already in them
+    print "Importing database models"
+    from Core.maps import Updates, LatestScan
+    trigrams()
+    print "Creating new tables"
+    Base.metadata.create_all(checkfirst=True)
+    
+    # Columns added to existing tables
+    columns = {Updates.__table__: ("galaxy_etag", "galaxy_modified", "alliance_etag", "alliance_modified", "feed_etag", "feed_modified",),}
+    for table, names in columns.items():
+        existing = set([name for name, in session.execute(text("SELECT column_name FROM information_schema.columns WHERE table_schema = 'public' AND table_name = :table;"), {"table": table.name})])
+        for name in names:
+            if name not in existing:
+                print "Adding column %s to %s" % (name, table.name,)
+                type = table.c[name].type.compile(dialect=engine.dialect)
+                session.execute(text("ALTER TABLE %s ADD COLUMN %s %s;" % (table.name, name, type,)))
+    
+    # Indexes added to the models since the tables were created
+    existing = set([name for name, in session.execute(text("SELECT indexname FROM pg_indexes WHERE schemaname = 'public';"))])
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in existing:
+                print "Creating index %s on %s" % (index.name, table.name,)
+                index.create(session.connection())
+    session.commit()
+    
+    print "Filling the latest scans"
+    LatestScan.rebuild()
+    session.close()
+    sys.exit()
 else:
     print "To setup a database for a new Merlin install: createdb.py --new"
     print "To migrate without saving previoud round data: createdb.py --migrate temp"
     print "To migrate from an old round use: createdb.py --migrate <previous_round>"
     print "For multiple bots sharing a DB, after the first migration use: createdb.py --migrate <previous_round> --noschema"
+    print "To add new tables, columns and indexes to an existing database: createdb.py --upgrade"
     sys.exit()
 
 if round and not mysql and not noschema:
@@ -74,6 +130,8 @@ if not mysql:
     finally:
         session.close()
 
+if not mysql:
+    trigrams()
 Base.metadata.create_all()
 
 print "Setting up default channels"
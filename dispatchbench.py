@@ -0,0 +1,68 @@
+# Dispatcher benchmark for merlin
+#
+# Feeds channel chatter and unknown commands through Callbacks.callback() and
+#  reports the lines per second handled by the command index, next to the old
+#  approach of offering every line to every hooked loadable.
+# Lines come from users who aren't authed, so no database queries are made and
+#  nothing is sent to IRC.
+#
+# Usage: python dispatchbench.py [rounds]
+
+import sys
+import time
+
+from Core.loader import Loader
+from Core import Merlin
+from Core.config import Config
+from Core.db import session
+from Core.connection import Connection
+from Core.actions import Action
+from Core.callbacks import Callbacks
+
+Merlin.attach(irc=(None, Config.get("Connection", "nick")))
+# Compare against every hook, not just those imported so far
+Callbacks.wake_all()
+
+lines = [":someone!user@host.example.com PRIVMSG #channel :anyone around?",
+         ":someone!user@host.example.com PRIVMSG #channel :lookup 1:1:1 has a lot of roids",
+         ":other!user@host.example.com PRIVMSG #channel :we should hit 4:5 tonight, they're asleep",
+         ":other!user@host.example.com PRIVMSG #channel :!notacommand with some params",
+         ":another!user@host.example.com PRIVMSG #channel :haha",
+         ":another!user@host.example.com PRIVMSG #channel :~wrongcommand",
+         ":someone!user@host.example.com PRIVMSG %s :hi" % (Merlin.nick,),
+         ":another!user@host.example.com PRIVMSG #channel :! spaced out",
+        ]
+
+messages = []
+for line in lines:
+    message = Action()
+    message.parse(line)
+    messages.append(message)
+
+def linear(message):
+    # The dispatcher before commands were indexed
+    for callback in Callbacks.callbacks.get(message.get_command(), []):
+        try:
+            callback(message)
+        finally:
+            session.remove()
+
+def bench(dispatch, rounds):
+    start = time.time()
+    for i in xrange(rounds):
+        for message in messages:
+            dispatch(message)
+    return len(messages) * rounds / (time.time() - start)
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    try:
+        print "%s PRIVMSG callbacks, %s catch-alls, %s lines x %s rounds" % (len(Callbacks.callbacks.get("PRIVMSG", [])), len(Callbacks.catchalls.get("PRIVMSG", [])), len(messages), rounds,)
+        indexed = bench(Callbacks.callback, rounds)
+        print "Indexed: %10.1f lines/sec" % (indexed,)
+        old = bench(linear, rounds)
+        print "Linear:  %10.1f lines/sec" % (old,)
+        print "Speedup: %10.1fx" % (indexed / old,)
+    finally:
+        # Let the output thread exit
+        Connection.quitting = True
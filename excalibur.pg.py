@@ -20,16 +20,18 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
  
 import datetime, re, sys, time, traceback, urllib2, shutil, os, errno, socket
+from threading import Thread
 from sqlalchemy.sql import text, bindparam
-from sqlalchemy import and_
 from sqlalchemy.sql.functions import max as max_
 from Core.config import Config
 from Core.paconf import PA
-from Core.string import decode, excaliburlog, errorlog, CRLF
-from Core.db import true, false, session
-from Core.maps import Updates, galpenis, apenis, Scan, Planet, Alliance, PlanetHistory, GalaxyHistory, Feed, War
-from Core.maps import galaxy_temp, planet_temp, alliance_temp
-from Hooks.scans.parser import parse
+from Core.string import decode, encode, excaliburlog, errorlog
+from Core.db import true, false, Base, session
+from Core.maps import Updates, TickTiming, galpenis, apenis, Scan, Alliance, PlanetHistory, GalaxyHistory, Feed, War
+from Core.maps import galaxy_temp, planet_temp, alliance_temp, history_partition
+from Core.pusher import deliver
+from Core import graphs
+from Hooks.scans.parser import parse, pool
 from ConfigParser import ConfigParser as CP
 
 # ########################################################################### #
@@ -41,6 +43,14 @@ from ConfigParser import ConfigParser as CP
 # Config files (absolute or relative paths) for all bots to be updated by this excalibur
 configs = ['merlin.cfg']
 savedumps = False
+# Dump requests are retried this many times, backing off from fetch_backoff seconds
+fetch_retries = 3
+fetch_backoff = 5
+fetch_timeout = 60
+# Ticks replayed by --rebuild are committed in batches of this many
+rebuild_batch = 24
+# Load the temp tables with a single streamed COPY FROM STDIN instead of one INSERT per row
+copydumps = True
 useragent = "Merlin (Python-urllib/%s); Alliance/%s; BotNick/%s; Admin/%s" % (urllib2.__version__, Config.get("Alliance", "name"), 
                                                                               Config.get("Connection", "nick"), Config.items("Admins")[0][0])
 catchup_enabled = Config.getboolean("Misc", "catchup")
@@ -55,10 +65,29 @@ class DefaultErrorHandler(urllib2.HTTPDefaultErrorHandler):
         result.status = code
         return result 
 
-class botfile:
+# Stage timings for the current tick, stored in tick_timing by save_timings()
+timings = []
+
+def stagelog(stage, seconds):
+    excaliburlog("%s in %.3f seconds" % (stage, seconds,), stage=stage, seconds=seconds)
+    timings.append((stage, seconds,))
+
+def save_timings(tick, commit=True):
+    if timings:
+        session.execute(TickTiming.__table__.insert(), [{"tick":tick, "stage":stage, "seconds":seconds} for stage, seconds in timings])
+        if commit:
+            session.commit()
+    del timings[:]
+
+class botfile(object):
+    # Only the header is read up front, the body is parsed lazily
+    #  off the stream as it is iterated over
+    columns = ()
+    
     def __init__(self, page):
+        self.page = page
         self.header = {}
-        self.body = []
+        self.body = None
 
         # Parse header
         line = page.readline().strip()
@@ -83,13 +112,61 @@ class botfile:
         if not self.header.has_key("EOF"):
             self.header["EOF"] = None
 
-        line = page.readline().strip()
-        while line != self.header["EOF"]:
-            self.body.append(line)
-            line = page.readline().strip()
+    def lines(self):
+        # Raw body lines, up to the EOF marker
+        if self.body is not None:
+            for line in self.body:
+                yield line
+            return
+        while True:
+            line = self.page.readline()
+            if not line:
+                if self.header["EOF"] is not None:
+                    raise TypeError("Dump for tick %s ended without EOF marker." % (self.tick,))
+                return
+            line = line.strip()
+            if line == self.header["EOF"]:
+                return
+            if line:
+                yield line
+
+    def buffer(self):
+        # Read the rest of the body now, for dumps that won't be used for a while
+        self.body = list(self.lines())
+        return self
 
     def __iter__(self):
-        return iter(self.body)
+        for line in self.lines():
+            yield self.record(decode(line).strip().split(self.header["Separator"]))
+
+    def record(self, fields):
+        return tuple(fields)
+
+class planetfile(botfile):
+    columns = ("id", "x", "y", "z", "planetname", "rulername", "race", "size", "score", "value", "xp", "special",)
+    def record(self, p):
+        return (p[0].strip("\""), int(p[1]), int(p[2]), int(p[3]), p[4].strip("\""), p[5].strip("\""), p[6],
+                int(p[7] or 0), int(p[8] or 0), int(p[9] or 0), int(p[10] or 0), p[11].strip("\""),)
+
+class galaxyfile(botfile):
+    columns = ("x", "y", "name", "size", "score", "value", "xp",)
+    def record(self, g):
+        return (int(g[0]), int(g[1]), g[2].strip("\""), int(g[3] or 0), int(g[4] or 0), int(g[5] or 0), int(g[6] or 0),)
+
+class alliancefile(botfile):
+    columns = ("score_rank", "name", "size", "members", "score", "points", "score_total", "value_total", "size_avg", "score_avg", "points_avg",)
+    tag_count = PA.getint("numbers", "tag_count")
+    def record(self, a):
+        size, members, score, points = int(a[2] or 0), int(a[3] or 1), int(a[4] or 0), int(a[5] or 0)
+        return (int(a[0]), a[1].strip("\""), size, members, score, points, int(a[6] or 0), int(a[7] or 0),
+                size / members, score / min(members, self.tag_count), points / members,)
+
+class feedfile(botfile):
+    columns = ("tick", "category", "text",)
+    def __iter__(self):
+        for line in self.lines():
+            [tick, category, content] = decode(line).strip().split(self.header["Separator"], 2)
+            yield (int(tick), category[1:-1], content[1:-1],)
 
 def push_message(bot, command, **kwargs):
 # Robocop message pusher
@@ -98,71 +175,165 @@ def push_message(bot, command, **kwargs):
         if k in ["text", "notice"]:
             kwargs[k] = "!#!" + kwargs[k].replace(" ", "!#!")
         args += ["%s=%s" % (k, kwargs[k])]
-    line = " ".join(args)
-    port = bot.getint("Misc", "robocop")
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.settimeout(30)
-    sock.connect(("127.0.0.1", port,))
-    sock.send(line + CRLF)
-    sock.close()
+    # Sent over a connection kept open to each bot
+    deliver(" ".join(args), bot.getint("Misc", "robocop"))
+
+def copy_value(value):
+    # Format a value for COPY's text format
+    if value is None:
+        return "\\N"
+    return encode(unicode(value)).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+class copybuffer(object):
+    # File-like object for COPY FROM STDIN, rows are only formatted
+    #  as the driver reads them so memory use stays flat
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = ""
+    
+    def next_line(self):
+        try:
+            return "\t".join(map(copy_value, self.rows.next())) + "\n"
+        except StopIteration:
+            return ""
+    
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            line = self.next_line()
+            if not line:
+                break
+            self.buffer += line
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+    
+    def readline(self, size=-1):
+        if "\n" not in self.buffer:
+            self.buffer += self.next_line()
+        i = self.buffer.find("\n") + 1 or len(self.buffer)
+        line, self.buffer = self.buffer[:i], self.buffer[i:]
+        return line
+
+def load_temp(table, dump):
+    # Fill a temp table from a parsed dump
+    columns = dump.columns
+    rows = iter(dump)
+    if copydumps:
+        # Use the session's connection so the COPY is part of the tick's transaction
+        cursor = session.connection().connection.cursor()
+        try:
+            cursor.copy_expert("COPY %s (%s) FROM STDIN;" % (table.name, ", ".join(columns)), copybuffer(rows))
+        finally:
+            cursor.close()
+    else:
+        tmplist = [dict(zip(columns, row)) for row in rows]
+        session.execute(table.insert(), tmplist) if tmplist else None
+
+class fetch(Thread):
+    # Opens a single dump feed, retrying with backoff on network errors
+    #  and server errors. The body is left on the stream for botfile.
+    def __init__(self, name, url, etag=None, modified=None, useragent=None):
+        Thread.__init__(self, name=name)
+        self.url = url
+        self.etag = etag
+        self.modified = modified
+        self.useragent = useragent
+        self.dump = None
+        self.error = None
+    
+    @property
+    def status(self):
+        # Only error responses have a status
+        return getattr(self.dump, "status", 200) if self.dump else None
+    
+    def run(self):
+        t_start = time.time()
+        opener = urllib2.build_opener(DefaultErrorHandler())
+        for attempt in range(fetch_retries):
+            req = urllib2.Request(self.url)
+            if self.etag:
+                req.add_header('If-None-Match', self.etag)
+            if self.modified:
+                req.add_header('If-Modified-Since', self.modified)
+            if self.useragent:
+                req.add_header('User-Agent', self.useragent)
+            try:
+                self.dump = opener.open(req, timeout=fetch_timeout)
+                self.error = None
+            except (urllib2.URLError, socket.error) as e:
+                self.dump = None
+                self.error = e
+            if self.dump is not None and self.status < 500:
+                break
+            if attempt + 1 < fetch_retries:
+                self.close()
+                time.sleep(fetch_backoff * 2 ** attempt)
+        self.time = time.time() - t_start
+    
+    def close(self):
+        # Release the connection when the body won't be read
+        if self.dump is not None:
+            self.dump.close()
 
 def get_dumps(last_tick, alt=False, useragent=None):
     if alt:
-       purl = Config.get("URL", "alt_plan") % (last_tick+1)
-       gurl = Config.get("URL", "alt_gal") % (last_tick+1)
-       aurl = Config.get("URL", "alt_ally") % (last_tick+1)
+        feeds = (("planets",   Config.get("URL", "alt_plan") % (last_tick+1)),
+                 ("galaxies",  Config.get("URL", "alt_gal") % (last_tick+1)),
+                 ("alliances", Config.get("URL", "alt_ally") % (last_tick+1)),)
     else:
-       purl = Config.get("URL", "planets")
-       gurl = Config.get("URL", "galaxies")
-       aurl = Config.get("URL", "alliances")
-       furl = Config.get("URL", "userfeed")
-
-    # Build the request for planet data
-    req = urllib2.Request(purl)
-    if last_tick > 0 and not alt:
-        u = Updates.load()
-        req.add_header('If-None-Match', u.etag)
-        req.add_header('If-Modified-Since', u.modified)
-    if useragent:
-        req.add_header('User-Agent', useragent)
-    opener = urllib2.build_opener(DefaultErrorHandler())
-    pdump = opener.open(req)
-    try:
-        if pdump.status == 304:
-            excaliburlog("Dump files not modified. Waiting...")
-            time.sleep(60)
-            return (False, False, False, False)
-        elif pdump.status == 404 and last_tick < alt:
-            # Dumps are missing from archive. Check for dumps for next tick
-            excaliburlog("Dump files missing. Looking for newer...")
-            return get_dumps(last_tick+1, alt, useragent)
-        else:
-            excaliburlog("Error: %s" % pdump.status)
-            time.sleep(120)
-            return (False, False, False, False)
-    except AttributeError:
-        pass
+        feeds = (("planets",   Config.get("URL", "planets")),
+                 ("galaxies",  Config.get("URL", "galaxies")),
+                 ("alliances", Config.get("URL", "alliances")),
+                 ("userfeed",  Config.get("URL", "userfeed")),)
 
-    # Open the dump files
-    try:
-        req = urllib2.Request(gurl)
-        req.add_header('User-Agent', useragent)
-        gdump = opener.open(req)
-        req = urllib2.Request(aurl)
-        req.add_header('User-Agent', useragent)
-        adump = opener.open(req)
-        if not alt:
-            req = urllib2.Request(furl)
-            req.add_header('User-Agent', useragent)
-            udump = opener.open(req)
+    # Each feed is conditional on the headers it had last tick
+    u = Updates.load() if last_tick > 0 and not alt else None
+    conditional = {
+                   "planets":   (u.etag, u.modified,),
+                   "galaxies":  (u.galaxy_etag, u.galaxy_modified,),
+                   "alliances": (u.alliance_etag, u.alliance_modified,),
+                   "userfeed":  (u.feed_etag, u.feed_modified,),
+                  } if u else {}
+
+    # Fetch all the feeds at once
+    fetches = [fetch(name, url, *conditional.get(name, (None, None,)), useragent=useragent) for name, url in feeds]
+    for f in fetches:
+        f.start()
+    for f in fetches:
+        f.join()
+        excaliburlog("Fetched %s in %.3f seconds (%s)" % (f.name, f.time, f.status or f.error,), dump=f.name, seconds=f.time, status=f.status or f.error)
+    pfetch = fetches[0]
+
+    if pfetch.status == 404 and last_tick < alt:
+        # Dumps are missing from archive. Check for dumps for next tick
+        excaliburlog("Dump files missing. Looking for newer...")
+        for f in fetches:
+            f.close()
+        return get_dumps(last_tick+1, alt, useragent)
+
+    if any(f.status == 304 for f in fetches):
+        excaliburlog("Dump files not modified. Waiting...")
+        for f in fetches:
+            f.close()
+        time.sleep(60)
+        return (False, False, False, False)
+
+    for f in fetches:
+        if f.dump is None:
+            excaliburlog("Failed gathering dump files.\n%s: %s" % (f.name, str(f.error),))
+            wait = 300
+        elif f.status != 200:
+            excaliburlog("Error: %s %s" % (f.name, f.status,))
+            wait = 120
         else:
-            udump = None
-    except Exception, e:
-        excaliburlog("Failed gathering dump files.\n%s" % (str(e),))
-        time.sleep(300)
+            continue
+        for other in fetches:
+            other.close()
+        time.sleep(wait)
         return (False, False, False, False)
-    else:
-        return (pdump, gdump, adump, udump)
+
+    return tuple(f.dump for f in fetches) + ((None,) if alt else ())
 
 
 def checktick(planets, galaxies, alliances, userfeed):
@@ -199,49 +370,77 @@ def checktick(planets, galaxies, alliances, userfeed):
     return True
 
 
-def parse_userfeed(userfeed):
+class feedlookup(object):
+    # Resolves userfeed coords and alliance names against dictionaries loaded
+    #  once per tick, instead of a history or alliance query per feed line
+
+    def __init__(self):
+        self.planets = {}
+        self.galaxies = {}
+        self.alliances = dict((name.lower(), id) for id, name in session.query(Alliance.id, Alliance.name).filter_by(active=True))
+
+    def planet(self, x, y, z, tick):
+        # Returns (id, rulername, planetname) for the active planet at x:y:z on tick
+        if tick not in self.planets:
+            Q = session.query(PlanetHistory.x, PlanetHistory.y, PlanetHistory.z, PlanetHistory.id, PlanetHistory.rulername, PlanetHistory.planetname)
+            Q = Q.filter_by(tick=tick, active=True)
+            self.planets[tick] = dict((p[:3], p[3:]) for p in Q)
+        return self.planets[tick].get((int(x), int(y), int(z),))
+
+    def galaxy(self, x, y, tick):
+        if tick not in self.galaxies:
+            Q = session.query(GalaxyHistory.x, GalaxyHistory.y, GalaxyHistory.id)
+            Q = Q.filter_by(tick=tick, active=True)
+            self.galaxies[tick] = dict(((g[0], g[1],), g[2]) for g in Q)
+        return self.galaxies[tick].get((int(x), int(y),))
+
+    def alliance(self, name):
+        if name.lower() not in self.alliances:
+            # Not an exact match, so fall back to the usual fuzzy search
+            alliance = Alliance.load(name)
+            self.alliances[name.lower()] = alliance.id if alliance else None
+        return self.alliances[name.lower()]
+
+
+def parse_userfeed(userfeed, commit=True):
     global prefixes
     last_tick = session.query(max_(Feed.tick)).scalar() or 0
-    recents = session.query(Feed).filter_by(tick=last_tick).all()
-    for line in userfeed:
-        [tick, category, content] = decode(line).strip().split(userfeed.header["Separator"], 2)
-        tick = int(tick)
+    recents = set(session.query(Feed.category, Feed.text).filter_by(tick=last_tick))
+    lookup = feedlookup()
+    feeds = []
+    wars = {}
+    for tick, category, content in userfeed:
         if tick < last_tick:
             continue
-        category = category[1:-1]
-        content = content[1:-1]
-        f = Feed(tick=tick, category=category, text=content)
+        if tick == last_tick and (category, content,) in recents:
+            continue
+        f = dict(tick=tick, category=category, text=content, planet_id=None, galaxy_id=None, alliance1_id=None, alliance2_id=None, alliance3_id=None)
 
         if category == "Planet Ranking":
             # "TAKIYA GENJI of SUZURAN (3:2:7) is now rank 278 (formerly rank 107)"
             m = re.match(r"(.*) \((\d+):(\d+):(\d+)\)", content)
-            ph = PlanetHistory.load(m.group(2), m.group(3), m.group(4), tick)
-            f.planet_id = ph.id if ph else None
+            p = lookup.planet(m.group(2), m.group(3), m.group(4), tick)
+            f["planet_id"] = p[0] if p else None
         elif category == "Galaxy Ranking":
             # "4:7 ("Error we only have 12 planets") has taken over rank 1 (formerly rank 2)"
             m = re.match(r"^\s*(\d+):(\d+)", content)
-            gh = GalaxyHistory.load(m.group(1), m.group(2), tick)
-            f.galaxy_id = gh.id if gh else None
+            f["galaxy_id"] = lookup.galaxy(m.group(1), m.group(2), tick)
         elif category == "Alliance Ranking":
             # "p3nguins has taken over rank 1 (formerly rank 2)"
             m = re.match(r"(.*) has taken", content)
-            alliance = Alliance.load(m.group(1))
-            f.alliance1_id = alliance.id if alliance else None
+            f["alliance1_id"] = lookup.alliance(m.group(1))
         elif category == "Alliance Merging":
             # "The alliances "HEROES" and "TRAITORS" have merged to form "TRAITORS"."
             m = re.match(r"The alliances \"(.*)\" and \"(.*)\" have merged to form \"(.*)\"", content)
-            alliance = Alliance.load(m.group(1))
-            f.alliance1_id = alliance.id if alliance else None
-            alliance = Alliance.load(m.group(2))
-            f.alliance2_id = alliance.id if alliance else None
-            alliance = Alliance.load(m.group(3))
-            f.alliance3_id = alliance.id if alliance else None
-            if f.alliance3_id:
+            f["alliance1_id"] = lookup.alliance(m.group(1))
+            f["alliance2_id"] = lookup.alliance(m.group(2))
+            f["alliance3_id"] = lookup.alliance(m.group(3))
+            if f["alliance3_id"]:
                 for prefix in prefixes:
-                    if f.alliance1_id:
-                        session.execute(text("UPDATE %sintel SET alliance_id = %s WHERE alliance_id = %s;" % (prefix, f.alliance3_id, f.alliance1_id)))
-                    if f.alliance2_id:
-                        session.execute(text("UPDATE %sintel SET alliance_id = %s WHERE alliance_id = %s;" % (prefix, f.alliance3_id, f.alliance2_id)))
+                    if f["alliance1_id"]:
+                        session.execute(text("UPDATE %sintel SET alliance_id = %s WHERE alliance_id = %s;" % (prefix, f["alliance3_id"], f["alliance1_id"])))
+                    if f["alliance2_id"]:
+                        session.execute(text("UPDATE %sintel SET alliance_id = %s WHERE alliance_id = %s;" % (prefix, f["alliance3_id"], f["alliance2_id"])))
         elif category == "Relation Change":
             # "Ultores has declared war on Conspiracy !"
             # "Ultores has decided to end its NAP with NewDawn."
@@ -256,27 +455,22 @@ def parse_userfeed(userfeed):
                 dec_war = False
 
             if m:
-                a1 = Alliance.load(m.group(1))
-                if a1:
-                    f.alliance1_id = a1.id
-                a2 = Alliance.load(m.group(2))
-                if a2:
-                    f.alliance2_id = a2.id
-                if dec_war and a1 and a2:
+                f["alliance1_id"] = lookup.alliance(m.group(1))
+                f["alliance2_id"] = lookup.alliance(m.group(2))
+                if dec_war and f["alliance1_id"] and f["alliance2_id"]:
                     # War XP
-                    w = War(start_tick=tick, end_tick=tick+PA.getint("numbers", "war_length"), alliance1_id=f.alliance1_id or None, alliance2_id=f.alliance2_id or None)
-                    session.add(w)
+                    wars[(tick, f["alliance1_id"], f["alliance2_id"],)] = dict(start_tick=tick, end_tick=tick+PA.getint("numbers", "war_length"), alliance1_id=f["alliance1_id"], alliance2_id=f["alliance2_id"])
             else:
                 excaliburlog("Unrecognised Relation Change: '%s'" % (content,))
         elif category == "Anarchy":
             # "laxer1013 of SchoolsOut (3:3:11) has exited anarchy."
             # "Nandos Skank of Chicken on the Phone (6:7:4) has entered anarchy until tick 192."
             m = re.match(r"(.*) \((\d+):(\d+):(\d+)\) has (entered|exited) anarchy(?: until tick (\d+).)?", content)
-            p = PlanetHistory.load(m.group(2), m.group(3), m.group(4), tick)
-            if not p or "%s of %s" % (p.rulername, p.planetname) != m.group(1):
-                p = PlanetHistory.load(m.group(2), m.group(3), m.group(4), tick+1)
-            if p and "%s of %s" % (p.rulername, p.planetname) == m.group(1):
-                f.planet_id = p.id
+            p = lookup.planet(m.group(2), m.group(3), m.group(4), tick)
+            if not p or "%s of %s" % (p[1], p[2]) != m.group(1):
+                p = lookup.planet(m.group(2), m.group(3), m.group(4), tick+1)
+            if p and "%s of %s" % (p[1], p[2]) == m.group(1):
+                f["planet_id"] = p[0]
             # Store intel - probably set the gov, put expiry and previous gov in comment. Append to comment?
         elif category == "Combat Report":
             # " Combat Report: [news]yy9w6bhijoo7h2b[/news]"
@@ -284,15 +478,13 @@ def parse_userfeed(userfeed):
             pass
         else:
             excaliburlog("Unknown User Feed Item Type: '%s'" % (category,))
-        if tick == last_tick:
-            for rf in recents:
-                if f.category == rf.category and f.text == rf.text:
-                    break
-            else:
-                session.add(f)
-        else:
-            session.add(f)
-    session.commit()
+        feeds.append(f)
+    if feeds:
+        session.execute(Feed.__table__.insert(), feeds)
+    if wars:
+        session.execute(War.__table__.insert(), wars.values())
+    if commit:
+        session.commit()
 
 
 def penis():
@@ -306,13 +498,13 @@ def penis():
     session.execute(text("SELECT setval('galpenis_rank_seq', 1, :false);", bindparams=[false]))
     session.execute(text("INSERT INTO galpenis (galaxy_id, penis) SELECT galaxy.id, galaxy.score - galaxy_history.score FROM galaxy, galaxy_history WHERE galaxy.active = :true AND galaxy.x != 200 AND galaxy.id = galaxy_history.id AND galaxy_history.tick = :tick ORDER BY galaxy.score - galaxy_history.score DESC;", bindparams=[history_tick, true]))
     t2=time.time()-t1
-    excaliburlog("galpenis in %.3f seconds" % (t2,))
+    stagelog("galpenis", t2)
     t1=time.time()
     session.execute(apenis.__table__.delete())
     session.execute(text("SELECT setval('apenis_rank_seq', 1, :false);", bindparams=[false]))
     session.execute(text("INSERT INTO apenis (alliance_id, penis) SELECT alliance.id, alliance.score - alliance_history.score FROM alliance, alliance_history WHERE alliance.active = :true AND alliance.id = alliance_history.id AND alliance_history.tick = :tick ORDER BY alliance.score - alliance_history.score DESC;", bindparams=[history_tick, true,]))
     t2=time.time()-t1
-    excaliburlog("apenis in %.3f seconds" % (t2,))
+    stagelog("apenis", t2)
     t1=time.time()
     for i in range(len(bots)):
         t2=time.time()
@@ -325,7 +517,7 @@ def penis():
         t3=time.time()-t2
         excaliburlog("epenis for %s in %.3f seconds" % (prefixes[i],t3,))
     t2=time.time()-t1
-    excaliburlog("epenis in %.3f seconds" % (t2,))
+    stagelog("epenis", t2)
     session.commit()
     t1=time.time()-t_start
     excaliburlog("Total penis time: %.3f seconds" % (t1,))
@@ -342,7 +534,7 @@ def closereqs(planet_tick):
         else:
             session.execute(text("UPDATE %srequest SET active=:false WHERE active=:true AND tick < %s;" % (prefixes[i], planet_tick-bots[i].getint("Misc", "reqexpire")), bindparams=[false, true]))
     session.commit()
-    excaliburlog("Expired requests removed in %.3f seconds" % (time.time() - t_start))
+    stagelog("Expired requests removed", time.time() - t_start)
     session.close()
 
 
@@ -353,19 +545,761 @@ def parsescans(tick):
             parse(s[0], "scan", s[1]).start()
 
 
-def clean_cache():
-    # Clean tick dependant graph cache
+def update_graphs(tick):
+    # Append the tick to the graph data, remove the cached graphs of
+    #  everything that changed and draw our own graphs again
+    if Config.get("Misc", "graphing") == "disabled":
+        return
     try:
         t_start=time.time()
+        updated = graphs.append(tick)
+        excaliburlog("Appended graph data for %s entities" % (sum([len(ids) for graph, ids in updated]),))
+        stagelog("Append graph data", time.time() - t_start)
         if Config.get("Misc", "graphing") != "cached":
-            raise OSError
-        shutil.rmtree("Arthur/graphs/values/")
-        shutil.rmtree("Arthur/graphs/ranks/")
-    except OSError:
-        pass
+            return
+        t_start=time.time()
+        removed = graphs.invalidate(tick, updated)
+        excaliburlog("Removed %s cached graphs" % (removed,))
+        stagelog("Clean tick dependant graph cache", time.time() - t_start)
+        t_start=time.time()
+        drawn = graphs.prerender(tick)
+        excaliburlog("Drew %s graphs for members and targets" % (drawn,))
+        stagelog("Draw graphs for members and targets", time.time() - t_start)
+    except Exception, e:
+        excaliburlog("Graph update failed: %s" % (str(e),), traceback=True)
     finally:
-        t1=time.time()-t_start
-        excaliburlog("Clean tick dependant graph cache in %.3f seconds" % (t1,))
+        session.close()
+
+
+def partition_history(tick):
+    # Make sure each partitioned history table has a partition for this tick.
+    #  Tables from before partitioning was added are left as they are.
+    first = tick - (tick - 1) % history_partition
+    for table in Base.metadata.sorted_tables:
+        if not table.info.get("partition_by"):
+            continue
+        if session.execute(text("SELECT relkind FROM pg_class WHERE relname = '%s' AND pg_table_is_visible(oid);" % (table.name,))).scalar() != 'p':
+            continue
+        session.execute(text("CREATE TABLE IF NOT EXISTS %s_%s PARTITION OF %s FOR VALUES FROM (%s) TO (%s);" % (table.name, first, table.name, first, first + history_partition,)))
+
+
+def process_tick(planets, galaxies, alliances, headers, midnight, hour, timestamp):
+    # Run a tick from the parsed dumps. Nothing is committed here, that is
+    #  left to the caller so several ticks can share a transaction.
+    t1=time.time()
+    
+    tick = bindparam("tick",planets.tick)
+    
+    # Insert a record of the tick and a timestamp generated by SQLA
+    session.execute(Updates.__table__.insert().values(id=planets.tick, **headers))
+    
+    # Empty out the temp tables
+    session.execute(galaxy_temp.delete())
+    session.execute(planet_temp.delete())
+    session.execute(alliance_temp.delete())
+    
+    # Insert the data to the temporary tables
+    load_temp(planet_temp, planets)
+    load_temp(galaxy_temp, galaxies)
+    load_temp(alliance_temp, alliances)
+    
+    t2=time.time()-t1
+    stagelog("Inserted dumps", t2)
+    t1=time.time()
+    
+    # ########################################################################### #
+    # ##############################    CLUSTERS    ############################# #
+    # ########################################################################### #
+    
+    # Make sure all the galaxies are active,
+    #  some might have been deactivated previously
+    session.execute(text("UPDATE cluster SET active = :true;", bindparams=[true]))
+    
+    # Any galaxies in the temp table without an id are new
+    # Insert them to the current table and the id(serial/auto_increment)
+    #  will be generated, and we can then copy it back to the temp table
+    session.execute(text("INSERT INTO cluster (x, active) SELECT g.x, :true FROM galaxy_temp as g WHERE g.x NOT IN (SELECT x FROM cluster) GROUP BY g.x;", bindparams=[true]))
+    
+    # For galaxies that are no longer present in the new dump
+    session.execute(text("UPDATE cluster SET active = :false WHERE x NOT IN (SELECT x FROM galaxy_temp);", bindparams=[false]))
+    
+    t2=time.time()-t1
+    stagelog("Deactivate old clusters and generate new cluster ids", t2)
+    t1=time.time()
+    
+    # Update everything from the temp table and generate ranks
+    # Deactivated items are untouched but NULLed earlier
+    session.execute(text("""UPDATE cluster AS c SET
+                              age = COALESCE(c.age, 0) + 1,
+                              size = t.size, score = t.score, value = t.value, xp = t.xp,
+                              ratio = CASE WHEN (t.value != 0) THEN 10000.0 * t.size / t.value ELSE 0 END,
+                              members = t.count,
+                         """ + (
+                         """
+                              size_growth = t.size - COALESCE(c.size - c.size_growth, 0),
+                              score_growth = t.score - COALESCE(c.score - c.score_growth, 0),
+                              value_growth = t.value - COALESCE(c.value - c.value_growth, 0),
+                              xp_growth = t.xp - COALESCE(c.xp - c.xp_growth, 0),
+                              member_growth = t.count - COALESCE(c.members - c.member_growth, 0),
+                              size_growth_pc = CASE WHEN (c.size - c.size_growth != 0) THEN COALESCE((t.size - (c.size - c.size_growth)) * 100.0 / (c.size - c.size_growth), 0) ELSE 0 END,
+                              score_growth_pc = CASE WHEN (c.score - c.score_growth != 0) THEN COALESCE((t.score - (c.score - c.score_growth)) * 100.0 / (c.score - c.score_growth), 0) ELSE 0 END,
+                              value_growth_pc = CASE WHEN (c.value - c.value_growth != 0) THEN COALESCE((t.value - (c.value - c.value_growth)) * 100.0 / (c.value - c.value_growth), 0) ELSE 0 END,
+                              xp_growth_pc = CASE WHEN (c.xp - c.xp_growth != 0) THEN COALESCE((t.xp - (c.xp - c.xp_growth)) * 100.0 / (c.xp - c.xp_growth), 0) ELSE 0 END,
+                              size_rank_change = t.size_rank - COALESCE(c.size_rank - c.size_rank_change, 0),
+                              score_rank_change = t.score_rank - COALESCE(c.score_rank - c.score_rank_change, 0),
+                              value_rank_change = t.value_rank - COALESCE(c.value_rank - c.value_rank_change, 0),
+                              xp_rank_change = t.xp_rank - COALESCE(c.xp_rank - c.xp_rank_change, 0),
+                              totalroundroids_rank_change = t.totalroundroids_rank - COALESCE(c.totalroundroids_rank - c.totalroundroids_rank_change, 0),
+                              totallostroids_rank_change = t.totallostroids_rank - COALESCE(c.totallostroids_rank - c.totallostroids_rank_change, 0),
+                              totalroundroids_growth = t.totalroundroids - COALESCE(c.totalroundroids - c.totalroundroids_growth, 0),
+                              totalroundroids_growth_pc = CASE WHEN (c.totalroundroids - c.totalroundroids_growth != 0) THEN COALESCE((t.totalroundroids - (c.totalroundroids - c.totalroundroids_growth)) * 100.0 / (c.totalroundroids - c.totalroundroids_growth), 0) ELSE 0 END,
+                              totallostroids_growth = t.totallostroids - COALESCE(c.totallostroids - c.totallostroids_growth, 0),
+                              totallostroids_growth_pc = CASE WHEN (c.totallostroids - c.totallostroids_growth != 0) THEN COALESCE((t.totallostroids - (c.totallostroids - c.totallostroids_growth)) * 100.0 / (c.totallostroids - c.totallostroids_growth), 0) ELSE 0 END,
+                         """ if not midnight
+                             else
+                         """
+                              size_growth = t.size - COALESCE(c.size, 0),
+                              score_growth = t.score - COALESCE(c.score, 0),
+                              value_growth = t.value - COALESCE(c.value, 0),
+                              xp_growth = t.xp - COALESCE(c.xp, 0),
+                              member_growth = t.count - COALESCE(c.members, 0),
+                              size_growth_pc = CASE WHEN (c.size != 0) THEN COALESCE((t.size - c.size) * 100.0 / c.size, 0) ELSE 0 END,
+                              score_growth_pc = CASE WHEN (c.score != 0) THEN COALESCE((t.score - c.score) * 100.0 / c.score * 100, 0) ELSE 0 END,
+                              value_growth_pc = CASE WHEN (c.value != 0) THEN COALESCE((t.value - c.value) * 100.0 / c.value, 0) ELSE 0 END,
+                              xp_growth_pc = CASE WHEN (c.xp != 0) THEN COALESCE((t.xp - c.xp) * 100.0 / c.xp, 0) ELSE 0 END,
+                              size_rank_change = t.size_rank - COALESCE(c.size_rank, 0),
+                              score_rank_change = t.score_rank - COALESCE(c.score_rank, 0),
+                              value_rank_change = t.value_rank - COALESCE(c.value_rank, 0),
+                              xp_rank_change = t.xp_rank - COALESCE(c.xp_rank, 0),
+                              totalroundroids_rank_change = t.totalroundroids_rank - COALESCE(c.totalroundroids_rank, 0),
+                              totallostroids_rank_change = t.totallostroids_rank - COALESCE(c.totallostroids_rank, 0),
+                              totalroundroids_growth = t.totalroundroids - COALESCE(c.totalroundroids, 0),
+                              totalroundroids_growth_pc = CASE WHEN (c.totalroundroids != 0) THEN COALESCE((t.totalroundroids - c.totalroundroids) * 100.0 / c.totalroundroids, 0) ELSE 0 END,
+                              totallostroids_growth = t.totallostroids - COALESCE(c.totallostroids, 0),
+                              totallostroids_growth_pc = CASE WHEN (c.totallostroids != 0) THEN COALESCE((t.totallostroids - c.totallostroids) * 100.0 / c.totallostroids, 0) ELSE 0 END,
+                         """ ) +
+                         """
+                              ticksroiding = COALESCE(c.ticksroiding, 0) + CASE WHEN (t.size > c.size AND (t.size - c.size) != (t.xp - c.xp)) THEN 1 ELSE 0 END,
+                              ticksroided = COALESCE(c.ticksroided, 0) + CASE WHEN (t.size < c.size) THEN 1 ELSE 0 END,
+                              tickroids = COALESCE(c.tickroids, 0) + t.size,
+                              avroids = COALESCE((c.tickroids + t.size) / (c.age + 1.0), t.size),
+                              roidxp = CASE WHEN (t.size != 0) THEN t.xp * 1.0 / t.size ELSE 0 END,
+                         """ + ((
+                         """
+                              %s_highest_rank = CASE WHEN (t.%s_rank <= COALESCE(c.%s_highest_rank, t.%s_rank)) THEN t.%s_rank ELSE c.%s_highest_rank END,
+                              %s_highest_rank_tick = CASE WHEN (t.%s_rank <= COALESCE(c.%s_highest_rank, t.%s_rank)) THEN :tick ELSE c.%s_highest_rank_tick END,
+                              %s_lowest_rank = CASE WHEN (t.%s_rank >= COALESCE(c.%s_lowest_rank, t.%s_rank)) THEN t.%s_rank ELSE c.%s_lowest_rank END,
+                              %s_lowest_rank_tick = CASE WHEN (t.%s_rank >= COALESCE(c.%s_lowest_rank, t.%s_rank)) THEN :tick ELSE c.%s_lowest_rank_tick END,
+                         """ * 4) % (("size",)*22 + ("score",)*22 + ("value",)*22 + ("xp",)*22)) +
+                         """
+                              totalroundroids = t.totalroundroids, totallostroids = t.totallostroids,
+                              totalroundroids_rank = t.totalroundroids_rank, totallostroids_rank = t.totallostroids_rank,
+                              size_rank = t.size_rank, score_rank = t.score_rank, value_rank = t.value_rank, xp_rank = t.xp_rank,
+                              vdiff = COALESCE(t.value - c.value, 0),
+                              sdiff = COALESCE(t.score - c.score, 0),
+                              xdiff = COALESCE(t.xp - c.xp, 0),
+                              rdiff = COALESCE(t.size - c.size, 0),
+                              mdiff = COALESCE(t.count - c.members, 0),
+                              vrankdiff = COALESCE(t.value_rank - c.value_rank, 0),
+                              srankdiff = COALESCE(t.score_rank - c.score_rank, 0),
+                              xrankdiff = COALESCE(t.xp_rank - c.xp_rank, 0),
+                              rrankdiff = COALESCE(t.size_rank - c.size_rank, 0),
+                              idle = CASE WHEN ((t.value-c.value) BETWEEN (c.vdiff-1) AND (c.vdiff+1) AND (c.xp-t.xp=0)) THEN 1 + COALESCE(c.idle, 0) ELSE 0 END
+                            FROM (SELECT *,
+                              rank() OVER (ORDER BY totalroundroids DESC) AS totalroundroids_rank,
+                              rank() OVER (ORDER BY totallostroids DESC) AS totallostroids_rank,
+                              rank() OVER (ORDER BY size DESC) AS size_rank,
+                              rank() OVER (ORDER BY score DESC) AS score_rank,
+                              rank() OVER (ORDER BY value DESC) AS value_rank,
+                              rank() OVER (ORDER BY xp DESC) AS xp_rank
+                            FROM (SELECT t.*,
+                              COALESCE(c.totalroundroids + (GREATEST(t.size - c.size, 0)), t.size) AS totalroundroids,
+                              COALESCE(c.totallostroids + (GREATEST(c.size - t.size, 0)), 0) AS totallostroids
+                            FROM cluster AS c, (SELECT x,
+                              count(*) as count,
+                              sum(size) as size,
+                              sum(value) as value,
+                              sum(score) as score,
+                              sum(xp) as xp
+                            FROM planet_temp
+                              GROUP BY x) AS t
+                              WHERE c.x = t.x) AS t) AS t
+                            WHERE c.x = t.x
+                            AND c.active = :true
+                        ;""", bindparams=[tick, true]))
+    
+    t2=time.time()-t1
+    stagelog("Update clusters from temp and generate ranks", t2)
+    t1=time.time()
+    
+    # We do galaxies before planets now in order to satisfy the planet(x,y) FK
+    
+    # ########################################################################### #
+    # ##############################    GALAXIES    ############################# #
+    # ########################################################################### #
+    
+    # Update the newly dumped data with IDs from the current data
+    #  based on an x,y match in the two tables (and active=True)
+    session.execute(text("""UPDATE galaxy_temp AS t SET
+                              id = g.id
+                            FROM (SELECT id, x, y FROM galaxy) AS g
+                              WHERE t.x = g.x AND t.y = g.y
+                        ;"""))
+    
+    # Make sure all the galaxies are active,
+    #  some might have been deactivated previously
+    session.execute(text("UPDATE galaxy SET active = :true;", bindparams=[true]))
+    
+    t2=time.time()-t1
+    stagelog("Copy galaxy ids to temp and activate", t2)
+    t1=time.time()
+    
+    # Any galaxies in the temp table without an id are new
+    # Insert them to the current table and the id(serial/auto_increment)
+    #  will be generated, and we can then copy it back to the temp table
+    # Galaxies under a certain amount of planets are private
+    session.execute(text("INSERT INTO galaxy (x, y, active) SELECT g.x, g.y, :true FROM galaxy_temp as g WHERE g.id IS NULL;", bindparams=[true]))
+    session.execute(text("UPDATE galaxy_temp SET id = (SELECT id FROM galaxy WHERE galaxy.x = galaxy_temp.x AND galaxy.y = galaxy_temp.y AND galaxy.active = :true ORDER BY galaxy.id DESC) WHERE id IS NULL;", bindparams=[true]))
+    
+    # For galaxies that are no longer present in the new dump
+    session.execute(text("UPDATE galaxy SET active = :false WHERE id NOT IN (SELECT id FROM galaxy_temp WHERE id IS NOT NULL);", bindparams=[false]))
+    
+    t2=time.time()-t1
+    stagelog("Deactivate old galaxies and generate new galaxy ids", t2)
+    t1=time.time()
+    
+    # Update everything from the temp table and generate ranks
+    # Deactivated items are untouched but NULLed earlier
+    session.execute(text("""UPDATE galaxy AS g SET
+                              age = COALESCE(g.age, 0) + 1,
+                              x = t.x, y = t.y,
+                              name = t.name, size = t.size, score = t.score, value = t.value, xp = t.xp,
+                              ratio = CASE WHEN (t.value != 0) THEN 10000.0 * t.size / t.value ELSE 0 END,
+                              members = p.count,
+                              private = p.count <= :priv_gal OR (g.x = 1 AND g.y = 1),
+                         """ + (
+                         """
+                              size_growth = t.size - COALESCE(g.size - g.size_growth, 0),
+                              score_growth = t.score - COALESCE(g.score - g.score_growth, 0),
+                              value_growth = t.value - COALESCE(g.value - g.value_growth, 0),
+                              xp_growth = t.xp - COALESCE(g.xp - g.xp_growth, 0),
+                              member_growth = p.count - COALESCE(g.members - g.member_growth, 0),
+                              size_growth_pc = CASE WHEN (g.size - g.size_growth != 0) THEN COALESCE((t.size - (g.size - g.size_growth)) * 100.0 / (g.size - g.size_growth), 0) ELSE 0 END,
+                              score_growth_pc = CASE WHEN (g.score - g.score_growth != 0) THEN COALESCE((t.score - (g.score - g.score_growth)) * 100.0 / (g.score - g.score_growth), 0) ELSE 0 END,
+                              value_growth_pc = CASE WHEN (g.value - g.value_growth != 0) THEN COALESCE((t.value - (g.value - g.value_growth)) * 100.0 / (g.value - g.value_growth), 0) ELSE 0 END,
+                              xp_growth_pc = CASE WHEN (g.xp - g.xp_growth != 0) THEN COALESCE((t.xp - (g.xp - g.xp_growth)) * 100.0 / (g.xp - g.xp_growth), 0) ELSE 0 END,
+                              size_rank_change = t.size_rank - COALESCE(g.size_rank - g.size_rank_change, 0),
+                              score_rank_change = t.score_rank - COALESCE(g.score_rank - g.score_rank_change, 0),
+                              value_rank_change = t.value_rank - COALESCE(g.value_rank - g.value_rank_change, 0),
+                              xp_rank_change = t.xp_rank - COALESCE(g.xp_rank - g.xp_rank_change, 0),
+                              real_score_growth = p.real_score - COALESCE(g.real_score - g.real_score_growth, 0),
+                              real_score_growth_pc = CASE WHEN (g.real_score - g.real_score_growth != 0) THEN COALESCE((p.real_score - (g.real_score - g.real_score_growth)) * 100.0 / (g.real_score - g.real_score_growth), 0) ELSE 0 END,
+                              real_score_rank_change = p.real_score_rank - COALESCE(g.real_score_rank - g.real_score_rank_change, 0),
+                              totalroundroids_rank_change = t.totalroundroids_rank - COALESCE(g.totalroundroids_rank - g.totalroundroids_rank_change, 0),
+                              totallostroids_rank_change = t.totallostroids_rank - COALESCE(g.totallostroids_rank - g.totallostroids_rank_change, 0),
+                              totalroundroids_growth = t.totalroundroids - COALESCE(g.totalroundroids - g.totalroundroids_growth, 0),
+                              totalroundroids_growth_pc = CASE WHEN (g.totalroundroids - g.totalroundroids_growth != 0) THEN COALESCE((t.totalroundroids - (g.totalroundroids - g.totalroundroids_growth)) * 100.0 / (g.totalroundroids - g.totalroundroids_growth), 0) ELSE 0 END,
+                              totallostroids_growth = t.totallostroids - COALESCE(g.totallostroids - g.totallostroids_growth, 0),
+                              totallostroids_growth_pc = CASE WHEN (g.totallostroids - g.totallostroids_growth != 0) THEN COALESCE((t.totallostroids - (g.totallostroids - g.totallostroids_growth)) * 100.0 / (g.totallostroids - g.totallostroids_growth), 0) ELSE 0 END,
+                         """ if not midnight
+                             else
+                         """
+                              size_growth = t.size - COALESCE(g.size, 0),
+                              score_growth = t.score - COALESCE(g.score, 0),
+                              value_growth = t.value - COALESCE(g.value, 0),
+                              xp_growth = t.xp - COALESCE(g.xp, 0),
+                              member_growth = p.count - COALESCE(g.members, 0),
+                              size_growth_pc = CASE WHEN (g.size != 0) THEN COALESCE((t.size - g.size) * 100.0 / g.size, 0) ELSE 0 END,
+                              score_growth_pc = CASE WHEN (g.score != 0) THEN COALESCE((t.score - g.score) * 100.0 / g.score * 100, 0) ELSE 0 END,
+                              value_growth_pc = CASE WHEN (g.value != 0) THEN COALESCE((t.value - g.value) * 100.0 / g.value, 0) ELSE 0 END,
+                              xp_growth_pc = CASE WHEN (g.xp != 0) THEN COALESCE((t.xp - g.xp) * 100.0 / g.xp, 0) ELSE 0 END,
+                              size_rank_change = t.size_rank - COALESCE(g.size_rank, 0),
+                              score_rank_change = t.score_rank - COALESCE(g.score_rank, 0),
+                              value_rank_change = t.value_rank - COALESCE(g.value_rank, 0),
+                              xp_rank_change = t.xp_rank - COALESCE(g.xp_rank, 0),
+                              real_score_growth = p.real_score - COALESCE(g.real_score, 0),
+                              real_score_growth_pc = CASE WHEN (g.real_score != 0) THEN COALESCE((p.real_score - g.real_score) * 100.0 / g.real_score * 100, 0) ELSE 0 END,
+                              real_score_rank_change = p.real_score_rank - COALESCE(g.real_score_rank, 0),
+                              totalroundroids_rank_change = t.totalroundroids_rank - COALESCE(g.totalroundroids_rank, 0),
+                              totallostroids_rank_change = t.totallostroids_rank - COALESCE(g.totallostroids_rank, 0),
+                              totalroundroids_growth = t.totalroundroids - COALESCE(g.totalroundroids, 0),
+                              totalroundroids_growth_pc = CASE WHEN (g.totalroundroids != 0) THEN COALESCE((t.totalroundroids - g.totalroundroids) * 100.0 / g.totalroundroids, 0) ELSE 0 END,
+                              totallostroids_growth = t.totallostroids - COALESCE(g.totallostroids, 0),
+                              totallostroids_growth_pc = CASE WHEN (g.totallostroids != 0) THEN COALESCE((t.totallostroids - g.totallostroids) * 100.0 / g.totallostroids, 0) ELSE 0 END,
+                         """ ) +
+                         """
+                              ticksroiding = COALESCE(g.ticksroiding, 0) + CASE WHEN (t.size > g.size AND (t.size - g.size) != (t.xp - g.xp)) THEN 1 ELSE 0 END,
+                              ticksroided = COALESCE(g.ticksroided, 0) + CASE WHEN (t.size < g.size) THEN 1 ELSE 0 END,
+                              tickroids = COALESCE(g.tickroids, 0) + t.size,
+                              avroids = COALESCE((g.tickroids + t.size) / (g.age + 1.0), t.size),
+                              roidxp = CASE WHEN (t.size != 0) THEN t.xp * 1.0 / t.size ELSE 0 END,
+                         """ + ((
+                         """
+                              %s_highest_rank = CASE WHEN (t.%s_rank <= COALESCE(g.%s_highest_rank, t.%s_rank)) THEN t.%s_rank ELSE g.%s_highest_rank END,
+                              %s_highest_rank_tick = CASE WHEN (t.%s_rank <= COALESCE(g.%s_highest_rank, t.%s_rank)) THEN :tick ELSE g.%s_highest_rank_tick END,
+                              %s_lowest_rank = CASE WHEN (t.%s_rank >= COALESCE(g.%s_lowest_rank, t.%s_rank)) THEN t.%s_rank ELSE g.%s_lowest_rank END,
+                              %s_lowest_rank_tick = CASE WHEN (t.%s_rank >= COALESCE(g.%s_lowest_rank, t.%s_rank)) THEN :tick ELSE g.%s_lowest_rank_tick END,
+                         """ * 4) % (("size",)*22 + ("score",)*22 + ("value",)*22 + ("xp",)*22)) +
+                         """
+                              real_score_highest_rank = CASE WHEN (p.real_score_rank <= COALESCE(g.real_score_highest_rank, p.real_score_rank)) THEN p.real_score_rank ELSE g.real_score_highest_rank END,
+                              real_score_highest_rank_tick = CASE WHEN (p.real_score_rank <= COALESCE(g.real_score_highest_rank, p.real_score_rank)) THEN :tick ELSE g.real_score_highest_rank_tick END,
+                              real_score_lowest_rank = CASE WHEN (p.real_score_rank >= COALESCE(g.real_score_lowest_rank, p.real_score_rank)) THEN p.real_score_rank ELSE g.real_score_lowest_rank END,
+                              real_score_lowest_rank_tick = CASE WHEN (p.real_score_rank >= COALESCE(g.real_score_lowest_rank, p.real_score_rank)) THEN :tick ELSE g.real_score_lowest_rank_tick END,
+                              real_score = p.real_score, real_score_rank = p.real_score_rank,
+                              totalroundroids = t.totalroundroids, totallostroids = t.totallostroids,
+                              totalroundroids_rank = t.totalroundroids_rank, totallostroids_rank = t.totallostroids_rank,
+                              size_rank = t.size_rank, score_rank = t.score_rank, value_rank = t.value_rank, xp_rank = t.xp_rank,
+                              vdiff = COALESCE(t.value - g.value, 0),
+                              sdiff = COALESCE(t.score - g.score, 0),
+                              rsdiff = COALESCE(p.real_score - g.real_score, 0),
+                              xdiff = COALESCE(t.xp - g.xp, 0),
+                              rdiff = COALESCE(t.size - g.size, 0),
+                              mdiff = COALESCE(p.count - g.members, 0),
+                              vrankdiff = COALESCE(t.value_rank - g.value_rank, 0),
+                              srankdiff = COALESCE(t.score_rank - g.score_rank, 0),
+                              rsrankdiff = COALESCE(p.real_score_rank - g.real_score_rank, 0),
+                              xrankdiff = COALESCE(t.xp_rank - g.xp_rank, 0),
+                              rrankdiff = COALESCE(t.size_rank - g.size_rank, 0),
+                              idle = CASE WHEN ((t.value-g.value) BETWEEN (g.vdiff-1) AND (g.vdiff+1) AND (g.xp-t.xp=0)) THEN 1 + COALESCE(g.idle, 0) ELSE 0 END
+                            FROM (SELECT *,
+                              rank() OVER (ORDER BY totalroundroids DESC) AS totalroundroids_rank,
+                              rank() OVER (ORDER BY totallostroids DESC) AS totallostroids_rank,
+                              rank() OVER (ORDER BY size DESC) AS size_rank,
+                              rank() OVER (ORDER BY score DESC) AS score_rank,
+                              rank() OVER (ORDER BY value DESC) AS value_rank,
+                              rank() OVER (ORDER BY xp DESC) AS xp_rank
+                            FROM (SELECT t.*,
+                              COALESCE(g.totalroundroids + (GREATEST(t.size - g.size, 0)), t.size) AS totalroundroids,
+                              COALESCE(g.totallostroids + (GREATEST(g.size - t.size, 0)), 0) AS totallostroids
+                            FROM galaxy AS g, galaxy_temp AS t
+                              WHERE g.id = t.id AND g.active = :true) AS t) AS t,
+                              (SELECT a.x, a.y, a.count, a.real_score,
+                                rank() OVER (ORDER BY a.real_score DESC) AS real_score_rank
+                              FROM (SELECT x, y,
+                                  count(*) AS count,
+                                  sum(score) AS real_score
+                                FROM planet_temp
+                                GROUP BY x, y
+                                ) AS a
+                              ) AS p
+                            WHERE g.id = t.id
+                               AND g.x = p.x AND g.y = p.y
+                            AND g.active = :true
+                        ;""", bindparams=[tick, true, bindparam("priv_gal",PA.getint("numbers", "priv_gal"))]))
+    
+    t2=time.time()-t1
+    stagelog("Update galaxies from temp and generate ranks", t2)
+    t1=time.time()
+    
+    # ########################################################################### #
+    # ##############################    PLANETS    ############################## #
+    # ########################################################################### #
+    
+    
+    # Any planets in the temp table without an id are new
+    # Insert them to the current table and the id(serial/auto_increment)
+    #  will be generated, and we can then copy it back to the temp table
+    session.execute(text("INSERT INTO planet (id, active) SELECT id, :true FROM planet_temp WHERE id NOT IN (SELECT id FROM planet);", bindparams=[true]))
+    
+    t2=time.time()-t1
+    stagelog("Insert new planets", t2)
+    t1=time.time()
+    
+    # Create records of new planets,
+    session.execute(text("""INSERT INTO planet_exiles (hour, tick, id, newx, newy, newz)
+                            SELECT :hour, :tick, planet.id, planet_temp.x, planet_temp.y, planet_temp.z
+                            FROM planet_temp, planet
+                            WHERE
+                                planet.id= planet_temp.id AND
+                                planet.active = :true AND
+                                planet.age IS NULL
+                        ;""", bindparams=[tick, hour, true]))
+    # deleted plantes
+    session.execute(text("""INSERT INTO planet_exiles (hour, tick, id, oldx, oldy, oldz)
+                            SELECT :hour, :tick, planet.id, planet.x, planet.y, planet.z
+                            FROM planet
+                            WHERE
+                                planet.active = :true AND
+                                planet.age IS NOT NULL AND
+                                planet.id NOT IN (SELECT id FROM planet_temp WHERE id IS NOT NULL)
+                        ;""", bindparams=[tick, hour, true]))
+    # planet renames
+    session.execute(text("""INSERT INTO planet_exiles (hour, tick, id, oldx, oldy, oldz, newx, newy, newz)
+                            SELECT :hour, :tick, planet.id, planet.x, planet.y, planet.z, planet_temp.x, planet_temp.y, planet_temp.z
+                            FROM planet_temp, planet
+                            WHERE
+                                planet.id = planet_temp.id AND
+                                planet.active = :true AND
+                                planet.age IS NOT NULL AND
+                                (planet.rulername != planet_temp.rulername OR planet.planetname != planet_temp.planetname)
+                        ;""", bindparams=[tick, hour, true]))
+    # and planet movements
+    session.execute(text("""INSERT INTO planet_exiles (hour, tick, id, oldx, oldy, oldz, newx, newy, newz)
+                            SELECT :hour, :tick, planet.id, planet.x, planet.y, planet.z, planet_temp.x, planet_temp.y, planet_temp.z
+                            FROM planet_temp, planet
+                            WHERE
+                                planet.id = planet_temp.id AND
+                                planet.active = :true AND
+                                planet.age IS NOT NULL AND
+                                (planet.x != planet_temp.x OR planet.y != planet_temp.y OR planet.z != planet_temp.z)
+                        ;""", bindparams=[tick, hour, true]))
+    
+    t2=time.time()-t1
+    stagelog("Track new/deleted/moved planets", t2)
+    t1=time.time()
+    
+    # For planets that are no longer present in the new dump
+    session.execute(text("UPDATE planet SET active = :false WHERE active AND id NOT IN (SELECT id FROM planet_temp WHERE id IS NOT NULL);", bindparams=[false]))
+    # For planets that are present in the new dump but weren't. I don't think this should happen, but you never know
+    session.execute(text("UPDATE planet SET active = :true WHERE NOT active AND id IN (SELECT id FROM planet_temp WHERE id IS NOT NULL);", bindparams=[true]))
+    
+    t2=time.time()-t1
+    stagelog("Deactivate old planets", t2)
+    t1=time.time()
+    
+    # Update everything from the temp table and generate ranks
+    # Deactivated items are untouched but NULLed earlier
+    session.execute(text("""UPDATE planet AS p SET
+                              age = COALESCE(p.age, 0) + 1,
+                              x = t.x, y = t.y, z = t.z,
+                              planetname = t.planetname, rulername = t.rulername, race = t.race,
+                              size = t.size, score = t.score, value = t.value, xp = t.xp, special = t.special,
+                              ratio = CASE WHEN (t.value != 0) THEN 10000.0 * t.size / t.value ELSE 0 END,
+                         """ + ((
+                         """
+                              size_growth = t.size - COALESCE(p.size - p.size_growth, 0),
+                              score_growth = t.score - COALESCE(p.score - p.score_growth, 0),
+                              value_growth = t.value - COALESCE(p.value - p.value_growth, 0),
+                              xp_growth = t.xp - COALESCE(p.xp - p.xp_growth, 0),
+                              size_growth_pc = CASE WHEN (p.size - p.size_growth != 0) THEN COALESCE((t.size - (p.size - p.size_growth)) * 100.0 / (p.size - p.size_growth), 0) ELSE 0 END,
+                              score_growth_pc = CASE WHEN (p.score - p.score_growth != 0) THEN COALESCE((t.score - (p.score - p.score_growth)) * 100.0 / (p.score - p.score_growth), 0) ELSE 0 END,
+                              value_growth_pc = CASE WHEN (p.value - p.value_growth != 0) THEN COALESCE((t.value - (p.value - p.value_growth)) * 100.0 / (p.value - p.value_growth), 0) ELSE 0 END,
+                              xp_growth_pc = CASE WHEN (p.xp - p.xp_growth != 0) THEN COALESCE((t.xp - (p.xp - p.xp_growth)) * 100.0 / (p.xp - p.xp_growth), 0) ELSE 0 END,
+                         """ + ((
+                         """
+                              %ssize_rank_change = t.%ssize_rank - COALESCE(p.%ssize_rank - p.%ssize_rank_change, 0),
+                              %sscore_rank_change = t.%sscore_rank - COALESCE(p.%sscore_rank - p.%sscore_rank_change, 0),
+                              %svalue_rank_change = t.%svalue_rank - COALESCE(p.%svalue_rank - p.%svalue_rank_change, 0),
+                              %sxp_rank_change = t.%sxp_rank - COALESCE(p.%sxp_rank - p.%sxp_rank_change, 0),
+                              %stotalroundroids_rank_change = t.%stotalroundroids_rank - COALESCE(p.%stotalroundroids_rank - p.%stotalroundroids_rank_change, 0),
+                              %stotallostroids_rank_change = t.%stotallostroids_rank - COALESCE(p.%stotallostroids_rank - p.%stotallostroids_rank_change, 0),
+                         """ * 4) % (("",)*24 + ("cluster_",)*24 + ("galaxy_",)*24 + ("race_",)*24)) +
+                         """
+                              totalroundroids_growth = t.totalroundroids - COALESCE(p.totalroundroids - p.totalroundroids_growth, 0),
+                              totalroundroids_growth_pc = CASE WHEN (p.totalroundroids - p.totalroundroids_growth != 0) THEN COALESCE((t.totalroundroids - (p.totalroundroids - p.totalroundroids_growth)) * 100.0 / (p.totalroundroids - p.totalroundroids_growth), 0) ELSE 0 END,
+                              totallostroids_growth = t.totallostroids - COALESCE(p.totallostroids - p.totallostroids_growth, 0),
+                              totallostroids_growth_pc = CASE WHEN (p.totallostroids - p.totallostroids_growth != 0) THEN COALESCE((t.totallostroids - (p.totallostroids - p.totallostroids_growth)) * 100.0 / (p.totallostroids - p.totallostroids_growth), 0) ELSE 0 END,
+                         """ ) if not midnight
+                             else (
+                         """
+                              size_growth = t.size - COALESCE(p.size, 0),
+                              score_growth = t.score - COALESCE(p.score, 0),
+                              value_growth = t.value - COALESCE(p.value, 0),
+                              xp_growth = t.xp - COALESCE(p.xp, 0),
+                              size_growth_pc = CASE WHEN (p.size != 0) THEN COALESCE((t.size - p.size) * 100.0 / p.size, 0) ELSE 0 END,
+                              score_growth_pc = CASE WHEN (p.score != 0) THEN COALESCE((t.score - p.score) * 100.0 / p.score, 0) ELSE 0 END,
+                              value_growth_pc = CASE WHEN (p.value != 0) THEN COALESCE((t.value - p.value) * 100.0 / p.value, 0) ELSE 0 END,
+                              xp_growth_pc = CASE WHEN (p.xp != 0) THEN COALESCE((t.xp - p.xp) * 100.0 / p.xp, 0) ELSE 0 END,
+                         """ + ((
+                         """
+                              %ssize_rank_change = t.%ssize_rank - COALESCE(p.%ssize_rank, 0),
+                              %sscore_rank_change = t.%sscore_rank - COALESCE(p.%sscore_rank, 0),
+                              %svalue_rank_change = t.%svalue_rank - COALESCE(p.%svalue_rank, 0),
+                              %sxp_rank_change = t.%sxp_rank - COALESCE(p.%sxp_rank, 0),
+                              %stotalroundroids_rank_change = t.%stotalroundroids_rank - COALESCE(p.%stotalroundroids_rank, 0),
+                              %stotallostroids_rank_change = t.%stotallostroids_rank - COALESCE(p.%stotallostroids_rank, 0),
+                         """ * 4) % (("",)*18 + ("cluster_",)*18 + ("galaxy_",)*18 + ("race_",)*18)) +
+                         """
+                              totalroundroids_growth = t.totalroundroids - COALESCE(p.totalroundroids, 0),
+                              totalroundroids_growth_pc = CASE WHEN (p.totalroundroids != 0) THEN COALESCE((t.totalroundroids - p.totalroundroids) * 100.0 / p.totalroundroids, 0) ELSE 0 END,
+                              totallostroids_growth = t.totallostroids - COALESCE(p.totallostroids, 0),
+                              totallostroids_growth_pc = CASE WHEN (p.totallostroids != 0) THEN COALESCE((t.totallostroids - p.totallostroids) * 100.0 / p.totallostroids, 0) ELSE 0 END,
+                         """ )) +
+                         """
+                              totalroundroids = t.totalroundroids, totallostroids = t.totallostroids,
+                         """ + ((
+                         """
+                              %ssize_rank = t.%ssize_rank, %sscore_rank = t.%sscore_rank, %svalue_rank = t.%svalue_rank, %sxp_rank = t.%sxp_rank,
+                              %stotalroundroids_rank = t.%stotalroundroids_rank, %stotallostroids_rank = t.%stotallostroids_rank,
+                         """ * 4) % (("",)*12 + ("cluster_",)*12 + ("galaxy_",)*12 + ("race_",)*12)) +
+                         """
+                              ticksroiding = COALESCE(p.ticksroiding, 0) + CASE WHEN (t.size > p.size AND (t.size - p.size) != (t.xp - p.xp)) THEN 1 ELSE 0 END,
+                              ticksroided = COALESCE(p.ticksroided, 0) + CASE WHEN (t.size < p.size) THEN 1 ELSE 0 END,
+                              tickroids = COALESCE(p.tickroids, 0) + t.size,
+                              avroids = COALESCE((p.tickroids + t.size) / (p.age + 1.0), t.size),
+                              roidxp = CASE WHEN (t.size != 0) THEN t.xp * 1.0 / t.size ELSE 0 END,
+                         """ + ((
+                         """
+                              %s_highest_rank = CASE WHEN (t.%s_rank <= COALESCE(p.%s_highest_rank, t.%s_rank)) THEN t.%s_rank ELSE p.%s_highest_rank END,
+                              %s_highest_rank_tick = CASE WHEN (t.%s_rank <= COALESCE(p.%s_highest_rank, t.%s_rank)) THEN :tick ELSE p.%s_highest_rank_tick END,
+                              %s_lowest_rank = CASE WHEN (t.%s_rank >= COALESCE(p.%s_lowest_rank, t.%s_rank)) THEN t.%s_rank ELSE p.%s_lowest_rank END,
+                              %s_lowest_rank_tick = CASE WHEN (t.%s_rank >= COALESCE(p.%s_lowest_rank, t.%s_rank)) THEN :tick ELSE p.%s_lowest_rank_tick END,
+                         """ * 4) % (("size",)*22 + ("score",)*22 + ("value",)*22 + ("xp",)*22)) +
+                         """
+                              vdiff = COALESCE(t.value - p.value, 0),
+                              sdiff = COALESCE(t.score - p.score, 0),
+                              xdiff = COALESCE(t.xp - p.xp, 0),
+                              rdiff = COALESCE(t.size - p.size, 0),
+                              vrankdiff = COALESCE(t.value_rank - p.value_rank, 0),
+                              srankdiff = COALESCE(t.score_rank - p.score_rank, 0),
+                              xrankdiff = COALESCE(t.xp_rank - p.xp_rank, 0),
+                              rrankdiff = COALESCE(t.size_rank - p.size_rank, 0),
+                              idle = CASE WHEN ((t.value-p.value) BETWEEN (p.vdiff-1) AND (p.vdiff+1) AND (p.xp-t.xp=0)) THEN 1 + COALESCE(p.idle, 0) ELSE 0 END
+                            FROM (SELECT *,
+                         """ + ((
+                         """
+                              rank() OVER (PARTITION BY %s ORDER BY totalroundroids DESC) AS %s_totalroundroids_rank,
+                              rank() OVER (PARTITION BY %s ORDER BY totallostroids DESC) AS %s_totallostroids_rank,
+                              rank() OVER (PARTITION BY %s ORDER BY size DESC) AS %s_size_rank,
+                              rank() OVER (PARTITION BY %s ORDER BY score DESC) AS %s_score_rank,
+                              rank() OVER (PARTITION BY %s ORDER BY value DESC) AS %s_value_rank,
+                              rank() OVER (PARTITION BY %s ORDER BY xp DESC) AS %s_xp_rank,
+                         """ * 3) % (("x","cluster",)*6 + ("x, y","galaxy",)*6 + ("race","race",)*6)) +
+                         """
+                              rank() OVER (ORDER BY totalroundroids DESC) AS totalroundroids_rank,
+                              rank() OVER (ORDER BY totallostroids DESC) AS totallostroids_rank,
+                              rank() OVER (ORDER BY size DESC) AS size_rank,
+                              rank() OVER (ORDER BY score DESC) AS score_rank,
+                              rank() OVER (ORDER BY value DESC) AS value_rank,
+                              rank() OVER (ORDER BY xp DESC) AS xp_rank
+                            FROM (SELECT t.*,
+                              COALESCE(p.totalroundroids + (GREATEST(t.size - p.size, 0)), t.size) AS totalroundroids,
+                              COALESCE(p.totallostroids + (GREATEST(p.size - t.size, 0)), 0) AS totallostroids
+                            FROM planet AS p, planet_temp AS t
+                              WHERE p.id = t.id AND p.active = :true) AS t) AS t
+                              WHERE p.id = t.id
+                            AND p.active = :true
+                        ;""", bindparams=[tick, true]))
+    
+    t2=time.time()-t1
+    stagelog("Update planets from temp and generate ranks", t2)
+    t1=time.time()
+    
+    # Idle data
+    session.execute(text("""INSERT INTO planet_idles (hour, tick, id, idle)
+                            SELECT :hour, :tick, planet.id, planet.idle
+                            FROM planet
+                            WHERE
+                                planet.idle > 0 AND
+                                planet.active = :true
+                        ;""", bindparams=[tick, hour, true]))
+    # Value drops
+    session.execute(text("""INSERT INTO planet_value_drops (hour, tick, id, vdiff)
+                            SELECT :hour, :tick, planet.id, planet.vdiff
+                            FROM planet
+                            WHERE
+                                planet.vdiff < 0 AND
+                                planet.active = :true
+                        ;""", bindparams=[tick, hour, true]))
+    # Landings
+    session.execute(text("""INSERT INTO planet_landings (hour, tick, id, rdiff)
+                            SELECT :hour, :tick, planet.id, planet.rdiff
+                            FROM planet
+                            WHERE
+                                planet.rdiff > 0 AND
+                                planet.rdiff != planet.xdiff AND
+                                planet.active = :true
+                        ;""", bindparams=[tick, hour, true]))
+    # Landed on
+    session.execute(text("""INSERT INTO planet_landed_on (hour, tick, id, rdiff)
+                            SELECT :hour, :tick, planet.id, planet.rdiff
+                            FROM planet
+                            WHERE
+                                planet.rdiff < 0 AND
+                                planet.active = :true
+                        ;""", bindparams=[tick, hour, true]))
+    
+    t2=time.time()-t1
+    stagelog("Planet stats", t2)
+    t1=time.time()
+    
+    # ########################################################################### #
+    # #############################    ALLIANCES    ############################# #
+    # ########################################################################### #
+    
+    # Update the newly dumped data with IDs from the current data
+    #  based on a name match in the two tables (and active=True)
+    session.execute(text("""UPDATE alliance_temp AS t SET
+                              id = a.id
+                            FROM (SELECT id, name FROM alliance) AS a
+                              WHERE t.name = a.name
+                        ;"""))
+    
+    # Make sure all the alliances are active,
+    #  some might have been deactivated previously
+    session.execute(text("UPDATE alliance SET active = :true;", bindparams=[true]))
+    
+    t2=time.time()-t1
+    stagelog("Copy alliance ids to temp and activate", t2)
+    t1=time.time()
+    
+    # Any alliances in the temp table without an id are new
+    # Insert them to the current table and the id(serial/auto_increment)
+    #  will be generated, and we can then copy it back to the temp table
+    session.execute(text("INSERT INTO alliance (name, active) SELECT name, :true FROM alliance_temp WHERE id IS NULL;", bindparams=[true]))
+    session.execute(text("UPDATE alliance_temp SET id = (SELECT id FROM alliance WHERE alliance.name = alliance_temp.name AND alliance.active = :true ORDER BY alliance.id DESC) WHERE id IS NULL;", bindparams=[true]))
+    
+    # For alliances that are no longer present in the new dump, we will
+    #  NULL all the data, leaving only the name and id for FKs
+    session.execute(text("UPDATE alliance SET active = :false WHERE id NOT IN (SELECT id FROM alliance_temp WHERE id IS NOT NULL);", bindparams=[false]))
+    
+    t2=time.time()-t1
+    stagelog("Deactivate old alliances and generate new alliance ids", t2)
+    t1=time.time()
+    
+    # Update everything from the temp table and generate ranks
+    # Deactivated items are untouched but NULLed earlier
+    session.execute(text("""UPDATE alliance AS a SET
+                              age = COALESCE(a.age, 0) + 1,
+                              size = t.size, members = t.members, score = t.score, points = t.points,
+                              score_total = t.score_total, value_total = t.value_total,
+                              xp = (t.score_total - t.value_total) / 60,
+                              size_avg = t.size_avg, score_avg = t.score_avg, points_avg = t.points_avg,
+                              ratio = CASE WHEN (t.score != 0) THEN 10000.0 * t.size / t.score ELSE 0 END,
+                         """ + (
+                         """
+                              size_growth = t.size - COALESCE(a.size - a.size_growth, 0),
+                              score_growth = t.score - COALESCE(a.score - a.score_growth, 0),
+                              points_growth = t.points - COALESCE(a.points - a.points_growth, 0),
+                              member_growth = t.members - COALESCE(a.members - a.member_growth, 0),
+                              size_growth_pc = CASE WHEN (a.size - a.size_growth != 0) THEN COALESCE((t.size - (a.size - a.size_growth)) * 100.0 / (a.size - a.size_growth), 0) ELSE 0 END,
+                              score_growth_pc = CASE WHEN (a.score - a.score_growth != 0) THEN COALESCE((t.score - (a.score - a.score_growth)) * 100.0 / (a.score - a.score_growth), 0) ELSE 0 END,
+                              points_growth_pc = CASE WHEN (a.points - a.points_growth != 0) THEN COALESCE((t.points - (a.points - a.points_growth)) * 100.0 / (a.points - a.points_growth), 0) ELSE 0 END,
+                              size_avg_growth = t.size_avg - COALESCE(a.size_avg - a.size_avg_growth, 0),
+                              score_avg_growth = t.score_avg - COALESCE(a.score_avg - a.score_avg_growth, 0),
+                              points_avg_growth = t.points_avg - COALESCE(a.points_avg - a.points_avg_growth, 0),
+                              size_avg_growth_pc = CASE WHEN (a.size_avg - a.size_avg_growth != 0) THEN COALESCE((t.size_avg - (a.size_avg - a.size_avg_growth)) * 100.0 / (a.size_avg - a.size_avg_growth), 0) ELSE 0 END,
+                              score_avg_growth_pc = CASE WHEN (a.score_avg - a.score_avg_growth != 0) THEN COALESCE((t.score_avg - (a.score_avg - a.score_avg_growth)) * 100.0 / (a.score_avg - a.score_avg_growth), 0) ELSE 0 END,
+                              points_avg_growth_pc = CASE WHEN (a.points_avg - a.points_avg_growth != 0) THEN COALESCE((t.points_avg - (a.points_avg - a.points_avg_growth)) * 100.0 / (a.points_avg - a.points_avg_growth), 0) ELSE 0 END,
+                              size_rank_change = t.size_rank - COALESCE(a.size_rank - a.size_rank_change, 0),
+                              members_rank_change = t.members_rank - COALESCE(a.members_rank - a.members_rank_change, 0),
+                              score_rank_change = t.score_rank - COALESCE(a.score_rank - a.score_rank_change, 0),
+                              points_rank_change = t.points_rank - COALESCE(a.points_rank - a.points_rank_change, 0),
+                              size_avg_rank_change = t.size_avg_rank - COALESCE(a.size_avg_rank - a.size_avg_rank_change, 0),
+                              score_avg_rank_change = t.score_avg_rank - COALESCE(a.score_avg_rank - a.score_avg_rank_change, 0),
+                              points_avg_rank_change = t.points_avg_rank - COALESCE(a.points_avg_rank - a.points_avg_rank_change, 0),
+                              totalroundroids_rank_change = t.totalroundroids_rank - COALESCE(a.totalroundroids_rank - a.totalroundroids_rank_change, 0),
+                              totallostroids_rank_change = t.totallostroids_rank - COALESCE(a.totallostroids_rank - a.totallostroids_rank_change, 0),
+                              totalroundroids_growth = t.totalroundroids - COALESCE(a.totalroundroids - a.totalroundroids_growth, 0),
+                              totalroundroids_growth_pc = CASE WHEN (a.totalroundroids - a.totalroundroids_growth != 0) THEN COALESCE((t.totalroundroids - (a.totalroundroids - a.totalroundroids_growth)) * 100.0 / (a.totalroundroids - a.totalroundroids_growth), 0) ELSE 0 END,
+                              totallostroids_growth = t.totallostroids - COALESCE(a.totallostroids - a.totallostroids_growth, 0),
+                              totallostroids_growth_pc = CASE WHEN (a.totallostroids - a.totallostroids_growth != 0) THEN COALESCE((t.totallostroids - (a.totallostroids - a.totallostroids_growth)) * 100.0 / (a.totallostroids - a.totallostroids_growth), 0) ELSE 0 END,
+                         """ if not midnight
+                             else
+                         """
+                              size_growth = t.size - COALESCE(a.size, 0),
+                              score_growth = t.score - COALESCE(a.score, 0),
+                              points_growth = t.points - COALESCE(a.points, 0),
+                              member_growth = t.members - COALESCE(a.members, 0),
+                              size_growth_pc = CASE WHEN (a.size != 0) THEN COALESCE((t.size - a.size) * 100.0 / a.size, 0) ELSE 0 END,
+                              score_growth_pc = CASE WHEN (a.score != 0) THEN COALESCE((t.score - a.score) * 100.0 / a.score, 0) ELSE 0 END,
+                              points_growth_pc = CASE WHEN (a.points != 0) THEN COALESCE((t.points - a.points) * 100.0 / a.points, 0) ELSE 0 END,
+                              size_avg_growth = t.size_avg - COALESCE(a.size_avg, 0),
+                              score_avg_growth = t.score_avg - COALESCE(a.score_avg, 0),
+                              points_avg_growth = t.points_avg - COALESCE(a.points_avg, 0),
+                              size_avg_growth_pc = CASE WHEN (a.size_avg != 0) THEN COALESCE((t.size_avg - a.size_avg) * 100.0 / a.size_avg, 0) ELSE 0 END,
+                              score_avg_growth_pc = CASE WHEN (a.score_avg != 0) THEN COALESCE((t.score_avg - a.score_avg) * 100.0 / a.score_avg, 0) ELSE 0 END,
+                              points_avg_growth_pc = CASE WHEN (a.points_avg != 0) THEN COALESCE((t.points_avg - a.points_avg) * 100.0 / a.points_avg, 0) ELSE 0 END,
+                              size_rank_change = t.size_rank - COALESCE(a.size_rank, 0),
+                              members_rank_change = t.members_rank - COALESCE(a.members_rank, 0),
+                              score_rank_change = t.score_rank - COALESCE(a.score_rank, 0),
+                              points_rank_change = t.points_rank - COALESCE(a.points_rank, 0),
+                              size_avg_rank_change = t.size_avg_rank - COALESCE(a.size_avg_rank, 0),
+                              score_avg_rank_change = t.score_avg_rank - COALESCE(a.score_avg_rank, 0),
+                              points_avg_rank_change = t.points_avg_rank - COALESCE(a.points_avg_rank, 0),
+                              totalroundroids_rank_change = t.totalroundroids_rank - COALESCE(a.totalroundroids_rank, 0),
+                              totallostroids_rank_change = t.totallostroids_rank - COALESCE(a.totallostroids_rank, 0),
+                              totalroundroids_growth = t.totalroundroids - COALESCE(a.totalroundroids, 0),
+                              totalroundroids_growth_pc = CASE WHEN (a.totalroundroids != 0) THEN COALESCE((t.totalroundroids - a.totalroundroids) * 100.0 / a.totalroundroids, 0) ELSE 0 END,
+                              totallostroids_growth = t.totallostroids - COALESCE(a.totallostroids, 0),
+                              totallostroids_growth_pc = CASE WHEN (a.totallostroids != 0) THEN COALESCE((t.totallostroids - a.totallostroids) * 100.0 / a.totallostroids, 0) ELSE 0 END,
+                         """ ) +
+                         """
+                              ticksroiding = COALESCE(a.ticksroiding, 0) + CASE WHEN (t.size > a.size) THEN 1 ELSE 0 END,
+                              ticksroided = COALESCE(a.ticksroided, 0) + CASE WHEN (t.size < a.size) THEN 1 ELSE 0 END,
+                              tickroids = COALESCE(a.tickroids, 0) + t.size,
+                              avroids = COALESCE((a.tickroids + t.size) / (a.age + 1.0), t.size),
+                         """ + ((
+                         """
+                              %s_highest_rank = CASE WHEN (t.%s_rank <= COALESCE(a.%s_highest_rank, t.%s_rank)) THEN t.%s_rank ELSE a.%s_highest_rank END,
+                              %s_highest_rank_tick = CASE WHEN (t.%s_rank <= COALESCE(a.%s_highest_rank, t.%s_rank)) THEN :tick ELSE a.%s_highest_rank_tick END,
+                              %s_lowest_rank = CASE WHEN (t.%s_rank >= COALESCE(a.%s_lowest_rank, t.%s_rank)) THEN t.%s_rank ELSE a.%s_lowest_rank END,
+                              %s_lowest_rank_tick = CASE WHEN (t.%s_rank >= COALESCE(a.%s_lowest_rank, t.%s_rank)) THEN :tick ELSE a.%s_lowest_rank_tick END,
+                         """ * 7) % (("size",)*22 + ("members",)*22 + ("score",)*22 + ("points",)*22 + ("size_avg",)*22 + ("score_avg",)*22 + ("points_avg",)*22)) +
+                         """
+                              totalroundroids = t.totalroundroids, totallostroids = t.totallostroids,
+                              totalroundroids_rank = t.totalroundroids_rank, totallostroids_rank = t.totallostroids_rank,
+                              size_rank = t.size_rank, members_rank = t.members_rank, score_rank = t.score_rank, points_rank = t.points_rank,
+                              size_avg_rank = t.size_avg_rank, score_avg_rank = t.score_avg_rank, points_avg_rank = t.points_avg_rank,
+                              sdiff = COALESCE(t.score - a.score, 0),
+                              pdiff = COALESCE(t.points - a.points, 0),
+                              rdiff = COALESCE(t.size - a.size, 0),
+                              mdiff = COALESCE(t.members - a.members, 0),
+                              srankdiff = COALESCE(t.score_rank - a.score_rank, 0),
+                              prankdiff = COALESCE(t.points_rank - a.points_rank, 0),
+                              rrankdiff = COALESCE(t.size_rank - a.size_rank, 0),
+                              mrankdiff = COALESCE(t.members_rank - a.members_rank, 0),
+                              savgdiff = COALESCE(t.score_avg - a.score_avg, 0),
+                              pavgdiff = COALESCE(t.points_avg - a.points_avg, 0),
+                              ravgdiff = COALESCE(t.size_avg - a.size_avg, 0),
+                              savgrankdiff = COALESCE(t.score_avg_rank - a.score_avg_rank, 0),
+                              pavgrankdiff = COALESCE(t.points_avg_rank - a.points_avg_rank, 0),
+                              ravgrankdiff = COALESCE(t.size_avg_rank - a.size_avg_rank, 0),
+                              idle = CASE WHEN ((t.score-a.score) BETWEEN (a.sdiff-1) AND (a.sdiff+1)) THEN 1 + COALESCE(a.idle, 0) ELSE 0 END
+                            FROM (SELECT *,
+                              rank() OVER (ORDER BY totalroundroids DESC) AS totalroundroids_rank,
+                              rank() OVER (ORDER BY totallostroids DESC) AS totallostroids_rank,
+                              rank() OVER (ORDER BY size DESC) AS size_rank,
+                              rank() OVER (ORDER BY points DESC) AS points_rank,
+                              rank() OVER (ORDER BY members DESC) AS members_rank,
+                              rank() OVER (ORDER BY size_avg DESC) AS size_avg_rank,
+                              rank() OVER (ORDER BY score_avg DESC) AS score_avg_rank,
+                              rank() OVER (ORDER BY points_avg DESC) AS points_avg_rank
+                            FROM (SELECT t.*,
+                              COALESCE(a.totalroundroids + (GREATEST(t.size - a.size, 0)), t.size) AS totalroundroids,
+                              COALESCE(a.totallostroids + (GREATEST(a.size - t.size, 0)), 0) AS totallostroids
+                            FROM alliance AS a, alliance_temp AS t
+                              WHERE a.id = t.id AND a.active = :true) AS t) AS t
+                              WHERE a.id = t.id
+                            AND a.active = :true
+                        ;""", bindparams=[tick, true]))
+    
+    t2=time.time()-t1
+    stagelog("Update alliances from temp and generate ranks", t2)
+    t1=time.time()
+    
+    # ########################################################################### #
+    # ##################   HISTORY: EVERYTHING BECOMES FINAL   ################## #
+    # ########################################################################### #
+    
+    # Update stats
+    session.execute(text("""UPDATE updates SET
+                              clusters  = (SELECT count(*) FROM cluster  WHERE cluster.active  = :true),
+                              galaxies  = (SELECT count(*) FROM galaxy   WHERE galaxy.active   = :true),
+                              planets   = (SELECT count(*) FROM planet   WHERE planet.active   = :true),
+                              alliances = (SELECT count(*) FROM alliance WHERE alliance.active = :true),
+                              c200     = (SELECT count(*) FROM planet WHERE planet.active = :true AND x = 200),
+                              ter      = (SELECT count(*) FROM planet WHERE planet.active = :true AND race ILIKE 'ter%'),
+                              cat      = (SELECT count(*) FROM planet WHERE planet.active = :true AND race ILIKE 'cat%'),
+                              xan      = (SELECT count(*) FROM planet WHERE planet.active = :true AND race ILIKE 'xan%'),
+                              zik      = (SELECT count(*) FROM planet WHERE planet.active = :true AND race ILIKE 'zik%'),
+                              etd      = (SELECT count(*) FROM planet WHERE planet.active = :true AND race ILIKE 'etd%')
+                            WHERE updates.id = :tick
+                        ;""", bindparams=[tick, true]))
+    
+    t2=time.time()-t1
+    stagelog("Update stats", t2)
+    t1=time.time()
+    
+    # Copy the dumps to their respective history tables
+    partition_history(planets.tick)
+    session.execute(text("INSERT INTO cluster_history SELECT :tick, :hour, :timestamp, * FROM cluster ORDER BY x ASC;", bindparams=[tick, hour, timestamp]))
+    session.execute(text("INSERT INTO galaxy_history SELECT :tick, :hour, :timestamp, * FROM galaxy ORDER BY id ASC;", bindparams=[tick, hour, timestamp]))
+    session.execute(text("INSERT INTO planet_history SELECT :tick, :hour, :timestamp, * FROM planet ORDER BY id ASC;", bindparams=[tick, hour, timestamp]))
+    session.execute(text("INSERT INTO alliance_history SELECT :tick, :hour, :timestamp, * FROM alliance ORDER BY id ASC;", bindparams=[tick, hour, timestamp]))
+    
+    t2=time.time()-t1
+    stagelog("History", t2)
 
 
 def ticker(alt=False):
@@ -377,6 +1311,9 @@ def ticker(alt=False):
     t1=t_start
 
     while True:
+        # Only keep the timings of the attempt that processes the tick, not
+        #  those of failed attempts or of one abandoned to catch up
+        del timings[:]
         try:
             # Get the previous tick number!
             last_tick = Updates.current_tick()
@@ -400,8 +1337,11 @@ def ticker(alt=False):
                 continue
 
             # Get header information now, as the headers will be lost if we save dumps
-            etag = pdump.headers.get("ETag")
-            modified = pdump.headers.get("Last-Modified")
+            headers = {}
+            for name, dump in (("", pdump), ("galaxy_", gdump), ("alliance_", adump), ("feed_", udump),):
+                if dump:
+                    headers[name+"etag"] = dump.headers.get("ETag")
+                    headers[name+"modified"] = dump.headers.get("Last-Modified")
     
             if savedumps:
                 try:
@@ -434,10 +1374,10 @@ def ticker(alt=False):
 
             # Parse botfile headers
             try:
-                planets   = botfile(pdump)
-                galaxies  = botfile(gdump)
-                alliances = botfile(adump)
-                userfeed = botfile(udump) if udump else None
+                planets   = planetfile(pdump)
+                galaxies  = galaxyfile(gdump)
+                alliances = alliancefile(adump)
+                userfeed  = feedfile(udump) if udump else None
             except TypeError as e:
                 excaliburlog("Error: %s" % e)
                 time.sleep(60)
@@ -456,14 +1396,20 @@ def ticker(alt=False):
                 time.sleep(60)
                 continue
     
+            # The other dumps are streamed into the temp tables as they download,
+            #  but the userfeed isn't parsed until after the tick is committed
+            if userfeed:
+                userfeed.buffer()
+    
             t2=time.time()-t1
-            excaliburlog("Loaded dumps from webserver in %.3f seconds" % (t2,))
+            stagelog("Loaded dump headers from webserver", t2)
             t1=time.time()
     
             if catchup_enabled and planets.tick > last_tick + 1:
                 if not alt:
                     excaliburlog("Found missing ticks. Catching up...")
                     ticker(planets.tick-1)
+                    t1=time.time()
                     continue
                 if planets.tick > alt:
                     excaliburlog("Something is very, very wrong...")
@@ -472,763 +1418,14 @@ def ticker(alt=False):
     ##      # Uncomment this line to allow ticking on the same data for debug
     ##      # planet_tick = last_tick + 1
     
-            tick = bindparam("tick",planets.tick)
-    
-            # Insert a record of the tick and a timestamp generated by SQLA
-            session.execute(Updates.__table__.insert().values(id=planets.tick, etag=etag, modified=modified))
-    
-            # Empty out the temp tables
-            session.execute(galaxy_temp.delete())
-            session.execute(planet_temp.delete())
-            session.execute(alliance_temp.delete())
-    
-            # Insert the data to the temporary tables
-            # Planets
-            tmplist = [{
-                        "id": p[0].strip("\""),
-                        "x": int(p[1]),
-                        "y": int(p[2]),
-                        "z": int(p[3]),
-                        "planetname": p[4].strip("\""),
-                        "rulername": p[5].strip("\""),
-                        "race": p[6],
-                        "size": int(p[7] or 0),
-                        "score": int(p[8] or 0),
-                        "value": int(p[9] or 0),
-                        "xp": int(p[10] or 0),
-                        "special": p[11].strip("\""),
-                       } for p in [decode(line).strip().split(planets.header["Separator"]) for line in planets]] if planets else None
-            session.execute(planet_temp.insert(), tmplist) if tmplist else None
-            # Galaxies
-            tmplist = [{
-                        "x": int(g[0]),
-                        "y": int(g[1]),
-                        "name": g[2].strip("\""),
-                        "size": int(g[3] or 0),
-                        "score": int(g[4] or 0),
-                        "value": int(g[5] or 0),
-                        "xp": int(g[6] or 0),
-                       } for g in [decode(line).strip().split(galaxies.header["Separator"]) for line in galaxies]] if galaxies else None
-            session.execute(galaxy_temp.insert(), tmplist) if tmplist else None
-            # Alliances
-            tmplist = [{
-                        "score_rank": int(a[0]),
-                        "name": a[1].strip("\""),
-                        "size": int(a[2] or 0),
-                        "members": int(a[3] or 1),
-                        "score": int(a[4] or 0),
-                        "points": int(a[5] or 0),
-                        "score_total": int(a[6] or 0),
-                        "value_total": int(a[7] or 0),
-                        "size_avg": int(a[2] or 0) / int(a[3] or 1),
-                        "score_avg": int(a[4] or 0) / min(int(a[3] or 1), PA.getint("numbers", "tag_count")),
-                        "points_avg": int(a[5] or 0) / int(a[3] or 1),
-                       } for a in [decode(line).strip().split(alliances.header["Separator"]) for line in alliances]] if alliances else None
-            session.execute(alliance_temp.insert(), tmplist) if tmplist else None
-    
-            t2=time.time()-t1
-            excaliburlog("Inserted dumps in %.3f seconds" % (t2,))
-            t1=time.time()
-    
-    # ########################################################################### #
-    # ##############################    CLUSTERS    ############################# #
-    # ########################################################################### #
-    
-            # Make sure all the galaxies are active,
-            #  some might have been deactivated previously
-            session.execute(text("UPDATE cluster SET active = :true;", bindparams=[true]))
-    
-            # Any galaxies in the temp table without an id are new
-            # Insert them to the current table and the id(serial/auto_increment)
-            #  will be generated, and we can then copy it back to the temp table
-            session.execute(text("INSERT INTO cluster (x, active) SELECT g.x, :true FROM galaxy_temp as g WHERE g.x NOT IN (SELECT x FROM cluster) GROUP BY g.x;", bindparams=[true]))
-    
-            # For galaxies that are no longer present in the new dump
-            session.execute(text("UPDATE cluster SET active = :false WHERE x NOT IN (SELECT x FROM galaxy_temp);", bindparams=[false]))
-    
-            t2=time.time()-t1
-            excaliburlog("Deactivate old clusters and generate new cluster ids in %.3f seconds" % (t2,))
-            t1=time.time()
-    
-            # Update everything from the temp table and generate ranks
-            # Deactivated items are untouched but NULLed earlier
-            session.execute(text("""UPDATE cluster AS c SET
-                                      age = COALESCE(c.age, 0) + 1,
-                                      size = t.size, score = t.score, value = t.value, xp = t.xp,
-                                      ratio = CASE WHEN (t.value != 0) THEN 10000.0 * t.size / t.value ELSE 0 END,
-                                      members = t.count,
-                                 """ + (
-                                 """
-                                      size_growth = t.size - COALESCE(c.size - c.size_growth, 0),
-                                      score_growth = t.score - COALESCE(c.score - c.score_growth, 0),
-                                      value_growth = t.value - COALESCE(c.value - c.value_growth, 0),
-                                      xp_growth = t.xp - COALESCE(c.xp - c.xp_growth, 0),
-                                      member_growth = t.count - COALESCE(c.members - c.member_growth, 0),
-                                      size_growth_pc = CASE WHEN (c.size - c.size_growth != 0) THEN COALESCE((t.size - (c.size - c.size_growth)) * 100.0 / (c.size - c.size_growth), 0) ELSE 0 END,
-                                      score_growth_pc = CASE WHEN (c.score - c.score_growth != 0) THEN COALESCE((t.score - (c.score - c.score_growth)) * 100.0 / (c.score - c.score_growth), 0) ELSE 0 END,
-                                      value_growth_pc = CASE WHEN (c.value - c.value_growth != 0) THEN COALESCE((t.value - (c.value - c.value_growth)) * 100.0 / (c.value - c.value_growth), 0) ELSE 0 END,
-                                      xp_growth_pc = CASE WHEN (c.xp - c.xp_growth != 0) THEN COALESCE((t.xp - (c.xp - c.xp_growth)) * 100.0 / (c.xp - c.xp_growth), 0) ELSE 0 END,
-                                      size_rank_change = t.size_rank - COALESCE(c.size_rank - c.size_rank_change, 0),
-                                      score_rank_change = t.score_rank - COALESCE(c.score_rank - c.score_rank_change, 0),
-                                      value_rank_change = t.value_rank - COALESCE(c.value_rank - c.value_rank_change, 0),
-                                      xp_rank_change = t.xp_rank - COALESCE(c.xp_rank - c.xp_rank_change, 0),
-                                      totalroundroids_rank_change = t.totalroundroids_rank - COALESCE(c.totalroundroids_rank - c.totalroundroids_rank_change, 0),
-                                      totallostroids_rank_change = t.totallostroids_rank - COALESCE(c.totallostroids_rank - c.totallostroids_rank_change, 0),
-                                      totalroundroids_growth = t.totalroundroids - COALESCE(c.totalroundroids - c.totalroundroids_growth, 0),
-                                      totalroundroids_growth_pc = CASE WHEN (c.totalroundroids - c.totalroundroids_growth != 0) THEN COALESCE((t.totalroundroids - (c.totalroundroids - c.totalroundroids_growth)) * 100.0 / (c.totalroundroids - c.totalroundroids_growth), 0) ELSE 0 END,
-                                      totallostroids_growth = t.totallostroids - COALESCE(c.totallostroids - c.totallostroids_growth, 0),
-                                      totallostroids_growth_pc = CASE WHEN (c.totallostroids - c.totallostroids_growth != 0) THEN COALESCE((t.totallostroids - (c.totallostroids - c.totallostroids_growth)) * 100.0 / (c.totallostroids - c.totallostroids_growth), 0) ELSE 0 END,
-                                 """ if not midnight
-                                     else
-                                 """
-                                      size_growth = t.size - COALESCE(c.size, 0),
-                                      score_growth = t.score - COALESCE(c.score, 0),
-                                      value_growth = t.value - COALESCE(c.value, 0),
-                                      xp_growth = t.xp - COALESCE(c.xp, 0),
-                                      member_growth = t.count - COALESCE(c.members, 0),
-                                      size_growth_pc = CASE WHEN (c.size != 0) THEN COALESCE((t.size - c.size) * 100.0 / c.size, 0) ELSE 0 END,
-                                      score_growth_pc = CASE WHEN (c.score != 0) THEN COALESCE((t.score - c.score) * 100.0 / c.score * 100, 0) ELSE 0 END,
-                                      value_growth_pc = CASE WHEN (c.value != 0) THEN COALESCE((t.value - c.value) * 100.0 / c.value, 0) ELSE 0 END,
-                                      xp_growth_pc = CASE WHEN (c.xp != 0) THEN COALESCE((t.xp - c.xp) * 100.0 / c.xp, 0) ELSE 0 END,
-                                      size_rank_change = t.size_rank - COALESCE(c.size_rank, 0),
-                                      score_rank_change = t.score_rank - COALESCE(c.score_rank, 0),
-                                      value_rank_change = t.value_rank - COALESCE(c.value_rank, 0),
-                                      xp_rank_change = t.xp_rank - COALESCE(c.xp_rank, 0),
-                                      totalroundroids_rank_change = t.totalroundroids_rank - COALESCE(c.totalroundroids_rank, 0),
-                                      totallostroids_rank_change = t.totallostroids_rank - COALESCE(c.totallostroids_rank, 0),
-                                      totalroundroids_growth = t.totalroundroids - COALESCE(c.totalroundroids, 0),
-                                      totalroundroids_growth_pc = CASE WHEN (c.totalroundroids != 0) THEN COALESCE((t.totalroundroids - c.totalroundroids) * 100.0 / c.totalroundroids, 0) ELSE 0 END,
-                                      totallostroids_growth = t.totallostroids - COALESCE(c.totallostroids, 0),
-                                      totallostroids_growth_pc = CASE WHEN (c.totallostroids != 0) THEN COALESCE((t.totallostroids - c.totallostroids) * 100.0 / c.totallostroids, 0) ELSE 0 END,
-                                 """ ) +
-                                 """
-                                      ticksroiding = COALESCE(c.ticksroiding, 0) + CASE WHEN (t.size > c.size AND (t.size - c.size) != (t.xp - c.xp)) THEN 1 ELSE 0 END,
-                                      ticksroided = COALESCE(c.ticksroided, 0) + CASE WHEN (t.size < c.size) THEN 1 ELSE 0 END,
-                                      tickroids = COALESCE(c.tickroids, 0) + t.size,
-                                      avroids = COALESCE((c.tickroids + t.size) / (c.age + 1.0), t.size),
-                                      roidxp = CASE WHEN (t.size != 0) THEN t.xp * 1.0 / t.size ELSE 0 END,
-                                 """ + ((
-                                 """
-                                      %s_highest_rank = CASE WHEN (t.%s_rank <= COALESCE(c.%s_highest_rank, t.%s_rank)) THEN t.%s_rank ELSE c.%s_highest_rank END,
-                                      %s_highest_rank_tick = CASE WHEN (t.%s_rank <= COALESCE(c.%s_highest_rank, t.%s_rank)) THEN :tick ELSE c.%s_highest_rank_tick END,
-                                      %s_lowest_rank = CASE WHEN (t.%s_rank >= COALESCE(c.%s_lowest_rank, t.%s_rank)) THEN t.%s_rank ELSE c.%s_lowest_rank END,
-                                      %s_lowest_rank_tick = CASE WHEN (t.%s_rank >= COALESCE(c.%s_lowest_rank, t.%s_rank)) THEN :tick ELSE c.%s_lowest_rank_tick END,
-                                 """ * 4) % (("size",)*22 + ("score",)*22 + ("value",)*22 + ("xp",)*22)) +
-                                 """
-                                      totalroundroids = t.totalroundroids, totallostroids = t.totallostroids,
-                                      totalroundroids_rank = t.totalroundroids_rank, totallostroids_rank = t.totallostroids_rank,
-                                      size_rank = t.size_rank, score_rank = t.score_rank, value_rank = t.value_rank, xp_rank = t.xp_rank,
-                                      vdiff = COALESCE(t.value - c.value, 0),
-                                      sdiff = COALESCE(t.score - c.score, 0),
-                                      xdiff = COALESCE(t.xp - c.xp, 0),
-                                      rdiff = COALESCE(t.size - c.size, 0),
-                                      mdiff = COALESCE(t.count - c.members, 0),
-                                      vrankdiff = COALESCE(t.value_rank - c.value_rank, 0),
-                                      srankdiff = COALESCE(t.score_rank - c.score_rank, 0),
-                                      xrankdiff = COALESCE(t.xp_rank - c.xp_rank, 0),
-                                      rrankdiff = COALESCE(t.size_rank - c.size_rank, 0),
-                                      idle = CASE WHEN ((t.value-c.value) BETWEEN (c.vdiff-1) AND (c.vdiff+1) AND (c.xp-t.xp=0)) THEN 1 + COALESCE(c.idle, 0) ELSE 0 END
-                                    FROM (SELECT *,
-                                      rank() OVER (ORDER BY totalroundroids DESC) AS totalroundroids_rank,
-                                      rank() OVER (ORDER BY totallostroids DESC) AS totallostroids_rank,
-                                      rank() OVER (ORDER BY size DESC) AS size_rank,
-                                      rank() OVER (ORDER BY score DESC) AS score_rank,
-                                      rank() OVER (ORDER BY value DESC) AS value_rank,
-                                      rank() OVER (ORDER BY xp DESC) AS xp_rank
-                                    FROM (SELECT t.*,
-                                      COALESCE(c.totalroundroids + (GREATEST(t.size - c.size, 0)), t.size) AS totalroundroids,
-                                      COALESCE(c.totallostroids + (GREATEST(c.size - t.size, 0)), 0) AS totallostroids
-                                    FROM cluster AS c, (SELECT x,
-                                      count(*) as count,
-                                      sum(size) as size,
-                                      sum(value) as value,
-                                      sum(score) as score,
-                                      sum(xp) as xp
-                                    FROM planet_temp
-                                      GROUP BY x) AS t
-                                      WHERE c.x = t.x) AS t) AS t
-                                    WHERE c.x = t.x
-                                    AND c.active = :true
-                                ;""", bindparams=[tick, true]))
-    
-            t2=time.time()-t1
-            excaliburlog("Update clusters from temp and generate ranks in %.3f seconds" % (t2,))
-            t1=time.time()
-    
-    # We do galaxies before planets now in order to satisfy the planet(x,y) FK
-    
-    # ########################################################################### #
-    # ##############################    GALAXIES    ############################# #
-    # ########################################################################### #
-    
-            # Update the newly dumped data with IDs from the current data
-            #  based on an x,y match in the two tables (and active=True)
-            session.execute(text("""UPDATE galaxy_temp AS t SET
-                                      id = g.id
-                                    FROM (SELECT id, x, y FROM galaxy) AS g
-                                      WHERE t.x = g.x AND t.y = g.y
-                                ;"""))
-    
-            # Make sure all the galaxies are active,
-            #  some might have been deactivated previously
-            session.execute(text("UPDATE galaxy SET active = :true;", bindparams=[true]))
-    
-            t2=time.time()-t1
-            excaliburlog("Copy galaxy ids to temp and activate in %.3f seconds" % (t2,))
-            t1=time.time()
-    
-            # Any galaxies in the temp table without an id are new
-            # Insert them to the current table and the id(serial/auto_increment)
-            #  will be generated, and we can then copy it back to the temp table
-            # Galaxies under a certain amount of planets are private
-            session.execute(text("INSERT INTO galaxy (x, y, active) SELECT g.x, g.y, :true FROM galaxy_temp as g WHERE g.id IS NULL;", bindparams=[true]))
-            session.execute(text("UPDATE galaxy_temp SET id = (SELECT id FROM galaxy WHERE galaxy.x = galaxy_temp.x AND galaxy.y = galaxy_temp.y AND galaxy.active = :true ORDER BY galaxy.id DESC) WHERE id IS NULL;", bindparams=[true]))
-    
-            # For galaxies that are no longer present in the new dump
-            session.execute(text("UPDATE galaxy SET active = :false WHERE id NOT IN (SELECT id FROM galaxy_temp WHERE id IS NOT NULL);", bindparams=[false]))
-    
-            t2=time.time()-t1
-            excaliburlog("Deactivate old galaxies and generate new galaxy ids in %.3f seconds" % (t2,))
-            t1=time.time()
-    
-            # Update everything from the temp table and generate ranks
-            # Deactivated items are untouched but NULLed earlier
-            session.execute(text("""UPDATE galaxy AS g SET
-                                      age = COALESCE(g.age, 0) + 1,
-                                      x = t.x, y = t.y,
-                                      name = t.name, size = t.size, score = t.score, value = t.value, xp = t.xp,
-                                      ratio = CASE WHEN (t.value != 0) THEN 10000.0 * t.size / t.value ELSE 0 END,
-                                      members = p.count,
-                                      private = p.count <= :priv_gal OR (g.x = 1 AND g.y = 1),
-                                 """ + (
-                                 """
-                                      size_growth = t.size - COALESCE(g.size - g.size_growth, 0),
-                                      score_growth = t.score - COALESCE(g.score - g.score_growth, 0),
-                                      value_growth = t.value - COALESCE(g.value - g.value_growth, 0),
-                                      xp_growth = t.xp - COALESCE(g.xp - g.xp_growth, 0),
-                                      member_growth = p.count - COALESCE(g.members - g.member_growth, 0),
-                                      size_growth_pc = CASE WHEN (g.size - g.size_growth != 0) THEN COALESCE((t.size - (g.size - g.size_growth)) * 100.0 / (g.size - g.size_growth), 0) ELSE 0 END,
-                                      score_growth_pc = CASE WHEN (g.score - g.score_growth != 0) THEN COALESCE((t.score - (g.score - g.score_growth)) * 100.0 / (g.score - g.score_growth), 0) ELSE 0 END,
-                                      value_growth_pc = CASE WHEN (g.value - g.value_growth != 0) THEN COALESCE((t.value - (g.value - g.value_growth)) * 100.0 / (g.value - g.value_growth), 0) ELSE 0 END,
-                                      xp_growth_pc = CASE WHEN (g.xp - g.xp_growth != 0) THEN COALESCE((t.xp - (g.xp - g.xp_growth)) * 100.0 / (g.xp - g.xp_growth), 0) ELSE 0 END,
-                                      size_rank_change = t.size_rank - COALESCE(g.size_rank - g.size_rank_change, 0),
-                                      score_rank_change = t.score_rank - COALESCE(g.score_rank - g.score_rank_change, 0),
-                                      value_rank_change = t.value_rank - COALESCE(g.value_rank - g.value_rank_change, 0),
-                                      xp_rank_change = t.xp_rank - COALESCE(g.xp_rank - g.xp_rank_change, 0),
-                                      real_score_growth = p.real_score - COALESCE(g.real_score - g.real_score_growth, 0),
-                                      real_score_growth_pc = CASE WHEN (g.real_score - g.real_score_growth != 0) THEN COALESCE((p.real_score - (g.real_score - g.real_score_growth)) * 100.0 / (g.real_score - g.real_score_growth), 0) ELSE 0 END,
-                                      real_score_rank_change = p.real_score_rank - COALESCE(g.real_score_rank - g.real_score_rank_change, 0),
-                                      totalroundroids_rank_change = t.totalroundroids_rank - COALESCE(g.totalroundroids_rank - g.totalroundroids_rank_change, 0),
-                                      totallostroids_rank_change = t.totallostroids_rank - COALESCE(g.totallostroids_rank - g.totallostroids_rank_change, 0),
-                                      totalroundroids_growth = t.totalroundroids - COALESCE(g.totalroundroids - g.totalroundroids_growth, 0),
-                                      totalroundroids_growth_pc = CASE WHEN (g.totalroundroids - g.totalroundroids_growth != 0) THEN COALESCE((t.totalroundroids - (g.totalroundroids - g.totalroundroids_growth)) * 100.0 / (g.totalroundroids - g.totalroundroids_growth), 0) ELSE 0 END,
-                                      totallostroids_growth = t.totallostroids - COALESCE(g.totallostroids - g.totallostroids_growth, 0),
-                                      totallostroids_growth_pc = CASE WHEN (g.totallostroids - g.totallostroids_growth != 0) THEN COALESCE((t.totallostroids - (g.totallostroids - g.totallostroids_growth)) * 100.0 / (g.totallostroids - g.totallostroids_growth), 0) ELSE 0 END,
-                                 """ if not midnight
-                                     else
-                                 """
-                                      size_growth = t.size - COALESCE(g.size, 0),
-                                      score_growth = t.score - COALESCE(g.score, 0),
-                                      value_growth = t.value - COALESCE(g.value, 0),
-                                      xp_growth = t.xp - COALESCE(g.xp, 0),
-                                      member_growth = p.count - COALESCE(g.members, 0),
-                                      size_growth_pc = CASE WHEN (g.size != 0) THEN COALESCE((t.size - g.size) * 100.0 / g.size, 0) ELSE 0 END,
-                                      score_growth_pc = CASE WHEN (g.score != 0) THEN COALESCE((t.score - g.score) * 100.0 / g.score * 100, 0) ELSE 0 END,
-                                      value_growth_pc = CASE WHEN (g.value != 0) THEN COALESCE((t.value - g.value) * 100.0 / g.value, 0) ELSE 0 END,
-                                      xp_growth_pc = CASE WHEN (g.xp != 0) THEN COALESCE((t.xp - g.xp) * 100.0 / g.xp, 0) ELSE 0 END,
-                                      size_rank_change = t.size_rank - COALESCE(g.size_rank, 0),
-                                      score_rank_change = t.score_rank - COALESCE(g.score_rank, 0),
-                                      value_rank_change = t.value_rank - COALESCE(g.value_rank, 0),
-                                      xp_rank_change = t.xp_rank - COALESCE(g.xp_rank, 0),
-                                      real_score_growth = p.real_score - COALESCE(g.real_score, 0),
-                                      real_score_growth_pc = CASE WHEN (g.real_score != 0) THEN COALESCE((p.real_score - g.real_score) * 100.0 / g.real_score * 100, 0) ELSE 0 END,
-                                      real_score_rank_change = p.real_score_rank - COALESCE(g.real_score_rank, 0),
-                                      totalroundroids_rank_change = t.totalroundroids_rank - COALESCE(g.totalroundroids_rank, 0),
-                                      totallostroids_rank_change = t.totallostroids_rank - COALESCE(g.totallostroids_rank, 0),
-                                      totalroundroids_growth = t.totalroundroids - COALESCE(g.totalroundroids, 0),
-                                      totalroundroids_growth_pc = CASE WHEN (g.totalroundroids != 0) THEN COALESCE((t.totalroundroids - g.totalroundroids) * 100.0 / g.totalroundroids, 0) ELSE 0 END,
-                                      totallostroids_growth = t.totallostroids - COALESCE(g.totallostroids, 0),
-                                      totallostroids_growth_pc = CASE WHEN (g.totallostroids != 0) THEN COALESCE((t.totallostroids - g.totallostroids) * 100.0 / g.totallostroids, 0) ELSE 0 END,
-                                 """ ) +
-                                 """
-                                      ticksroiding = COALESCE(g.ticksroiding, 0) + CASE WHEN (t.size > g.size AND (t.size - g.size) != (t.xp - g.xp)) THEN 1 ELSE 0 END,
-                                      ticksroided = COALESCE(g.ticksroided, 0) + CASE WHEN (t.size < g.size) THEN 1 ELSE 0 END,
-                                      tickroids = COALESCE(g.tickroids, 0) + t.size,
-                                      avroids = COALESCE((g.tickroids + t.size) / (g.age + 1.0), t.size),
-                                      roidxp = CASE WHEN (t.size != 0) THEN t.xp * 1.0 / t.size ELSE 0 END,
-                                 """ + ((
-                                 """
-                                      %s_highest_rank = CASE WHEN (t.%s_rank <= COALESCE(g.%s_highest_rank, t.%s_rank)) THEN t.%s_rank ELSE g.%s_highest_rank END,
-                                      %s_highest_rank_tick = CASE WHEN (t.%s_rank <= COALESCE(g.%s_highest_rank, t.%s_rank)) THEN :tick ELSE g.%s_highest_rank_tick END,
-                                      %s_lowest_rank = CASE WHEN (t.%s_rank >= COALESCE(g.%s_lowest_rank, t.%s_rank)) THEN t.%s_rank ELSE g.%s_lowest_rank END,
-                                      %s_lowest_rank_tick = CASE WHEN (t.%s_rank >= COALESCE(g.%s_lowest_rank, t.%s_rank)) THEN :tick ELSE g.%s_lowest_rank_tick END,
-                                 """ * 4) % (("size",)*22 + ("score",)*22 + ("value",)*22 + ("xp",)*22)) +
-                                 """
-                                      real_score_highest_rank = CASE WHEN (p.real_score_rank <= COALESCE(g.real_score_highest_rank, p.real_score_rank)) THEN p.real_score_rank ELSE g.real_score_highest_rank END,
-                                      real_score_highest_rank_tick = CASE WHEN (p.real_score_rank <= COALESCE(g.real_score_highest_rank, p.real_score_rank)) THEN :tick ELSE g.real_score_highest_rank_tick END,
-                                      real_score_lowest_rank = CASE WHEN (p.real_score_rank >= COALESCE(g.real_score_lowest_rank, p.real_score_rank)) THEN p.real_score_rank ELSE g.real_score_lowest_rank END,
-                                      real_score_lowest_rank_tick = CASE WHEN (p.real_score_rank >= COALESCE(g.real_score_lowest_rank, p.real_score_rank)) THEN :tick ELSE g.real_score_lowest_rank_tick END,
-                                      real_score = p.real_score, real_score_rank = p.real_score_rank,
-                                      totalroundroids = t.totalroundroids, totallostroids = t.totallostroids,
-                                      totalroundroids_rank = t.totalroundroids_rank, totallostroids_rank = t.totallostroids_rank,
-                                      size_rank = t.size_rank, score_rank = t.score_rank, value_rank = t.value_rank, xp_rank = t.xp_rank,
-                                      vdiff = COALESCE(t.value - g.value, 0),
-                                      sdiff = COALESCE(t.score - g.score, 0),
-                                      rsdiff = COALESCE(p.real_score - g.real_score, 0),
-                                      xdiff = COALESCE(t.xp - g.xp, 0),
-                                      rdiff = COALESCE(t.size - g.size, 0),
-                                      mdiff = COALESCE(p.count - g.members, 0),
-                                      vrankdiff = COALESCE(t.value_rank - g.value_rank, 0),
-                                      srankdiff = COALESCE(t.score_rank - g.score_rank, 0),
-                                      rsrankdiff = COALESCE(p.real_score_rank - g.real_score_rank, 0),
-                                      xrankdiff = COALESCE(t.xp_rank - g.xp_rank, 0),
-                                      rrankdiff = COALESCE(t.size_rank - g.size_rank, 0),
-                                      idle = CASE WHEN ((t.value-g.value) BETWEEN (g.vdiff-1) AND (g.vdiff+1) AND (g.xp-t.xp=0)) THEN 1 + COALESCE(g.idle, 0) ELSE 0 END
-                                    FROM (SELECT *,
-                                      rank() OVER (ORDER BY totalroundroids DESC) AS totalroundroids_rank,
-                                      rank() OVER (ORDER BY totallostroids DESC) AS totallostroids_rank,
-                                      rank() OVER (ORDER BY size DESC) AS size_rank,
-                                      rank() OVER (ORDER BY score DESC) AS score_rank,
-                                      rank() OVER (ORDER BY value DESC) AS value_rank,
-                                      rank() OVER (ORDER BY xp DESC) AS xp_rank
-                                    FROM (SELECT t.*,
-                                      COALESCE(g.totalroundroids + (GREATEST(t.size - g.size, 0)), t.size) AS totalroundroids,
-                                      COALESCE(g.totallostroids + (GREATEST(g.size - t.size, 0)), 0) AS totallostroids
-                                    FROM galaxy AS g, galaxy_temp AS t
-                                      WHERE g.id = t.id AND g.active = :true) AS t) AS t,
-                                      (SELECT a.x, a.y, a.count, a.real_score,
-                                        rank() OVER (ORDER BY a.real_score DESC) AS real_score_rank
-                                      FROM (SELECT x, y,
-                                          count(*) AS count,
-                                          sum(score) AS real_score
-                                        FROM planet_temp
-                                        GROUP BY x, y
-                                        ) AS a
-                                      ) AS p
-                                    WHERE g.id = t.id
-                                       AND g.x = p.x AND g.y = p.y
-                                    AND g.active = :true
-                                ;""", bindparams=[tick, true, bindparam("priv_gal",PA.getint("numbers", "priv_gal"))]))
-    
-            t2=time.time()-t1
-            excaliburlog("Update galaxies from temp and generate ranks in %.3f seconds" % (t2,))
-            t1=time.time()
-    
-    # ########################################################################### #
-    # ##############################    PLANETS    ############################## #
-    # ########################################################################### #
-    
-    
-            # Any planets in the temp table without an id are new
-            # Insert them to the current table and the id(serial/auto_increment)
-            #  will be generated, and we can then copy it back to the temp table
-            session.execute(text("INSERT INTO planet (id, active) SELECT id, :true FROM planet_temp WHERE id NOT IN (SELECT id FROM planet);", bindparams=[true]))
-
-            t2=time.time()-t1
-            excaliburlog("Insert new planets in %.3f seconds" % (t2,))
-            t1=time.time()
-    
-            # Create records of new planets,
-            session.execute(text("""INSERT INTO planet_exiles (hour, tick, id, newx, newy, newz)
-                                    SELECT :hour, :tick, planet.id, planet_temp.x, planet_temp.y, planet_temp.z
-                                    FROM planet_temp, planet
-                                    WHERE
-                                        planet.id= planet_temp.id AND
-                                        planet.active = :true AND
-                                        planet.age IS NULL
-                                ;""", bindparams=[tick, hour, true]))
-            # deleted plantes
-            session.execute(text("""INSERT INTO planet_exiles (hour, tick, id, oldx, oldy, oldz)
-                                    SELECT :hour, :tick, planet.id, planet.x, planet.y, planet.z
-                                    FROM planet
-                                    WHERE
-                                        planet.active = :true AND
-                                        planet.age IS NOT NULL AND
-                                        planet.id NOT IN (SELECT id FROM planet_temp WHERE id IS NOT NULL)
-                                ;""", bindparams=[tick, hour, true]))
-            # planet renames
-            session.execute(text("""INSERT INTO planet_exiles (hour, tick, id, oldx, oldy, oldz, newx, newy, newz)
-                                    SELECT :hour, :tick, planet.id, planet.x, planet.y, planet.z, planet_temp.x, planet_temp.y, planet_temp.z
-                                    FROM planet_temp, planet
-                                    WHERE
-                                        planet.id = planet_temp.id AND
-                                        planet.active = :true AND
-                                        planet.age IS NOT NULL AND
-                                        (planet.rulername != planet_temp.rulername OR planet.planetname != planet_temp.planetname)
-                                ;""", bindparams=[tick, hour, true]))
-            # and planet movements
-            session.execute(text("""INSERT INTO planet_exiles (hour, tick, id, oldx, oldy, oldz, newx, newy, newz)
-                                    SELECT :hour, :tick, planet.id, planet.x, planet.y, planet.z, planet_temp.x, planet_temp.y, planet_temp.z
-                                    FROM planet_temp, planet
-                                    WHERE
-                                        planet.id = planet_temp.id AND
-                                        planet.active = :true AND
-                                        planet.age IS NOT NULL AND
-                                        (planet.x != planet_temp.x OR planet.y != planet_temp.y OR planet.z != planet_temp.z)
-                                ;""", bindparams=[tick, hour, true]))
-    
-            t2=time.time()-t1
-            excaliburlog("Track new/deleted/moved planets in %.3f seconds" % (t2,))
-            t1=time.time()
-    
-            # For planets that are no longer present in the new dump
-            session.execute(text("UPDATE planet SET active = :false WHERE active AND id NOT IN (SELECT id FROM planet_temp WHERE id IS NOT NULL);", bindparams=[false]))
-            # For planets that are present in the new dump but weren't. I don't think this should happen, but you never know
-            session.execute(text("UPDATE planet SET active = :true WHERE NOT active AND id IN (SELECT id FROM planet_temp WHERE id IS NOT NULL);", bindparams=[true]))
-    
-            t2=time.time()-t1
-            excaliburlog("Deactivate old planets in %.3f seconds" % (t2,))
-            t1=time.time()
-    
-            # Update everything from the temp table and generate ranks
-            # Deactivated items are untouched but NULLed earlier
-            session.execute(text("""UPDATE planet AS p SET
-                                      age = COALESCE(p.age, 0) + 1,
-                                      x = t.x, y = t.y, z = t.z,
-                                      planetname = t.planetname, rulername = t.rulername, race = t.race,
-                                      size = t.size, score = t.score, value = t.value, xp = t.xp, special = t.special,
-                                      ratio = CASE WHEN (t.value != 0) THEN 10000.0 * t.size / t.value ELSE 0 END,
-                                 """ + ((
-                                 """
-                                      size_growth = t.size - COALESCE(p.size - p.size_growth, 0),
-                                      score_growth = t.score - COALESCE(p.score - p.score_growth, 0),
-                                      value_growth = t.value - COALESCE(p.value - p.value_growth, 0),
-                                      xp_growth = t.xp - COALESCE(p.xp - p.xp_growth, 0),
-                                      size_growth_pc = CASE WHEN (p.size - p.size_growth != 0) THEN COALESCE((t.size - (p.size - p.size_growth)) * 100.0 / (p.size - p.size_growth), 0) ELSE 0 END,
-                                      score_growth_pc = CASE WHEN (p.score - p.score_growth != 0) THEN COALESCE((t.score - (p.score - p.score_growth)) * 100.0 / (p.score - p.score_growth), 0) ELSE 0 END,
-                                      value_growth_pc = CASE WHEN (p.value - p.value_growth != 0) THEN COALESCE((t.value - (p.value - p.value_growth)) * 100.0 / (p.value - p.value_growth), 0) ELSE 0 END,
-                                      xp_growth_pc = CASE WHEN (p.xp - p.xp_growth != 0) THEN COALESCE((t.xp - (p.xp - p.xp_growth)) * 100.0 / (p.xp - p.xp_growth), 0) ELSE 0 END,
-                                 """ + ((
-                                 """
-                                      %ssize_rank_change = t.%ssize_rank - COALESCE(p.%ssize_rank - p.%ssize_rank_change, 0),
-                                      %sscore_rank_change = t.%sscore_rank - COALESCE(p.%sscore_rank - p.%sscore_rank_change, 0),
-                                      %svalue_rank_change = t.%svalue_rank - COALESCE(p.%svalue_rank - p.%svalue_rank_change, 0),
-                                      %sxp_rank_change = t.%sxp_rank - COALESCE(p.%sxp_rank - p.%sxp_rank_change, 0),
-                                      %stotalroundroids_rank_change = t.%stotalroundroids_rank - COALESCE(p.%stotalroundroids_rank - p.%stotalroundroids_rank_change, 0),
-                                      %stotallostroids_rank_change = t.%stotallostroids_rank - COALESCE(p.%stotallostroids_rank - p.%stotallostroids_rank_change, 0),
-                                 """ * 4) % (("",)*24 + ("cluster_",)*24 + ("galaxy_",)*24 + ("race_",)*24)) +
-                                 """
-                                      totalroundroids_growth = t.totalroundroids - COALESCE(p.totalroundroids - p.totalroundroids_growth, 0),
-                                      totalroundroids_growth_pc = CASE WHEN (p.totalroundroids - p.totalroundroids_growth != 0) THEN COALESCE((t.totalroundroids - (p.totalroundroids - p.totalroundroids_growth)) * 100.0 / (p.totalroundroids - p.totalroundroids_growth), 0) ELSE 0 END,
-                                      totallostroids_growth = t.totallostroids - COALESCE(p.totallostroids - p.totallostroids_growth, 0),
-                                      totallostroids_growth_pc = CASE WHEN (p.totallostroids - p.totallostroids_growth != 0) THEN COALESCE((t.totallostroids - (p.totallostroids - p.totallostroids_growth)) * 100.0 / (p.totallostroids - p.totallostroids_growth), 0) ELSE 0 END,
-                                 """ ) if not midnight
-                                     else (
-                                 """
-                                      size_growth = t.size - COALESCE(p.size, 0),
-                                      score_growth = t.score - COALESCE(p.score, 0),
-                                      value_growth = t.value - COALESCE(p.value, 0),
-                                      xp_growth = t.xp - COALESCE(p.xp, 0),
-                                      size_growth_pc = CASE WHEN (p.size != 0) THEN COALESCE((t.size - p.size) * 100.0 / p.size, 0) ELSE 0 END,
-                                      score_growth_pc = CASE WHEN (p.score != 0) THEN COALESCE((t.score - p.score) * 100.0 / p.score, 0) ELSE 0 END,
-                                      value_growth_pc = CASE WHEN (p.value != 0) THEN COALESCE((t.value - p.value) * 100.0 / p.value, 0) ELSE 0 END,
-                                      xp_growth_pc = CASE WHEN (p.xp != 0) THEN COALESCE((t.xp - p.xp) * 100.0 / p.xp, 0) ELSE 0 END,
-                                 """ + ((
-                                 """
-                                      %ssize_rank_change = t.%ssize_rank - COALESCE(p.%ssize_rank, 0),
-                                      %sscore_rank_change = t.%sscore_rank - COALESCE(p.%sscore_rank, 0),
-                                      %svalue_rank_change = t.%svalue_rank - COALESCE(p.%svalue_rank, 0),
-                                      %sxp_rank_change = t.%sxp_rank - COALESCE(p.%sxp_rank, 0),
-                                      %stotalroundroids_rank_change = t.%stotalroundroids_rank - COALESCE(p.%stotalroundroids_rank, 0),
-                                      %stotallostroids_rank_change = t.%stotallostroids_rank - COALESCE(p.%stotallostroids_rank, 0),
-                                 """ * 4) % (("",)*18 + ("cluster_",)*18 + ("galaxy_",)*18 + ("race_",)*18)) +
-                                 """
-                                      totalroundroids_growth = t.totalroundroids - COALESCE(p.totalroundroids, 0),
-                                      totalroundroids_growth_pc = CASE WHEN (p.totalroundroids != 0) THEN COALESCE((t.totalroundroids - p.totalroundroids) * 100.0 / p.totalroundroids, 0) ELSE 0 END,
-                                      totallostroids_growth = t.totallostroids - COALESCE(p.totallostroids, 0),
-                                      totallostroids_growth_pc = CASE WHEN (p.totallostroids != 0) THEN COALESCE((t.totallostroids - p.totallostroids) * 100.0 / p.totallostroids, 0) ELSE 0 END,
-                                 """ )) +
-                                 """
-                                      totalroundroids = t.totalroundroids, totallostroids = t.totallostroids,
-                                 """ + ((
-                                 """
-                                      %ssize_rank = t.%ssize_rank, %sscore_rank = t.%sscore_rank, %svalue_rank = t.%svalue_rank, %sxp_rank = t.%sxp_rank,
-                                      %stotalroundroids_rank = t.%stotalroundroids_rank, %stotallostroids_rank = t.%stotallostroids_rank,
-                                 """ * 4) % (("",)*12 + ("cluster_",)*12 + ("galaxy_",)*12 + ("race_",)*12)) +
-                                 """
-                                      ticksroiding = COALESCE(p.ticksroiding, 0) + CASE WHEN (t.size > p.size AND (t.size - p.size) != (t.xp - p.xp)) THEN 1 ELSE 0 END,
-                                      ticksroided = COALESCE(p.ticksroided, 0) + CASE WHEN (t.size < p.size) THEN 1 ELSE 0 END,
-                                      tickroids = COALESCE(p.tickroids, 0) + t.size,
-                                      avroids = COALESCE((p.tickroids + t.size) / (p.age + 1.0), t.size),
-                                      roidxp = CASE WHEN (t.size != 0) THEN t.xp * 1.0 / t.size ELSE 0 END,
-                                 """ + ((
-                                 """
-                                      %s_highest_rank = CASE WHEN (t.%s_rank <= COALESCE(p.%s_highest_rank, t.%s_rank)) THEN t.%s_rank ELSE p.%s_highest_rank END,
-                                      %s_highest_rank_tick = CASE WHEN (t.%s_rank <= COALESCE(p.%s_highest_rank, t.%s_rank)) THEN :tick ELSE p.%s_highest_rank_tick END,
-                                      %s_lowest_rank = CASE WHEN (t.%s_rank >= COALESCE(p.%s_lowest_rank, t.%s_rank)) THEN t.%s_rank ELSE p.%s_lowest_rank END,
-                                      %s_lowest_rank_tick = CASE WHEN (t.%s_rank >= COALESCE(p.%s_lowest_rank, t.%s_rank)) THEN :tick ELSE p.%s_lowest_rank_tick END,
-                                 """ * 4) % (("size",)*22 + ("score",)*22 + ("value",)*22 + ("xp",)*22)) +
-                                 """
-                                      vdiff = COALESCE(t.value - p.value, 0),
-                                      sdiff = COALESCE(t.score - p.score, 0),
-                                      xdiff = COALESCE(t.xp - p.xp, 0),
-                                      rdiff = COALESCE(t.size - p.size, 0),
-                                      vrankdiff = COALESCE(t.value_rank - p.value_rank, 0),
-                                      srankdiff = COALESCE(t.score_rank - p.score_rank, 0),
-                                      xrankdiff = COALESCE(t.xp_rank - p.xp_rank, 0),
-                                      rrankdiff = COALESCE(t.size_rank - p.size_rank, 0),
-                                      idle = CASE WHEN ((t.value-p.value) BETWEEN (p.vdiff-1) AND (p.vdiff+1) AND (p.xp-t.xp=0)) THEN 1 + COALESCE(p.idle, 0) ELSE 0 END
-                                    FROM (SELECT *,
-                                 """ + ((
-                                 """
-                                      rank() OVER (PARTITION BY %s ORDER BY totalroundroids DESC) AS %s_totalroundroids_rank,
-                                      rank() OVER (PARTITION BY %s ORDER BY totallostroids DESC) AS %s_totallostroids_rank,
-                                      rank() OVER (PARTITION BY %s ORDER BY size DESC) AS %s_size_rank,
-                                      rank() OVER (PARTITION BY %s ORDER BY score DESC) AS %s_score_rank,
-                                      rank() OVER (PARTITION BY %s ORDER BY value DESC) AS %s_value_rank,
-                                      rank() OVER (PARTITION BY %s ORDER BY xp DESC) AS %s_xp_rank,
-                                 """ * 3) % (("x","cluster",)*6 + ("x, y","galaxy",)*6 + ("race","race",)*6)) +
-                                 """
-                                      rank() OVER (ORDER BY totalroundroids DESC) AS totalroundroids_rank,
-                                      rank() OVER (ORDER BY totallostroids DESC) AS totallostroids_rank,
-                                      rank() OVER (ORDER BY size DESC) AS size_rank,
-                                      rank() OVER (ORDER BY score DESC) AS score_rank,
-                                      rank() OVER (ORDER BY value DESC) AS value_rank,
-                                      rank() OVER (ORDER BY xp DESC) AS xp_rank
-                                    FROM (SELECT t.*,
-                                      COALESCE(p.totalroundroids + (GREATEST(t.size - p.size, 0)), t.size) AS totalroundroids,
-                                      COALESCE(p.totallostroids + (GREATEST(p.size - t.size, 0)), 0) AS totallostroids
-                                    FROM planet AS p, planet_temp AS t
-                                      WHERE p.id = t.id AND p.active = :true) AS t) AS t
-                                      WHERE p.id = t.id
-                                    AND p.active = :true
-                                ;""", bindparams=[tick, true]))
-    
-            t2=time.time()-t1
-            excaliburlog("Update planets from temp and generate ranks in %.3f seconds" % (t2,))
-            t1=time.time()
-    
-            # Idle data
-            session.execute(text("""INSERT INTO planet_idles (hour, tick, id, idle)
-                                    SELECT :hour, :tick, planet.id, planet.idle
-                                    FROM planet
-                                    WHERE
-                                        planet.idle > 0 AND
-                                        planet.active = :true
-                                ;""", bindparams=[tick, hour, true]))
-            # Value drops
-            session.execute(text("""INSERT INTO planet_value_drops (hour, tick, id, vdiff)
-                                    SELECT :hour, :tick, planet.id, planet.vdiff
-                                    FROM planet
-                                    WHERE
-                                        planet.vdiff < 0 AND
-                                        planet.active = :true
-                                ;""", bindparams=[tick, hour, true]))
-            # Landings
-            session.execute(text("""INSERT INTO planet_landings (hour, tick, id, rdiff)
-                                    SELECT :hour, :tick, planet.id, planet.rdiff
-                                    FROM planet
-                                    WHERE
-                                        planet.rdiff > 0 AND
-                                        planet.rdiff != planet.xdiff AND
-                                        planet.active = :true
-                                ;""", bindparams=[tick, hour, true]))
-            # Landed on
-            session.execute(text("""INSERT INTO planet_landed_on (hour, tick, id, rdiff)
-                                    SELECT :hour, :tick, planet.id, planet.rdiff
-                                    FROM planet
-                                    WHERE
-                                        planet.rdiff < 0 AND
-                                        planet.active = :true
-                                ;""", bindparams=[tick, hour, true]))
-    
-            t2=time.time()-t1
-            excaliburlog("Planet stats in in %.3f seconds" % (t2,))
-            t1=time.time()
-    
-    # ########################################################################### #
-    # #############################    ALLIANCES    ############################# #
-    # ########################################################################### #
-    
-            # Update the newly dumped data with IDs from the current data
-            #  based on a name match in the two tables (and active=True)
-            session.execute(text("""UPDATE alliance_temp AS t SET
-                                      id = a.id
-                                    FROM (SELECT id, name FROM alliance) AS a
-                                      WHERE t.name = a.name
-                                ;"""))
-    
-            # Make sure all the alliances are active,
-            #  some might have been deactivated previously
-            session.execute(text("UPDATE alliance SET active = :true;", bindparams=[true]))
-    
-            t2=time.time()-t1
-            excaliburlog("Copy alliance ids to temp and activate in %.3f seconds" % (t2,))
-            t1=time.time()
-    
-            # Any alliances in the temp table without an id are new
-            # Insert them to the current table and the id(serial/auto_increment)
-            #  will be generated, and we can then copy it back to the temp table
-            session.execute(text("INSERT INTO alliance (name, active) SELECT name, :true FROM alliance_temp WHERE id IS NULL;", bindparams=[true]))
-            session.execute(text("UPDATE alliance_temp SET id = (SELECT id FROM alliance WHERE alliance.name = alliance_temp.name AND alliance.active = :true ORDER BY alliance.id DESC) WHERE id IS NULL;", bindparams=[true]))
-    
-            # For alliances that are no longer present in the new dump, we will
-            #  NULL all the data, leaving only the name and id for FKs
-            session.execute(text("UPDATE alliance SET active = :false WHERE id NOT IN (SELECT id FROM alliance_temp WHERE id IS NOT NULL);", bindparams=[false]))
-    
-            t2=time.time()-t1
-            excaliburlog("Deactivate old alliances and generate new alliance ids in %.3f seconds" % (t2,))
-            t1=time.time()
-    
-            # Update everything from the temp table and generate ranks
-            # Deactivated items are untouched but NULLed earlier
-            session.execute(text("""UPDATE alliance AS a SET
-                                      age = COALESCE(a.age, 0) + 1,
-                                      size = t.size, members = t.members, score = t.score, points = t.points,
-                                      score_total = t.score_total, value_total = t.value_total,
-                                      xp = (t.score_total - t.value_total) / 60,
-                                      size_avg = t.size_avg, score_avg = t.score_avg, points_avg = t.points_avg,
-                                      ratio = CASE WHEN (t.score != 0) THEN 10000.0 * t.size / t.score ELSE 0 END,
-                                 """ + (
-                                 """
-                                      size_growth = t.size - COALESCE(a.size - a.size_growth, 0),
-                                      score_growth = t.score - COALESCE(a.score - a.score_growth, 0),
-                                      points_growth = t.points - COALESCE(a.points - a.points_growth, 0),
-                                      member_growth = t.members - COALESCE(a.members - a.member_growth, 0),
-                                      size_growth_pc = CASE WHEN (a.size - a.size_growth != 0) THEN COALESCE((t.size - (a.size - a.size_growth)) * 100.0 / (a.size - a.size_growth), 0) ELSE 0 END,
-                                      score_growth_pc = CASE WHEN (a.score - a.score_growth != 0) THEN COALESCE((t.score - (a.score - a.score_growth)) * 100.0 / (a.score - a.score_growth), 0) ELSE 0 END,
-                                      points_growth_pc = CASE WHEN (a.points - a.points_growth != 0) THEN COALESCE((t.points - (a.points - a.points_growth)) * 100.0 / (a.points - a.points_growth), 0) ELSE 0 END,
-                                      size_avg_growth = t.size_avg - COALESCE(a.size_avg - a.size_avg_growth, 0),
-                                      score_avg_growth = t.score_avg - COALESCE(a.score_avg - a.score_avg_growth, 0),
-                                      points_avg_growth = t.points_avg - COALESCE(a.points_avg - a.points_avg_growth, 0),
-                                      size_avg_growth_pc = CASE WHEN (a.size_avg - a.size_avg_growth != 0) THEN COALESCE((t.size_avg - (a.size_avg - a.size_avg_growth)) * 100.0 / (a.size_avg - a.size_avg_growth), 0) ELSE 0 END,
-                                      score_avg_growth_pc = CASE WHEN (a.score_avg - a.score_avg_growth != 0) THEN COALESCE((t.score_avg - (a.score_avg - a.score_avg_growth)) * 100.0 / (a.score_avg - a.score_avg_growth), 0) ELSE 0 END,
-                                      points_avg_growth_pc = CASE WHEN (a.points_avg - a.points_avg_growth != 0) THEN COALESCE((t.points_avg - (a.points_avg - a.points_avg_growth)) * 100.0 / (a.points_avg - a.points_avg_growth), 0) ELSE 0 END,
-                                      size_rank_change = t.size_rank - COALESCE(a.size_rank - a.size_rank_change, 0),
-                                      members_rank_change = t.members_rank - COALESCE(a.members_rank - a.members_rank_change, 0),
-                                      score_rank_change = t.score_rank - COALESCE(a.score_rank - a.score_rank_change, 0),
-                                      points_rank_change = t.points_rank - COALESCE(a.points_rank - a.points_rank_change, 0),
-                                      size_avg_rank_change = t.size_avg_rank - COALESCE(a.size_avg_rank - a.size_avg_rank_change, 0),
-                                      score_avg_rank_change = t.score_avg_rank - COALESCE(a.score_avg_rank - a.score_avg_rank_change, 0),
-                                      points_avg_rank_change = t.points_avg_rank - COALESCE(a.points_avg_rank - a.points_avg_rank_change, 0),
-                                      totalroundroids_rank_change = t.totalroundroids_rank - COALESCE(a.totalroundroids_rank - a.totalroundroids_rank_change, 0),
-                                      totallostroids_rank_change = t.totallostroids_rank - COALESCE(a.totallostroids_rank - a.totallostroids_rank_change, 0),
-                                      totalroundroids_growth = t.totalroundroids - COALESCE(a.totalroundroids - a.totalroundroids_growth, 0),
-                                      totalroundroids_growth_pc = CASE WHEN (a.totalroundroids - a.totalroundroids_growth != 0) THEN COALESCE((t.totalroundroids - (a.totalroundroids - a.totalroundroids_growth)) * 100.0 / (a.totalroundroids - a.totalroundroids_growth), 0) ELSE 0 END,
-                                      totallostroids_growth = t.totallostroids - COALESCE(a.totallostroids - a.totallostroids_growth, 0),
-                                      totallostroids_growth_pc = CASE WHEN (a.totallostroids - a.totallostroids_growth != 0) THEN COALESCE((t.totallostroids - (a.totallostroids - a.totallostroids_growth)) * 100.0 / (a.totallostroids - a.totallostroids_growth), 0) ELSE 0 END,
-                                 """ if not midnight
-                                     else
-                                 """
-                                      size_growth = t.size - COALESCE(a.size, 0),
-                                      score_growth = t.score - COALESCE(a.score, 0),
-                                      points_growth = t.points - COALESCE(a.points, 0),
-                                      member_growth = t.members - COALESCE(a.members, 0),
-                                      size_growth_pc = CASE WHEN (a.size != 0) THEN COALESCE((t.size - a.size) * 100.0 / a.size, 0) ELSE 0 END,
-                                      score_growth_pc = CASE WHEN (a.score != 0) THEN COALESCE((t.score - a.score) * 100.0 / a.score, 0) ELSE 0 END,
-                                      points_growth_pc = CASE WHEN (a.points != 0) THEN COALESCE((t.points - a.points) * 100.0 / a.points, 0) ELSE 0 END,
-                                      size_avg_growth = t.size_avg - COALESCE(a.size_avg, 0),
-                                      score_avg_growth = t.score_avg - COALESCE(a.score_avg, 0),
-                                      points_avg_growth = t.points_avg - COALESCE(a.points_avg, 0),
-                                      size_avg_growth_pc = CASE WHEN (a.size_avg != 0) THEN COALESCE((t.size_avg - a.size_avg) * 100.0 / a.size_avg, 0) ELSE 0 END,
-                                      score_avg_growth_pc = CASE WHEN (a.score_avg != 0) THEN COALESCE((t.score_avg - a.score_avg) * 100.0 / a.score_avg, 0) ELSE 0 END,
-                                      points_avg_growth_pc = CASE WHEN (a.points_avg != 0) THEN COALESCE((t.points_avg - a.points_avg) * 100.0 / a.points_avg, 0) ELSE 0 END,
-                                      size_rank_change = t.size_rank - COALESCE(a.size_rank, 0),
-                                      members_rank_change = t.members_rank - COALESCE(a.members_rank, 0),
-                                      score_rank_change = t.score_rank - COALESCE(a.score_rank, 0),
-                                      points_rank_change = t.points_rank - COALESCE(a.points_rank, 0),
-                                      size_avg_rank_change = t.size_avg_rank - COALESCE(a.size_avg_rank, 0),
-                                      score_avg_rank_change = t.score_avg_rank - COALESCE(a.score_avg_rank, 0),
-                                      points_avg_rank_change = t.points_avg_rank - COALESCE(a.points_avg_rank, 0),
-                                      totalroundroids_rank_change = t.totalroundroids_rank - COALESCE(a.totalroundroids_rank, 0),
-                                      totallostroids_rank_change = t.totallostroids_rank - COALESCE(a.totallostroids_rank, 0),
-                                      totalroundroids_growth = t.totalroundroids - COALESCE(a.totalroundroids, 0),
-                                      totalroundroids_growth_pc = CASE WHEN (a.totalroundroids != 0) THEN COALESCE((t.totalroundroids - a.totalroundroids) * 100.0 / a.totalroundroids, 0) ELSE 0 END,
-                                      totallostroids_growth = t.totallostroids - COALESCE(a.totallostroids, 0),
-                                      totallostroids_growth_pc = CASE WHEN (a.totallostroids != 0) THEN COALESCE((t.totallostroids - a.totallostroids) * 100.0 / a.totallostroids, 0) ELSE 0 END,
-                                 """ ) +
-                                 """
-                                      ticksroiding = COALESCE(a.ticksroiding, 0) + CASE WHEN (t.size > a.size) THEN 1 ELSE 0 END,
-                                      ticksroided = COALESCE(a.ticksroided, 0) + CASE WHEN (t.size < a.size) THEN 1 ELSE 0 END,
-                                      tickroids = COALESCE(a.tickroids, 0) + t.size,
-                                      avroids = COALESCE((a.tickroids + t.size) / (a.age + 1.0), t.size),
-                                 """ + ((
-                                 """
-                                      %s_highest_rank = CASE WHEN (t.%s_rank <= COALESCE(a.%s_highest_rank, t.%s_rank)) THEN t.%s_rank ELSE a.%s_highest_rank END,
-                                      %s_highest_rank_tick = CASE WHEN (t.%s_rank <= COALESCE(a.%s_highest_rank, t.%s_rank)) THEN :tick ELSE a.%s_highest_rank_tick END,
-                                      %s_lowest_rank = CASE WHEN (t.%s_rank >= COALESCE(a.%s_lowest_rank, t.%s_rank)) THEN t.%s_rank ELSE a.%s_lowest_rank END,
-                                      %s_lowest_rank_tick = CASE WHEN (t.%s_rank >= COALESCE(a.%s_lowest_rank, t.%s_rank)) THEN :tick ELSE a.%s_lowest_rank_tick END,
-                                 """ * 7) % (("size",)*22 + ("members",)*22 + ("score",)*22 + ("points",)*22 + ("size_avg",)*22 + ("score_avg",)*22 + ("points_avg",)*22)) +
-                                 """
-                                      totalroundroids = t.totalroundroids, totallostroids = t.totallostroids,
-                                      totalroundroids_rank = t.totalroundroids_rank, totallostroids_rank = t.totallostroids_rank,
-                                      size_rank = t.size_rank, members_rank = t.members_rank, score_rank = t.score_rank, points_rank = t.points_rank,
-                                      size_avg_rank = t.size_avg_rank, score_avg_rank = t.score_avg_rank, points_avg_rank = t.points_avg_rank,
-                                      sdiff = COALESCE(t.score - a.score, 0),
-                                      pdiff = COALESCE(t.points - a.points, 0),
-                                      rdiff = COALESCE(t.size - a.size, 0),
-                                      mdiff = COALESCE(t.members - a.members, 0),
-                                      srankdiff = COALESCE(t.score_rank - a.score_rank, 0),
-                                      prankdiff = COALESCE(t.points_rank - a.points_rank, 0),
-                                      rrankdiff = COALESCE(t.size_rank - a.size_rank, 0),
-                                      mrankdiff = COALESCE(t.members_rank - a.members_rank, 0),
-                                      savgdiff = COALESCE(t.score_avg - a.score_avg, 0),
-                                      pavgdiff = COALESCE(t.points_avg - a.points_avg, 0),
-                                      ravgdiff = COALESCE(t.size_avg - a.size_avg, 0),
-                                      savgrankdiff = COALESCE(t.score_avg_rank - a.score_avg_rank, 0),
-                                      pavgrankdiff = COALESCE(t.points_avg_rank - a.points_avg_rank, 0),
-                                      ravgrankdiff = COALESCE(t.size_avg_rank - a.size_avg_rank, 0),
-                                      idle = CASE WHEN ((t.score-a.score) BETWEEN (a.sdiff-1) AND (a.sdiff+1)) THEN 1 + COALESCE(a.idle, 0) ELSE 0 END
-                                    FROM (SELECT *,
-                                      rank() OVER (ORDER BY totalroundroids DESC) AS totalroundroids_rank,
-                                      rank() OVER (ORDER BY totallostroids DESC) AS totallostroids_rank,
-                                      rank() OVER (ORDER BY size DESC) AS size_rank,
-                                      rank() OVER (ORDER BY points DESC) AS points_rank,
-                                      rank() OVER (ORDER BY members DESC) AS members_rank,
-                                      rank() OVER (ORDER BY size_avg DESC) AS size_avg_rank,
-                                      rank() OVER (ORDER BY score_avg DESC) AS score_avg_rank,
-                                      rank() OVER (ORDER BY points_avg DESC) AS points_avg_rank
-                                    FROM (SELECT t.*,
-                                      COALESCE(a.totalroundroids + (GREATEST(t.size - a.size, 0)), t.size) AS totalroundroids,
-                                      COALESCE(a.totallostroids + (GREATEST(a.size - t.size, 0)), 0) AS totallostroids
-                                    FROM alliance AS a, alliance_temp AS t
-                                      WHERE a.id = t.id AND a.active = :true) AS t) AS t
-                                      WHERE a.id = t.id
-                                    AND a.active = :true
-                                ;""", bindparams=[tick, true]))
-    
-            t2=time.time()-t1
-            excaliburlog("Update alliances from temp and generate ranks in %.3f seconds" % (t2,))
-            t1=time.time()
-    
-    # ########################################################################### #
-    # ##################   HISTORY: EVERYTHING BECOMES FINAL   ################## #
-    # ########################################################################### #
-    
-            # Update stats
-            session.execute(text("""UPDATE updates SET
-                                      clusters  = (SELECT count(*) FROM cluster  WHERE cluster.active  = :true),
-                                      galaxies  = (SELECT count(*) FROM galaxy   WHERE galaxy.active   = :true),
-                                      planets   = (SELECT count(*) FROM planet   WHERE planet.active   = :true),
-                                      alliances = (SELECT count(*) FROM alliance WHERE alliance.active = :true),
-                                      c200     = (SELECT count(*) FROM planet WHERE planet.active = :true AND x = 200),
-                                      ter      = (SELECT count(*) FROM planet WHERE planet.active = :true AND race ILIKE 'ter%'),
-                                      cat      = (SELECT count(*) FROM planet WHERE planet.active = :true AND race ILIKE 'cat%'),
-                                      xan      = (SELECT count(*) FROM planet WHERE planet.active = :true AND race ILIKE 'xan%'),
-                                      zik      = (SELECT count(*) FROM planet WHERE planet.active = :true AND race ILIKE 'zik%'),
-                                      etd      = (SELECT count(*) FROM planet WHERE planet.active = :true AND race ILIKE 'etd%')
-                                    WHERE updates.id = :tick
-                                ;""", bindparams=[tick, true]))
-    
-            t2=time.time()-t1
-            excaliburlog("Update stats in: %.3f seconds" % (t2,))
-            t1=time.time()
-    
-            # Copy the dumps to their respective history tables
-            session.execute(text("INSERT INTO cluster_history SELECT :tick, :hour, :timestamp, * FROM cluster ORDER BY x ASC;", bindparams=[tick, hour, timestamp]))
-            session.execute(text("INSERT INTO galaxy_history SELECT :tick, :hour, :timestamp, * FROM galaxy ORDER BY id ASC;", bindparams=[tick, hour, timestamp]))
-            session.execute(text("INSERT INTO planet_history SELECT :tick, :hour, :timestamp, * FROM planet ORDER BY id ASC;", bindparams=[tick, hour, timestamp]))
-            session.execute(text("INSERT INTO alliance_history SELECT :tick, :hour, :timestamp, * FROM alliance ORDER BY id ASC;", bindparams=[tick, hour, timestamp]))
-    
-            t2=time.time()-t1
-            excaliburlog("History in %.3f seconds" % (t2,))
+            process_tick(planets, galaxies, alliances, headers, midnight, hour, timestamp)
             t1=time.time()
     
             # Finally we can commit!
             session.commit()
     
             t2=time.time()-t1
-            excaliburlog("Final update in %.3f seconds" % (t2,))
+            stagelog("Final update", t2)
             t1=time.time()
     
             break
@@ -1243,7 +1440,10 @@ def ticker(alt=False):
     if not alt:
         parse_userfeed(userfeed)
         t2=time.time()-t1
-        excaliburlog("Parsed User Feed in %.3f seconds" % (t2,))
+        stagelog("Parsed User Feed", t2)
+
+    save_timings(planets.tick)
+    session.close()
 
     if alt and planets.tick < alt:
         t1=time.time()-t_start
@@ -1256,29 +1456,82 @@ def ticker(alt=False):
     return planets.tick
 
 
+def rebuild(first, last, batch=None):
+    # Replay archived dumps from dumps/<tick>/ into the database. There is no
+    #  network, sleeping or reconnecting, and ticks are committed in batches.
+    batch = batch or rebuild_batch
+    t_start = time.time()
+    if first != Updates.current_tick() + 1:
+        excaliburlog("Rebuild must start from the tick after the current tick (%s)" % (Updates.current_tick() + 1,))
+        return False
+    count = 0
+    try:
+        for tick in range(first, last+1):
+            path = "dumps/%s/" % (tick,)
+            if not os.path.exists(path + "planet_listing.txt"):
+                excaliburlog("No archived dumps for tick %s, stopping." % (tick,))
+                break
+            # The dumps were saved as they were downloaded, so their age gives the time of the tick
+            saved = datetime.datetime.utcfromtimestamp(os.path.getmtime(path + "planet_listing.txt"))
+            hour = bindparam("hour",saved.hour)
+            timestamp = bindparam("timestamp",saved - datetime.timedelta(minutes=1))
+            with open(path + "planet_listing.txt") as pf, open(path + "galaxy_listing.txt") as gf, open(path + "alliance_listing.txt") as af:
+                planets   = planetfile(pf)
+                galaxies  = galaxyfile(gf)
+                alliances = alliancefile(af)
+                if not planets.tick == galaxies.tick == alliances.tick == tick:
+                    excaliburlog("Archived dumps for tick %s are for the wrong tick\nPlanet: %s, Galaxy: %s, Alliance: %s" % (tick, planets.tick, galaxies.tick, alliances.tick))
+                    break
+                process_tick(planets, galaxies, alliances, {}, saved.hour == 0, hour, timestamp)
+            if os.path.exists(path + "user_feed.txt"):
+                with open(path + "user_feed.txt") as uf:
+                    parse_userfeed(feedfile(uf), commit=False)
+            save_timings(tick, commit=False)
+            count += 1
+            if count % batch == 0:
+                session.commit()
+                excaliburlog("Rebuilt up to tick %s at %.2f ticks/sec" % (tick, count / (time.time() - t_start)))
+        session.commit()
+    except Exception, e:
+        excaliburlog("Rebuild failed, rolling back to tick %s: %s" % (first + count - count % batch - 1, str(e),), traceback=True)
+        session.rollback()
+        del timings[:]
+        count -= count % batch
+    finally:
+        session.close()
+    t1=time.time()-t_start
+    excaliburlog("Rebuilt %s ticks in %.3f seconds (%.2f ticks/sec)" % (count, t1, count / t1 if t1 else 0,))
+    return first + count - 1 if count else False
+
+
 def find1man(max_age):
     # Find one-man alliances and store intel
     # Can't use ORM fully here because intel is not shared
     # This will find any new 1-man alliances
     t_start = time.time()
-    results = session.query(Alliance, Planet).select_from(Alliance).filter(Alliance.age <= max_age, Alliance.members == 1, Alliance.active == True).join(Planet, and_(Planet.score == Alliance.score_total, Planet.value == Alliance.value_total, Planet.size == Alliance.size)).all()
-    for a, p in results:
-        count = 0
-        for ta, tp in results:
-            if ta.id == a.id:
-                count += 1
-        if count > 1:
-            excaliburlog("Uncertainty for one-man alliance %s" % (a.name))
-            continue
-        else:
-            for i in range(len(bots)):
-                if bots[i].getboolean("Misc", "findsmall"):
-                    if session.execute(text("SELECT planet_id FROM %sintel WHERE planet_id='%s';" % (prefixes[i], p.id))).rowcount == 0:
-                        session.execute(text("INSERT INTO %sintel (planet_id, alliance_id) VALUES ('%s', %s);" % (prefixes[i], p.id, a.id)))
-                    else:
-                        session.execute(text("UPDATE %sintel set alliance_id=%s WHERE planet_id='%s';" % (prefixes[i], a.id, p.id)))
+    # Match each alliance against the planets with its exact totals in one pass.
+    #  Alliances matching more than one planet can't be pinned down.
+    session.execute(text("""CREATE TEMP TABLE find1man ON COMMIT DROP AS
+                              SELECT alliance.id AS alliance_id, alliance.name AS name, MIN(planet.id) AS planet_id, COUNT(*) AS planets
+                              FROM alliance, planet
+                              WHERE alliance.age <= :age AND alliance.members = 1 AND alliance.active = :true
+                                AND planet.score = alliance.score_total AND planet.value = alliance.value_total AND planet.size = alliance.size
+                              GROUP BY alliance.id, alliance.name
+                          ;""", bindparams=[bindparam("age",max_age), true]))
+    for name, in session.execute(text("SELECT name FROM find1man WHERE planets > 1;")):
+        excaliburlog("Uncertainty for one-man alliance %s" % (name))
+    for i in range(len(bots)):
+        if bots[i].getboolean("Misc", "findsmall"):
+            changed  = session.execute(text("""UPDATE %sintel SET alliance_id = find1man.alliance_id FROM find1man
+                                                 WHERE find1man.planets = 1 AND %sintel.planet_id = find1man.planet_id
+                                                   AND %sintel.alliance_id IS DISTINCT FROM find1man.alliance_id
+                                             ;""" % (prefixes[i], prefixes[i], prefixes[i],))).rowcount
+            changed += session.execute(text("""INSERT INTO %sintel (planet_id, alliance_id) SELECT planet_id, alliance_id FROM find1man
+                                                 WHERE find1man.planets = 1 AND find1man.planet_id NOT IN (SELECT planet_id FROM %sintel)
+                                             ;""" % (prefixes[i], prefixes[i],))).rowcount
+            excaliburlog("Updated %s intel rows for one-man alliances in %sintel" % (changed, prefixes[i],))
     session.commit()
-    excaliburlog("Added intel for one-man alliances in %.3f seconds" % (time.time() - t_start))
+    stagelog("Added intel for one-man alliances", time.time() - t_start)
     session.close()
 
 
@@ -1297,6 +1550,15 @@ if __name__ == "__main__":
     if session.query(Scan).filter(Scan.tick == oldtick-1).filter(Scan.planet_id == None).count() > 0:
         errorlog("Something broke the scan parser. There are unparsed scans.")
 
+    if len(sys.argv) > 3 and sys.argv[1] == "--rebuild":
+        # excalibur.pg.py --rebuild <first tick> <last tick> [<ticks per transaction>]
+        planet_tick = rebuild(int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]) if len(sys.argv) > 4 else None)
+        if planet_tick:
+            penis()
+            update_graphs(planet_tick)
+            save_timings(planet_tick)
+        sys.exit()
+
     if len(sys.argv) > 1:
         Config.set("URL", "dumps", sys.argv[1])
     excaliburlog("Dumping from %s" %(Config.get("URL", "dumps"),))
@@ -1306,12 +1568,16 @@ if __name__ == "__main__":
         penis()
         closereqs(planet_tick)
         parsescans(oldtick)
-        clean_cache()
+        update_graphs(planet_tick)
         # Every 100 ticks check for missing 1-man alliances
         if planet_tick % 100 == 0:
             find1man(1177)
         else:
             find1man(planet_tick-oldtick)
+        # Don't exit until the scans queued by parsescans() are done
+        pool.join()
+        save_timings(planet_tick)
+        session.close()
     
     # Add a newline at the end
     excaliburlog("\n")
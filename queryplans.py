@@ -0,0 +1,104 @@
+# Query plan checks for merlin
+#
+# Runs EXPLAIN on the queries behind the most used commands and pages, with
+#  parameters taken from the data already in the database, and fails if any
+#  of them scans a large table sequentially instead of using an index.
+# Run it against a local database holding at least a few days of a round,
+#  eg. loaded with excalibur.pg.py --rebuild, after createdb.py --upgrade.
+#  Nothing is written to the database.
+#
+# Usage: python queryplans.py [rows]
+#  Tables the planner estimates to hold at least rows rows count as large,
+#  by default 10000.
+
+import json
+import sys
+
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql import asc, desc, func, text
+from sqlalchemy.sql.functions import count
+
+from Core.db import engine, session
+from Core.maps import Updates, Planet, PlanetHistory, Alliance, FleetScan, Target, LatestScan, history_partition
+
+def queries():
+    # The hot queries, built the way the code that runs them builds them
+    tick = Updates.current_tick()
+    planet = session.query(Planet).filter(Planet.active == True).order_by(asc(Planet.score_rank)).first()
+    alliance = session.query(Alliance).filter(Alliance.active == True).order_by(asc(Alliance.score_rank)).first()
+    if planet is None or alliance is None:
+        sys.exit("The database has no planets or alliances, load some dumps first")
+    x, y, z = planet.x, planet.y, planet.z
+    name = alliance.name[1:-1] or alliance.name
+
+    # PlanetHistory.load(x,y,z,tick)
+    Q = session.query(PlanetHistory).filter_by(x=x, y=y, z=z)
+    yield "PlanetHistory.load", Q.filter_by(tick=tick-1).filter_by(active=True)
+    near = Q.filter(PlanetHistory.tick.between(tick-history_partition, tick+history_partition))
+    yield "PlanetHistory.load closest", near.order_by(asc(func.abs(tick-PlanetHistory.tick))).filter_by(active=True)
+
+    # Alliance.load, each of its passes
+    Q = session.query(Alliance).filter_by(active=True)
+    for pass_, filter in (("name", Alliance.name.ilike(name),), ("name x%", Alliance.name.ilike(name+"%"),),
+                          ("alias", Alliance.alias.ilike(name),), ("alias x%", Alliance.alias.ilike(name+"%"),),
+                          ("name %x%", Alliance.name.ilike("%"+name+"%"),), ("alias %x%", Alliance.alias.ilike("%"+name+"%"),),):
+        yield "Alliance.load %s" % (pass_,), Q.filter(filter)
+
+    # !topcunts on a planet
+    owner = aliased(Planet)
+    target = aliased(Planet)
+    Q = session.query(owner.x, owner.y, owner.z, count())
+    Q = Q.join((FleetScan.owner, owner))
+    Q = Q.join((FleetScan.target, target))
+    Q = Q.filter(FleetScan.mission == "Attack")
+    Q = Q.filter(FleetScan.target == planet)
+    Q = Q.group_by(owner.x, owner.y, owner.z)
+    yield "topcunts", Q.order_by(desc(count()))
+
+    # Bookings of a planet
+    Q = session.query(Target).filter(Target.planet_id == planet.id)
+    yield "Target by planet and tick", Q.filter(Target.tick >= tick)
+
+    # Planet.load and its latest scans
+    yield "Planet.load", session.query(Planet).filter_by(x=x, y=y, z=z, active=True)
+    yield "LatestScan", session.query(LatestScan).filter(LatestScan.planet_id == planet.id)
+
+def large(rows):
+    # Tables the planner expects to be large
+    Q = session.execute(text("SELECT relname FROM pg_class WHERE relkind IN ('r', 'p') AND reltuples >= :rows;"), {"rows": rows})
+    return set([name for name, in Q])
+
+def plan(Q):
+    statement = Q.statement.compile(dialect=engine.dialect)
+    result = session.connection().execute("EXPLAIN (FORMAT JSON) " + unicode(statement), statement.params).scalar()
+    # psycopg2 only decodes json itself from 2.5
+    if isinstance(result, basestring):
+        result = json.loads(result)
+    return result[0]["Plan"]
+
+def seqscans(node, tables):
+    # Tables in the plan scanned sequentially
+    scans = []
+    if node.get("Node Type") == "Seq Scan" and node.get("Relation Name") in tables:
+        scans.append(node["Relation Name"])
+    for child in node.get("Plans", []):
+        scans += seqscans(child, tables)
+    return scans
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    failed = []
+    try:
+        tables = large(rows)
+        print "Large tables: %s" % (", ".join(sorted(tables)) or "none",)
+        for name, Q in queries():
+            node = plan(Q)
+            scans = seqscans(node, tables)
+            print "%-30s %-6s cost %10.2f %s" % (name, "FAIL" if scans else "ok", node["Total Cost"], ", ".join(["seq scan on %s" % (t,) for t in scans]),)
+            if scans:
+                failed.append(name)
+    finally:
+        session.rollback()
+        session.close()
+    if failed:
+        sys.exit("%s queries scan large tables sequentially: %s" % (len(failed), ", ".join(failed),))
@@ -0,0 +1,64 @@
+# Object cache tests
+#
+# Runs against an in-memory SQLite database, so only needs the modules merlin
+#  itself needs. From merlin's directory: python -m unittest discover tests
+
+import unittest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, scoped_session
+
+import Core.cache
+from Core.maps import User, user_cache
+
+class cacheTest(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        User.__table__.create(engine)
+        self.session = scoped_session(sessionmaker(bind=engine))
+        self.saved = (Core.cache.Session, Core.cache.session,)
+        Core.cache.Session, Core.cache.session = sessionmaker(bind=engine), self.session
+        user_cache.invalidate()
+        self.session.add(User(name="tester", passwd="password", active=True, access=100, phone="1", email="old@example.com"))
+        self.session.commit()
+        self.session.remove()
+    
+    def tearDown(self):
+        self.session.remove()
+        Core.cache.Session, Core.cache.session = self.saved
+        user_cache.invalidate()
+    
+    def saved_user(self):
+        self.session.remove()
+        return self.session.query(User).filter(User.name == "tester").one()
+    
+    def test_hit_keeps_pending_changes(self):
+        # !pref changes the user, then replies before committing, which
+        #  loads the user again through the cache
+        User.load("tester")
+        user = self.session.query(User).filter(User.name == "tester").one()
+        user.phone = "2"
+        user.email = "new@example.com"
+        self.assertTrue(User.load("tester") is user)
+        self.session.commit()
+        saved = self.saved_user()
+        self.assertEqual(saved.phone, "2")
+        self.assertEqual(saved.email, "new@example.com")
+    
+    def test_miss_keeps_pending_changes(self):
+        user = self.session.query(User).filter(User.name == "tester").one()
+        user.phone = "2"
+        self.assertTrue(User.load("tester") is user)
+        self.session.commit()
+        self.assertEqual(self.saved_user().phone, "2")
+    
+    def test_attaches_to_session(self):
+        User.load("tester")
+        self.session.remove()
+        user = User.load("tester")
+        self.assertTrue(user in self.session)
+        user.phone = "3"
+        self.session.commit()
+        self.assertEqual(self.saved_user().phone, "3")
+
+if __name__ == "__main__":
+    unittest.main()